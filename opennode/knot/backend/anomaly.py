@@ -0,0 +1,238 @@
+import logging
+import math
+
+from twisted.internet import defer
+from twisted.python import log
+from zope.component import handle
+
+from opennode.oms.config import get_config
+from opennode.oms.model.model.events import ModelModifiedEvent
+from opennode.oms.model.traversal import traverse1
+from opennode.oms.zodb import db
+
+
+# metric name -> signal watched for anomalies
+SIGNALS = {'cpu_usage': 'load',
+           'memory_usage': 'memory',
+           'diskspace_usage': 'disk_fill_rate'}
+
+# signal -> level it must reach for a point to count as anomalous, whatever its z-score: the 1 minute
+# load per core, the memory usage in % of the memory of the compute and the disk fill rate in MB/s
+LEVELS = {'load': 1.0,
+          'memory': 90.0,
+          'disk_fill_rate': 5.0}
+
+# signal -> smallest deviation (in the same units) a z-score is computed against, so that the first
+# activity of a quiet compute is not an anomaly
+FLOORS = {'load': 0.25,
+          'memory': 5.0,
+          'disk_fill_rate': 1.0}
+
+
+def positive(value):
+    return value if isinstance(value, (int, long, float)) and value > 0 else None
+
+
+def signal_value(value):
+    """Reduces a metric value to a number: the 1 minute load of load tuples, the total of per-partition
+    dicts"""
+    if isinstance(value, dict):
+        value = sum(v for v in value.itervalues() if isinstance(v, (int, long, float)))
+    elif isinstance(value, (tuple, list)):
+        value = value[0] if value else None
+    return float(value) if isinstance(value, (int, long, float)) else None
+
+
+class EwmaDetector(object):
+    """Streaming z-score of a signal against its exponentially weighted mean and variance.
+
+    Values scoring above `threshold` are folded into the baseline with a tenth of the weight, so that a
+    sustained anomaly keeps being reported for a while before it becomes the new normal.
+
+    """
+    __slots__ = ('alpha', 'threshold', 'warmup', 'floor', 'mean', 'var', 'count')
+
+    def __init__(self, alpha, threshold, warmup, floor=1e-9):
+        self.alpha = alpha
+        self.threshold = threshold
+        self.warmup = warmup
+        self.floor = floor
+        self.mean = None
+        self.var = 0.0
+        self.count = 0
+
+    def update(self, value):
+        """Folds the value in, returning its z-score against the previous values (None while warming up)"""
+        self.count += 1
+        if self.mean is None:
+            self.mean = value
+            return None
+
+        diff = value - self.mean
+        # floor the deviation, so that tiny changes of a flat signal are not anomalies
+        std = max(math.sqrt(self.var), 0.01 * abs(self.mean), self.floor)
+        score = diff / std
+
+        alpha = self.alpha if abs(score) <= self.threshold or self.count <= self.warmup else self.alpha / 10
+        self.mean += alpha * diff
+        self.var = (1 - alpha) * (self.var + alpha * diff * diff)
+        return score if self.count > self.warmup else None
+
+
+class ComputeHealth(object):
+
+    def __init__(self):
+        self.detectors = {}
+        self.hot = {}
+        self.degraded = False
+        self.calm = 0
+        self.last_disk = None
+        # number of cores and memory in MB of the compute, read on flush
+        self.loaded = False
+        self.cores = None
+        self.memory = None
+
+
+class AnomalyDetector(object):
+    """Flags computes whose load, memory usage or disk fill rate stray from their recent behaviour.
+
+    Each signal of each compute has an EWMA detector; a compute becomes degraded after `persistence`
+    consecutive points of a signal scoring above `threshold` while above its level, and recovers once
+    no signal did for `persistence` points. Load and memory are relative to the cores and memory of the
+    compute, which are read on the first flush; their points are ignored until then. Changes of the
+    `degraded` flag are written on flush, with a modified event.
+
+    """
+
+    def __init__(self, alpha=0.05, threshold=4.0, persistence=5, warmup=60, levels=None, floors=None):
+        self.alpha = alpha
+        self.threshold = threshold
+        self.persistence = persistence
+        self.warmup = warmup
+        self.levels = dict(LEVELS, **(levels or {}))
+        self.floors = dict(FLOORS, **(floors or {}))
+        self.health = {}
+        self.changes = {}
+
+    def set_capacity(self, compute_path, cores, memory):
+        health = self.health.get(compute_path)
+        if health is None:
+            health = self.health[compute_path] = ComputeHealth()
+        health.cores = positive(cores)
+        health.memory = positive(memory)
+        health.loaded = True
+
+    def observe(self, path, data_points):
+        compute_path, sep, metric = path.rpartition('/metrics/')
+        signal = SIGNALS.get(metric) if sep else None
+        if signal is None:
+            return
+
+        health = self.health.get(compute_path)
+        if health is None:
+            health = self.health[compute_path] = ComputeHealth()
+
+        detector = health.detectors.get(signal)
+        if detector is None:
+            detector = health.detectors[signal] = EwmaDetector(self.alpha, self.threshold, self.warmup,
+                                                               self.floors[signal])
+
+        for timestamp, value in data_points:
+            value = signal_value(value)
+            if value is None:
+                continue
+
+            if signal == 'disk_fill_rate':
+                last, health.last_disk = health.last_disk, (timestamp, value)
+                if last is None or timestamp <= last[0]:
+                    continue
+                value = (value - last[1]) / ((timestamp - last[0]) / 1000.0)
+            elif signal == 'load':
+                if health.cores is None:
+                    continue
+                value /= health.cores
+            elif signal == 'memory':
+                if health.memory is None:
+                    continue
+                value = value * 100.0 / health.memory
+
+            score = detector.update(value)
+            anomalous = score is not None and score > self.threshold and value >= self.levels[signal]
+            health.hot[signal] = health.hot.get(signal, 0) + 1 if anomalous else 0
+            self.evaluate(compute_path, health)
+
+    def evaluate(self, compute_path, health):
+        if not health.degraded and any(hot >= self.persistence for hot in health.hot.itervalues()):
+            health.degraded = True
+            health.calm = 0
+        elif health.degraded:
+            health.calm = 0 if any(health.hot.itervalues()) else health.calm + 1
+            if health.calm >= self.persistence:
+                health.degraded = False
+        else:
+            return
+
+        self.changes[compute_path] = health.degraded
+
+    @defer.inlineCallbacks
+    def flush(self):
+        unloaded = [path for path, health in self.health.iteritems() if not health.loaded]
+        if not self.changes and not unloaded:
+            return
+
+        changes, self.changes = self.changes, {}
+        capacities, missing = yield self._write(changes, unloaded)
+        for path, (cores, memory) in capacities.iteritems():
+            self.set_capacity(path, cores, memory)
+        for path in missing:
+            self.health.pop(path, None)
+
+    @db.transact
+    def _write(self, changes, unloaded):
+        capacities = {}
+        missing = []
+        for path in unloaded:
+            compute = traverse1(path)
+            if compute is None:
+                missing.append(path)
+            else:
+                capacities[path] = (compute.num_cores, compute.memory)
+
+        for path, degraded in changes.iteritems():
+            compute = traverse1(path)
+            if compute is None:
+                missing.append(path)
+                continue
+
+            if compute.degraded != degraded:
+                compute.degraded = degraded
+                log.msg('%s is %s' % (compute, 'degraded' if degraded else 'no longer degraded'),
+                        system='anomaly', logLevel=logging.WARNING if degraded else logging.INFO)
+                handle(compute, ModelModifiedEvent({'degraded': not degraded}, {'degraded': degraded}))
+        return capacities, missing
+
+
+def signal_options(config, suffix):
+    """Reads the `<signal>_<suffix>` options of the anomaly section that are set"""
+    options = {}
+    for signal in LEVELS:
+        value = config.getstring('anomaly', '%s_%s' % (signal, suffix), '')
+        if value:
+            options[signal] = float(value)
+    return options
+
+
+_detector = None
+
+
+def get_anomaly_detector():
+    global _detector
+    if _detector is None:
+        config = get_config()
+        _detector = AnomalyDetector(float(config.getstring('anomaly', 'alpha', '0.05')),
+                                    float(config.getstring('anomaly', 'threshold', '4')),
+                                    config.getint('anomaly', 'persistence'),
+                                    config.getint('anomaly', 'warmup'),
+                                    signal_options(config, 'level'),
+                                    signal_options(config, 'floor'))
+    return _detector
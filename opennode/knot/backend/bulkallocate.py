@@ -0,0 +1,160 @@
+from twisted.internet import defer
+from twisted.python import log
+
+from opennode.knot.backend.compute import BulkDeployAction, find_compute_v12n_container
+from opennode.knot.backend.compute import get_current_ctid, is_deployed
+from opennode.knot.backend.placement import get_overcommit, get_placement_table, vm_demand
+from opennode.knot.model.compute import IUndeployed
+from opennode.oms.config import get_config
+from opennode.oms.endpoint.ssh.detached import DetachedProtocol
+from opennode.oms.model.traversal import canonical_path, traverse1
+from opennode.oms.zodb import db
+
+
+# uuids of the computes created for a bulk allocation, which must not be allocated one by one on creation
+bulk_created = set()
+
+
+def decreasing(demands):
+    """Orders (vm, backend, demand) tuples by decreasing size"""
+    return sorted(demands, key=lambda (vm, backend, demand): (demand.memory, demand.disk, demand.cores),
+                  reverse=True)
+
+
+def pack(table, demands, overcommit):
+    """Places the VMs in order of decreasing size, each with the strategy of the table.
+
+    Either all the VMs are placed, and a {vm: HostCapacity} dict is returned with an empty list, or none
+    is: their reservations are released and an empty dict is returned with the VMs that did not fit.
+
+    """
+    placement = {}
+    unplaced = []
+    for vm, backend, demand in decreasing(demands):
+        capacity = table.place(vm, backend, demand, overcommit)
+        if capacity is None:
+            unplaced.append(vm)
+        else:
+            placement[vm] = capacity
+
+    if unplaced:
+        for vm in placement:
+            table.release(vm)
+        return {}, unplaced
+    return placement, []
+
+
+def assign_ctids(vms, last_ctid):
+    """Assigns consecutive OpenVZ CTIDs after `last_ctid` to the VMs, in order. Returns {vm: ctid}"""
+    return dict((vm, last_ctid + i) for i, vm in enumerate(vms, 1))
+
+
+class BulkAllocation(object):
+    """Allocates a batch of undeployed VMs of the hangar.
+
+    The whole batch is placed in one pass, reserving the capacity of all the VMs or of none, then each VM
+    is deployed on the container it was placed on, in parallel with at most `max_per_host` deployments
+    running on each hypervisor. The OpenVZ VMs of the batch get their CTIDs assigned up front, as
+    concurrent deployments would otherwise be hinted the same one.
+
+    """
+
+    def __init__(self, paths, max_per_host=None, table=None):
+        self.paths = paths
+        self.max_per_host = max_per_host or get_config().getint('allocate', 'bulk_max_per_host')
+        self.table = table or get_placement_table()
+        self.vms = {}
+        self.backends = {}
+        self.placement = {}
+        self.unplaced = []
+        self.results = {}
+
+    @db.ro_transact
+    def get_demands(self):
+        """Returns the {vm uuid: path} of the undeployed VMs of the batch, their (vm uuid, backend, demand)
+        and the paths that are not undeployed VMs"""
+        vms = {}
+        demands = []
+        invalid = []
+        for path in self.paths:
+            vm = traverse1(path)
+            if vm is None or not IUndeployed.providedBy(vm):
+                invalid.append(path)
+                continue
+            vms[vm.__name__] = path
+            demands.append((vm.__name__, vm.__parent__.backend, vm_demand(vm)))
+        return vms, demands, invalid
+
+    @defer.inlineCallbacks
+    def place(self):
+        """Places the batch, returns whether every VM was placed"""
+        self.vms, demands, self.unplaced = yield self.get_demands()
+        self.backends = dict((vm, backend) for vm, backend, demand in demands)
+        if self.unplaced:
+            defer.returnValue(False)
+
+        yield self.table.refresh()
+        self.placement, unplaced = pack(self.table, demands, get_overcommit())
+        self.unplaced = [self.vms[vm] for vm in unplaced]
+
+        if self.unplaced:
+            log.msg('Bulk allocation of %s VMs does not fit: %s' % (len(demands), self.unplaced),
+                    system='bulk-allocate')
+        else:
+            log.msg('Bulk allocation of %s VMs placed on %s hosts' %
+                    (len(demands), len(set(c.host for c in self.placement.itervalues()))),
+                    system='bulk-allocate')
+        defer.returnValue(not self.unplaced)
+
+    def last_ctid(self):
+        return get_current_ctid()
+
+    @defer.inlineCallbacks
+    def deploy(self):
+        """Deploys the placed VMs. Returns a deferred fired with the {path: deployed} results"""
+        vms = sorted(self.placement, key=self.vms.get)
+        openvz = [vm for vm in vms if self.backends.get(vm) == u'openvz']
+        ctids = assign_ctids(openvz, (yield self.last_ctid())) if openvz else {}
+
+        semaphores = {}
+        deferreds = []
+        for vm in vms:
+            host = self.placement[vm].host
+            semaphore = semaphores.get(host)
+            if semaphore is None:
+                semaphore = semaphores[host] = defer.DeferredSemaphore(self.max_per_host)
+            deferreds.append(semaphore.run(self.allocate, vm, ctids.get(vm)))
+
+        yield defer.DeferredList(deferreds, consumeErrors=True)
+        defer.returnValue(self.results)
+
+    @db.ro_transact
+    def get_target(self, vm):
+        """Returns the VM, the virtualization container of the host it was placed on, and the paths of
+        the host and of the container"""
+        compute = traverse1(self.vms[vm])
+        if compute is None:
+            raise KeyError(self.vms[vm])
+        host = db.get_root()['oms_root']['machines'][self.placement[vm].host]
+        container = find_compute_v12n_container(host, compute.__parent__.backend)
+        if container is None:
+            raise KeyError('%s has no %s container' % (host, compute.__parent__.backend))
+        return compute, container, (canonical_path(host), canonical_path(container))
+
+    @defer.inlineCallbacks
+    def allocate(self, vm, ctid=None):
+        path = self.vms[vm]
+        try:
+            compute, container, keys = yield self.get_target(vm)
+            action = BulkDeployAction(compute)
+            action.ctid = ctid
+            yield action.wait_for(keys)
+            # the reservation made by the placement is kept until the table sees the VM on its host
+            yield action.execute(DetachedProtocol(), container)
+            self.results[path] = yield is_deployed(vm)
+        except Exception:
+            log.err(system='bulk-allocate')
+            self.results[path] = False
+
+        if not self.results[path]:
+            self.table.release(vm)
@@ -0,0 +1,60 @@
+import time
+
+from twisted.python import log
+
+from opennode.knot.backend.operation import OperationRemoteError
+from opennode.oms.config import get_config
+
+
+def is_unsupported_error(e):
+    """Tells whether the error means the agent lacks the called module/function"""
+    if not isinstance(e, OperationRemoteError):
+        return False
+    msg = str(e)
+    return 'is not available' in msg or 'unavailable' in msg
+
+
+class AgentCapabilities(object):
+    """Remembers the optional agent calls a host does not support, so that callers can fall back to
+    the basic calls without paying a failing round-trip on every sync.
+
+    Hosts are probed again after `[sync] capabilities_ttl` seconds, as agents may get upgraded. Calls
+    that succeeded are remembered too, so that callers can rely on them without a fallback.
+
+    """
+
+    def __init__(self):
+        self._unsupported = {}
+        self._supported = set()
+
+    def supported(self, host, capability):
+        timestamp = self._unsupported.get((host, capability))
+        if timestamp is None:
+            return True
+
+        if timestamp + get_config().getint('sync', 'capabilities_ttl') < time.time():
+            del self._unsupported[(host, capability)]
+            return True
+
+        return False
+
+    def known_supported(self, host, capability):
+        """Tells whether the capability already worked on the host, rather than just not failed yet"""
+        return (host, capability) in self._supported
+
+    def mark_supported(self, host, capability):
+        self._supported.add((host, capability))
+
+    def mark_unsupported(self, host, capability):
+        log.msg('Agent on %s does not support %s, falling back' % (host, capability), system='capabilities')
+        self._unsupported[(host, capability)] = time.time()
+        self._supported.discard((host, capability))
+
+    def forget(self, host):
+        for key in self._unsupported.keys():
+            if key[0] == host:
+                del self._unsupported[key]
+        self._supported = set(key for key in self._supported if key[0] != host)
+
+
+capabilities = AgentCapabilities()
@@ -25,13 +25,15 @@ from opennode.knot.backend.operation import IStartVM
 from opennode.knot.backend.operation import ISuspendVM
 from opennode.knot.backend.operation import IUndeployVM
 from opennode.knot.backend.operation import OperationRemoteError
+from opennode.knot.backend.placement import get_overcommit, get_placement_table, vm_demand
+from opennode.knot.backend.syncschedule import get_sync_schedule
 from opennode.knot.backend.v12ncontainer import IVirtualizationContainerSubmitter
 from opennode.knot.model.common import IPreDeployHook
 from opennode.knot.model.common import IPostUndeployHook
 from opennode.knot.model.compute import ICompute, Compute, IVirtualCompute
 from opennode.knot.model.compute import IUndeployed, IDeployed, IDeploying
 from opennode.knot.model.compute import IManageable
-from opennode.knot.model.template import ITemplate
+from opennode.knot.model.computes import index_compute, query_computes
 from opennode.knot.model.user import IUserStatisticsProvider
 from opennode.knot.model.virtualizationcontainer import IVirtualizationContainer
 from opennode.knot.utils import mac_addr_kvm_generator
@@ -79,6 +81,7 @@ def register_machine(host, mgt_stack=IManageable):
         machine = Compute(unicode(host), u'active', mgt_stack=mgt_stack)
         machine.__name__ = str(uuid5(NAMESPACE_DNS, host))
         machines.add(machine)
+        index_compute(machine)
         return machine.__name__
 
     if not (yield check()):
@@ -301,6 +304,19 @@ class VComputeAction(ComputeAction):
                 canonical_path(self.context.__parent__),
                 canonical_path(self.context.__parent__.__parent__)]
 
+    @defer.inlineCallbacks
+    def handle_action_done(self, r, cmd):
+        @db.ro_transact
+        def get_host_name():
+            host = self.context.__parent__.__parent__
+            return host.__name__ if ICompute.providedBy(host) else None
+
+        # the hypervisor state changed: sync it soon rather than at its backed off interval
+        host_name = yield get_host_name()
+        if host_name is not None:
+            get_sync_schedule().expedite(host_name)
+        yield super(VComputeAction, self).handle_action_done(r, cmd)
+
     @db.transact
     def set_inprogress(self):
         if self.inprogress_marker is not None:
@@ -350,6 +366,16 @@ class DiskspaceInvalidConfigError(KeyError):
         KeyError.__init__(self, msg)
 
 
+@db.ro_transact
+def is_deployed(name):
+    """Whether the compute with the uuid `name` is deployed"""
+    try:
+        compute = follow_symlinks(db.get_root()['oms_root']['computes'][name])
+    except KeyError:
+        return False
+    return compute is not None and IDeployed.providedBy(compute)
+
+
 class AllocateAction(ComputeAction):
     context(IUndeployed)
     action('allocate')
@@ -368,88 +394,57 @@ class AllocateAction(ComputeAction):
             log.msg('Attempt to allocate a deployed compute: %s' % (self.context), system='deploy')
             return
 
-        @db.ro_transact
-        def get_matching_machines(container):
-            all_machines = db.get_root()['oms_root']['machines']
-            param = unicode(get_config().getstring('allocate', 'diskspace_filter_param',
-                                                   default=u'/storage'))
-
-            def condition_generator(m):
-                yield ICompute.providedBy(m)
-                yield find_compute_v12n_container(m, container)
-                yield not getattr(m, 'exclude_from_allocation', None)
-                if not get_config().getboolean('overcommit', 'memory', False):
-                    yield self.context.memory_usage < m.memory
-                else:
-                    log.msg('Memory filtering is disabled.', system='action-allocate')
-                if not get_config().getboolean('overcommit', 'disk', False):
-                    yield sum(map(lambda (pk, pv): pv,
-                              filter(lambda (pk, pv): pk != 'total',
-                                     self.context.diskspace.iteritems()))) < (m.diskspace.get(param, 0) -
-                                                                              m.diskspace_usage.get(param, 0))
-                else:
-                    log.msg('Diskspace filtering is disabled.', system='action-allocate')
-                if not get_config().getboolean('overcommit', 'cores', False):
-                    yield self.context.num_cores <= m.num_cores
-                else:
-                    log.msg('\'Total # of cores\' filtering is disabled.', system='action-allocate')
-
-                templates = m['vms-%s' % container]['templates']
-                yield self.context.template in map(lambda t: t.name,
-                                                   filter(lambda t: ITemplate.providedBy(t),
-                                                          templates.listcontent() if templates else []))
-
-            def unwind_until_false(generator):
-                fail_description = ['Not a compute',
-                                    'No virt container %s' % container,
-                                    'Excluded from allocation',
-                                    'Has less than %s MB memory' % self.context.memory_usage,
-                                    'Not enough diskspace',
-                                    'Not enough CPU cores',
-                                    'Template is unavailable']
-
-                try:
-                    for idx, r in enumerate(generator):
-                        if not r:
-                            return 'Fail at %d: %s' % (idx, fail_description[idx])
-                    return 'Match'
-                except Exception as e:
-                    log.err(system='action-allocate')
-                    return 'Fail (exception)' % (fail_description, e)
-
-            results = map(lambda m: (str(m), unwind_until_false(condition_generator(m))), all_machines)
-            log.msg('Searching in: %s' % (results), logLevel=DEBUG, system='action-allocate')
-
-            return filter(lambda m: all(condition_generator(m)), all_machines)
-
         log.msg('Allocating %s: searching for targets...' % self.context, system='action-allocate')
 
-        vmsbackend = yield db.ro_transact(lambda: self.context.__parent__.backend)()
-        machines = yield get_matching_machines(vmsbackend)
-
-        if len(machines) <= 0:
+        @db.ro_transact
+        def get_demand():
+            return self.context.__name__, self.context.__parent__.backend, vm_demand(self.context)
+
+        name, vmsbackend, demand = yield get_demand()
+        overcommit = get_overcommit()
+        for resource, enabled in overcommit.iteritems():
+            if enabled:
+                log.msg('%s filtering is disabled.' % resource.capitalize(), system='action-allocate')
+
+        table = get_placement_table()
+        yield table.refresh()
+        # VMs of a bulk allocation were placed beforehand
+        capacity = table.reserved(name) or table.place(name, vmsbackend, demand, overcommit)
+
+        if capacity is None:
+            log.msg('Searching in: %s' % table.explain(vmsbackend, demand, overcommit), logLevel=DEBUG,
+                    system='action-allocate')
             self._action_log(cmd, 'Found no fitting machines. Action aborted.', system='action-allocate',
                              logLevel=WARNING)
             return
 
+        log.msg('Found %s as the best candidate. Attempting to allocate...' % capacity.hostname,
+                system='action-allocate')
+
         @db.ro_transact
-        def rank(machines):
-            return sorted(machines, key=lambda m: m.__name__)
+        def get_target():
+            best = db.get_root()['oms_root']['machines'][capacity.host]
+            return best, find_compute_v12n_container(best, vmsbackend)
 
-        best = (yield rank(machines))[0]
-        log.msg('Found %s as the best candidate. Attempting to allocate...' % (best),
-                system='action-allocate')
+        try:
+            best, bestvmscontainer = yield get_target()
 
-        bestvmscontainer = yield db.ro_transact(find_compute_v12n_container)(best, vmsbackend)
+            @db.transact
+            def set_additional_keys():
+                self._additional_keys = [canonical_path(best), canonical_path(bestvmscontainer)]
+            yield set_additional_keys()
 
-        @db.transact
-        def set_additional_keys():
-            self._additional_keys = [canonical_path(best), canonical_path(bestvmscontainer)]
-        yield set_additional_keys()
+            yield self.reacquire_until_clear()
 
-        yield self.reacquire_until_clear()
+            yield DeployAction(self.context)._execute(DetachedProtocol(), bestvmscontainer)
+        except Exception:
+            table.release(name)
+            raise
 
-        yield DeployAction(self.context)._execute(DetachedProtocol(), bestvmscontainer)
+        # a deployment can also fail without an error, e.g. when the post-deploy check does not pass;
+        # deployed VMs keep their reservation until the table sees them on their host
+        if not (yield is_deployed(name)):
+            table.release(name)
 
 
 def mv_compute_model(context_path, target_path):
@@ -575,6 +570,7 @@ class DeployAction(VComputeAction):
 
                 container = c.__parent__
                 del container[name]
+                index_compute(new_compute)
 
                 timestamp = int(time.time() * 1000)
                 IStream(new_compute).add((timestamp, {'event': 'change',
@@ -621,6 +617,50 @@ class DeployAction(VComputeAction):
         defer.returnValue(True)
 
 
+class BulkDeployAction(DeployAction):
+    """Deploys a VM of a bulk allocation on the container it was placed on.
+
+    Only the VM is locked: the deployments of a batch share their hypervisor, the batch bounds how many
+    run on each one. Other actions locking the hypervisor or its container are still waited for. The VM
+    is deployed with the CTID assigned by the batch, if any.
+
+    """
+    baseclass()
+
+    ctid = None
+
+    @property
+    def lock_keys(self):
+        return (canonical_path(self.context),)
+
+    @defer.inlineCallbacks
+    def wait_for(self, keys):
+        """Waits until no action holds a lock on `keys`"""
+        while True:
+            holders = [self._lock_registry[key][0] for key in keys if key in self._lock_registry]
+            if not holders:
+                break
+            yield when_fired(holders[0])
+
+    @defer.inlineCallbacks
+    def get_parameters(self):
+        parameters = yield super(BulkDeployAction, self).get_parameters()
+        if self.ctid is not None:
+            parameters['ctid'] = self.ctid
+        defer.returnValue(parameters)
+
+
+def when_fired(d):
+    """Returns a deferred fired with None when `d` fires, leaving the result of `d` untouched"""
+    waiter = defer.Deferred()
+
+    def fire(r):
+        waiter.callback(None)
+        return r
+    d.addBoth(fire)
+    return waiter
+
+
 class PreDeployHookKVM(GlobalUtility):
     implements(IPreDeployHook)
     name('pre-deploy-kvm')
@@ -684,6 +724,12 @@ class PreDeployHookOpenVZ(GlobalUtility):
         cmd = args[0]
         vm_parameters = args[1]
 
+        if vm_parameters.get('ctid') is not None:
+            log.msg('Deploying %s to %s: using assigned CTID (%s)' % (context, context.__parent__,
+                                                                     vm_parameters['ctid']),
+                    system='deploy-hook-openvz')
+            return
+
         ctid = yield get_current_ctid()
 
         if ctid is not None:
@@ -727,8 +773,11 @@ class UndeployAction(VComputeAction):
             if vm is not None:
                 noLongerProvides(vm, IDeployed)
                 alsoProvides(vm, IUndeployed)
+                return vm.__parent__.__parent__.__name__, vm.__parent__.backend, vm_demand(vm)
 
-        yield finalize_vm()
+        freed = yield finalize_vm()
+        if freed is not None:
+            get_placement_table().undeployed(*freed)
 
         vm_parameters = yield self.get_parameters()
 
@@ -886,6 +935,7 @@ class MigrateAction(VComputeAction):
                         vm_compute.suspicious = destination_compute.suspicious
                         dvms = follow_symlinks(destination_compute['vms'])
                         dvms.add(vm_compute)
+                        index_compute(vm_compute)
                         log.msg('Model moved.', system='migrate')
                     except IndexError:
                         log.msg('Model NOT moved: destination compute or vms do not exist', system='migrate')
@@ -975,14 +1025,7 @@ class StopAllVmsCmd(Cmd):
 
     @db.ro_transact
     def get_computes(self, args):
-        computes = db.get_root()['oms_root']['computes']
-        user_vms = []
-        for c in map(follow_symlinks, computes.listcontent()):
-            if not IVirtualCompute.providedBy(c):
-                continue
-            if c.__owner__ == args.u:
-                user_vms.append(c)
-        return user_vms
+        return filter(IVirtualCompute.providedBy, query_computes(owner=args.u))
 
     @require_admins_only
     @defer.inlineCallbacks
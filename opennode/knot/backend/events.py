@@ -9,6 +9,7 @@ from zope.component import getUtility
 import netaddr
 import transaction
 
+from opennode.knot.backend.bulkallocate import bulk_created
 from opennode.knot.backend.compute import DeployAction, UndeployAction, DestroyComputeAction, AllocateAction
 from opennode.knot.backend.operation import IUpdateVM
 from opennode.knot.backend.operation import ISetOwner
@@ -129,6 +130,10 @@ def allocate_virtual_compute_from_hangar(model, event):
     if IDeployed.providedBy(model):
         return
 
+    # VMs created for a bulk allocation are placed and deployed together
+    if model.__name__ in bulk_created:
+        return
+
     auto_allocate = get_config().getboolean('vms', 'auto_allocate', True)
 
     if not auto_allocate:
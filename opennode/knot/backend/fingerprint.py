@@ -0,0 +1,77 @@
+import hashlib
+import json
+import time
+
+from opennode.knot.model.catalog import catalog_compute
+from opennode.knot.model.compute import ICompute
+from opennode.oms.config import get_config
+
+
+# attributes changing on every call, which must not invalidate a digest on their own
+VOLATILE_KEYS = ('uptime',)
+
+
+def _strip_volatile(payload):
+    if type(payload) is dict:
+        return dict((k, _strip_volatile(v)) for k, v in payload.iteritems() if k not in VOLATILE_KEYS)
+    if type(payload) in (list, tuple):
+        return [_strip_volatile(i) for i in payload]
+    return payload
+
+
+def payload_digest(payload):
+    """Returns a stable digest of a JSON-serializable agent payload, ignoring volatile keys"""
+    return hashlib.sha1(json.dumps(_strip_volatile(payload), sort_keys=True, default=str)).hexdigest()
+
+
+def incremental_sync_enabled():
+    return get_config().getboolean('sync', 'incremental', True)
+
+
+def update_changed(obj, values):
+    """Sets only the attributes whose value differs from the current one, keeping the catalog of computes
+    up to date. Returns the number of attributes written"""
+    changed = 0
+    for name, value in values.iteritems():
+        if getattr(obj, name, None) != value:
+            setattr(obj, name, value)
+            changed += 1
+    if changed and ICompute.providedBy(obj):
+        catalog_compute(obj)
+    return changed
+
+
+class SyncFingerprints(object):
+    """Digests of the last agent payload successfully applied to the DB, per host and sync section
+    (hardware, interfaces, vm list, templates).
+
+    Digests expire after `[sync] fingerprint_ttl` seconds so that volatile attributes (e.g. uptime) and
+    local modifications not reflected by the agent payload are periodically rewritten.
+
+    """
+
+    def __init__(self):
+        self._digests = {}
+
+    def unchanged(self, host, section, digest):
+        if not incremental_sync_enabled():
+            return False
+
+        entry = self._digests.get((host, section))
+        if entry is None:
+            return False
+
+        last_digest, timestamp = entry
+        ttl = get_config().getint('sync', 'fingerprint_ttl')
+        return last_digest == digest and timestamp + ttl > time.time()
+
+    def update(self, host, section, digest):
+        self._digests[(host, section)] = (digest, time.time())
+
+    def forget(self, host, section=None):
+        for key in self._digests.keys():
+            if key[0] == host and (section is None or key[1] == section):
+                del self._digests[key]
+
+
+fingerprints = SyncFingerprints()
@@ -0,0 +1,133 @@
+import logging
+import time
+
+from grokcore.component import subscribe
+from twisted.internet import defer
+from twisted.python import log
+from zope.component import queryAdapter
+
+from opennode.knot.backend.metricstore import metric_store_enabled, serve_from_store
+from opennode.knot.model.compute import ICompute
+from opennode.oms.model.model.events import IModelDeletedEvent
+from opennode.oms.model.model.stream import IStream, Metrics
+from opennode.oms.model.traversal import traverse1
+from opennode.oms.zodb import db
+
+
+class MetricsIngestor(object):
+    """Collects the data points gathered during a metrics cycle and writes them in one batch.
+
+    Points are queued by the canonical path of the metric they belong to. On flush, paths not seen before
+    are resolved to their streams in a single read-only transaction; resolved streams are cached, so a
+    steady state cycle does not touch the DB at all. Streams offering `add_many` receive all their points
+    with a single call. Observers are called with the path and the points of each resolved metric.
+
+    """
+
+    # seconds after which paths that could not be resolved are looked up again
+    negative_ttl = 60
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.pending = []
+        self._streams = {}
+        self._missing = {}
+        self.observers = []
+        self.stats = {'points': 0, 'batches': 0, 'dropped': 0,
+                      'points_per_sec': 0.0, 'batch_latency': 0.0, 'max_batch_latency': 0.0}
+        self._last_flush = None
+
+    def add(self, path, data_point):
+        self.pending.append((path, data_point))
+
+    def add_many(self, points):
+        self.pending.extend(points)
+
+    def invalidate(self, name):
+        """Drops the cached streams below the object named `name` (e.g. a deleted compute)"""
+        for path in self._streams.keys():
+            if name in path.split('/'):
+                del self._streams[path]
+
+    @db.ro_transact
+    def _resolve(self, paths):
+        use_store = metric_store_enabled()
+        streams = {}
+        for path in paths:
+            obj = traverse1(path)
+            if obj is None:
+                streams[path] = None
+            elif use_store:
+                if isinstance(obj.__parent__, Metrics):
+                    serve_from_store(obj)
+                streams[path] = queryAdapter(obj, IStream, name='metrics') or IStream(obj)
+            else:
+                streams[path] = IStream(obj)
+        return streams
+
+    @defer.inlineCallbacks
+    def flush(self):
+        if not self.pending:
+            return
+
+        start = self.clock()
+        pending, self.pending = self.pending, []
+
+        now = self.clock()
+        unknown = set(path for path, data_point in pending
+                      if path not in self._streams and self._missing.get(path, 0) < now)
+        if unknown:
+            for path, stream in (yield self._resolve(unknown)).iteritems():
+                if stream is None:
+                    self._missing[path] = now + self.negative_ttl
+                else:
+                    self._missing.pop(path, None)
+                    self._streams[path] = stream
+
+        by_stream = {}
+        dropped = 0
+        for path, data_point in pending:
+            stream = self._streams.get(path)
+            if stream is None:
+                dropped += 1
+                continue
+            by_stream.setdefault(path, (stream, []))[1].append(data_point)
+
+        for path, (stream, data_points) in by_stream.iteritems():
+            try:
+                if hasattr(stream, 'add_many'):
+                    stream.add_many(data_points)
+                else:
+                    for data_point in data_points:
+                        stream.add(data_point)
+                for observer in self.observers:
+                    observer(path, data_points)
+            except Exception:
+                log.err(system='metrics-ingest')
+
+        self._update_stats(len(pending) - dropped, dropped, start)
+
+    def _update_stats(self, written, dropped, start):
+        now = self.clock()
+        latency = now - start
+        self.stats['points'] += written
+        self.stats['dropped'] += dropped
+        self.stats['batches'] += 1
+        self.stats['batch_latency'] = latency
+        self.stats['max_batch_latency'] = max(self.stats['max_batch_latency'], latency)
+
+        if self._last_flush is not None and now > self._last_flush:
+            self.stats['points_per_sec'] = written / (now - self._last_flush)
+        self._last_flush = now
+
+        log.msg('Ingested %s points (%s dropped) in %.3fs, %.1f points/s' %
+                (written, dropped, latency, self.stats['points_per_sec']),
+                system='metrics-ingest', logLevel=logging.DEBUG)
+
+
+ingestor = MetricsIngestor()
+
+
+@subscribe(ICompute, IModelDeletedEvent)
+def invalidate_deleted_compute_streams(model, event):
+    ingestor.invalidate(model.__name__)
@@ -1,27 +1,64 @@
 import logging
-import datetime
 import time
 
 from grokcore.component import Adapter, context
 from twisted.internet import defer
 from twisted.python import log
+from zope import schema
 from zope.component import provideSubscriptionAdapter, queryAdapter
 from zope.interface import implements, Interface
 
-from opennode.knot.backend.operation import IGetGuestMetrics, IGetHostMetrics, OperationRemoteError
+from opennode.knot.backend.anomaly import get_anomaly_detector
+from opennode.knot.backend.capabilities import capabilities, is_unsupported_error
+from opennode.knot.backend.ingest import ingestor
+from opennode.knot.backend.metricsdelta import snapshots
+from opennode.knot.backend.metricstore import get_store, metric_store_enabled
+from opennode.knot.backend.metricspush import push_registry
+from opennode.knot.backend.operation import IGetGuestMetrics, IGetGuestMetricsDelta, IGetHostMetrics
+from opennode.knot.backend.operation import OperationRemoteError
+from opennode.knot.backend.scheduler import BoundedScheduler, JobTimeoutError
+from opennode.knot.backend.usage import get_usage_updater
 from opennode.knot.backend.v12ncontainer import IVirtualizationContainerSubmitter
-from opennode.knot.model.compute import IManageable, ICompute, IVirtualCompute
+from opennode.knot.model.compute import IManageable, IVirtualCompute
+from opennode.knot.model.computes import query_computes
 from opennode.oms.config import get_config
+from opennode.oms.model.model.base import ContainerInjector, ReadonlyContainer
 from opennode.oms.model.model.proc import IProcess, Proc, DaemonProcess
 from opennode.oms.model.model.symlink import follow_symlinks
-from opennode.oms.model.model.stream import IStream
+from opennode.oms.model.traversal import canonical_path
 from opennode.oms.util import subscription_factory, async_sleep
 from opennode.oms.zodb import db
 
 
 class IMetricsGatherer(Interface):
-    def gather():
-        """Gathers metrics for some object"""
+    def prepare():
+        """Reads what the gatherer needs from the DB; called within the transaction of the cycle"""
+
+    def gather(killhook=None):
+        """Gathers metrics for some object, queueing the data points to the metrics ingestor.
+        Firing `killhook` aborts the remote calls in progress"""
+
+
+class GatherStats(object):
+    """Per-host counters of the metrics gathers: completed, completed later than the gathering interval,
+    killed at the deadline, skipped because the previous gather was still running, and failed"""
+
+    counters = ('gathered', 'late', 'killed', 'skipped', 'failed')
+
+    def __init__(self):
+        self.hosts = {}
+
+    def get(self, hostname):
+        stats = self.hosts.get(hostname)
+        if stats is None:
+            stats = self.hosts[hostname] = dict((counter, 0) for counter in self.counters)
+        return stats
+
+    def count(self, hostname, counter):
+        self.get(hostname)[counter] += 1
+
+
+host_stats = GatherStats()
 
 
 class MetricsDaemonProcess(DaemonProcess):
@@ -31,8 +68,25 @@ class MetricsDaemonProcess(DaemonProcess):
 
     def __init__(self):
         super(MetricsDaemonProcess, self).__init__()
-        self.interval = get_config().getint('metrics', 'interval')
-        self.outstanding_requests = {}
+        config = get_config()
+        self.interval = config.getint('metrics', 'interval')
+        # gathers still running after `deadline` intervals are killed
+        self.deadline = self.interval * config.getint('metrics', 'deadline')
+        self.scheduler = BoundedScheduler(config.getint('metrics', 'max_concurrency'),
+                                          timeout=self.deadline, name='metrics')
+        self.host_stats = host_stats
+        self.gc_interval = config.getint('metrics', 'gc_interval')
+        self.last_gc = time.time()
+        self.gc_running = False
+        self.ingestor = ingestor
+        self.usage_updater = None
+        if config.getint('metrics', 'usage_interval'):
+            self.usage_updater = get_usage_updater()
+            self.ingestor.observers.append(self.usage_updater.observe)
+        self.anomaly_detector = None
+        if config.getboolean('anomaly', 'enabled', False):
+            self.anomaly_detector = get_anomaly_detector()
+            self.ingestor.observers.append(self.anomaly_detector.observe)
 
     @defer.inlineCallbacks
     def run(self):
@@ -43,6 +97,13 @@ class MetricsDaemonProcess(DaemonProcess):
                 # and maintain the gatherers via add/remove events.
                 if not self.paused:
                     yield self.gather_machines()
+                yield self.ingestor.flush()
+                if self.usage_updater is not None:
+                    yield self.usage_updater.flush()
+                if self.anomaly_detector is not None:
+                    yield self.anomaly_detector.flush()
+                if metric_store_enabled():
+                    self.collect_garbage()
             except Exception:
                 self.log_err()
 
@@ -54,99 +115,187 @@ class MetricsDaemonProcess(DaemonProcess):
     def log_err(self, msg=None, **kwargs):
         log.err(msg, system='metrics', **kwargs)
 
+    def collect_garbage(self):
+        store = get_store()
+        store.enforce_budget()
+        if self.gc_interval and not self.gc_running and time.time() - self.last_gc >= self.gc_interval:
+            self.last_gc = time.time()
+            self.gc_running = True
+            d = store.cooperative_gc()
+            d.addCallback(self.log_gc)
+            d.addErrback(self.log_err)
+            d.addBoth(lambda r: setattr(self, 'gc_running', False))
+
+    def log_gc(self, report):
+        self.log_msg('Metrics store gc: %(expired_points)s points expired, %(merged_files)s files '
+                     'merged, %(removed_series)s series removed, %(reclaimed_bytes)s bytes reclaimed'
+                     % report, logLevel=logging.DEBUG)
+
     @defer.inlineCallbacks
     def gather_machines(self):
         @db.ro_transact
         def get_gatherers():
-            oms_root = db.get_root()['oms_root']
-            computes = filter(lambda c: c and ICompute.providedBy(c) and not c.failure,
-                         map(follow_symlinks, oms_root['computes'].listcontent()))
+            computes = query_computes(failure=False)
+            # hosts streaming their metrics to the push receiver are not polled
+            computes = [c for c in computes if not push_registry.is_pushing(c.__name__)]
             gatherers = filter(None, (queryAdapter(c, IMetricsGatherer) for c in computes))
+            for g in gatherers:
+                g.prepare()
             return gatherers
 
-        def handle_success(r, c):
-            self.log_msg('%s: metrics gathered' % (c), logLevel=logging.DEBUG)
-            if str(c) in self.outstanding_requests:
-                del self.outstanding_requests[str(c)]
+        def gather(killhook, g):
+            return g.gather(killhook)
+
+        def handle_success(r, g, started):
+            elapsed = time.time() - started
+            self.host_stats.count(g.hostname, 'gathered')
+            if elapsed > self.interval:
+                self.host_stats.count(g.hostname, 'late')
+                self.log_msg('%s: metrics gathered late, in %.1fs' % (g.hostname, elapsed))
+            else:
+                self.log_msg('%s: metrics gathered' % (g.hostname), logLevel=logging.DEBUG)
 
-        def handle_errors(e, c):
-            e.trap(Exception)
-            self.log_msg("%s: got exception when gathering metrics: %s" % (c, e),
+        def handle_errors(e, g):
+            if e.check(JobTimeoutError):
+                self.host_stats.count(g.hostname, 'killed')
+                self.log_msg('%s: gathering metrics killed after the %ss deadline' %
+                             (g.hostname, self.deadline), logLevel=logging.WARNING)
+                return
+
+            self.host_stats.count(g.hostname, 'failed')
+            self.log_msg("%s: got exception when gathering metrics: %s" % (g.hostname, e),
                          logLevel=logging.ERROR)
-            self.log_err()
-            if str(c) in self.outstanding_requests:
-                del self.outstanding_requests[str(c)]
+            self.log_err(e)
 
         for g in (yield get_gatherers()):
-            hostname = yield db.get(g.context, 'hostname')
-            targetkey = str(g.context)
-            if (targetkey not in self.outstanding_requests
-                or self.outstanding_requests[targetkey][2] > 5):
-
-                if (targetkey in self.outstanding_requests and
-                    self.outstanding_requests[targetkey][2] > 5):
-                    self.log_msg('Killing all previous requests to %s (%s)' % (hostname, targetkey))
-                    self.outstanding_requests[targetkey][3].kill()
-
-                self.log_msg('%s: gathering metrics %s' % (hostname,
-                                                           '(after timeout!)' if targetkey in
-                                                           self.outstanding_requests else ''),
-                                                           logLevel=logging.DEBUG)
-                d = g.gather()
-                curtime = datetime.datetime.now().isoformat()
-                self.outstanding_requests[targetkey] = [d, curtime, 0, g]
-                d.addCallback(handle_success, g.context)
-                d.addErrback(handle_errors, g.context)
-            else:
-                self.outstanding_requests[targetkey][2] += 1
-                self.log_msg('Skipping: another outstanding request to "%s" (%s) is found from %s.' %
-                             (g.context, hostname, self.outstanding_requests[targetkey][1]),
-                             logLevel=logging.DEBUG)
+            d = self.scheduler.submit(str(g.context), gather, g)
+            if d is None:
+                self.host_stats.count(g.hostname, 'skipped')
+                continue
+
+            self.log_msg('%s: gathering metrics' % (g.hostname), logLevel=logging.DEBUG)
+            d.addCallback(handle_success, g, time.time())
+            d.addErrback(handle_errors, g)
+
+        stats = self.scheduler.new_cycle()
+        if stats['skipped'] or stats['timed_out']:
+            self.log_msg('Gathering cycle: %(queued)s started, %(running)s running, %(skipped)s skipped, '
+                         '%(timed_out)s killed' % stats)
 
 
 provideSubscriptionAdapter(subscription_factory(MetricsDaemonProcess), adapts=(Proc,))
 
 
+class IGatheredHost(Interface):
+    hostname = schema.TextLine(title=u"Hostname", readonly=True)
+    gathered = schema.Int(title=u"Completed gathers", readonly=True)
+    late = schema.Int(title=u"Gathers completed after the gathering interval", readonly=True)
+    killed = schema.Int(title=u"Gathers killed at the deadline", readonly=True)
+    skipped = schema.Int(title=u"Gathers skipped, the previous one still running", readonly=True)
+    failed = schema.Int(title=u"Failed gathers", readonly=True)
+
+
+class GatheredHost(ReadonlyContainer):
+    implements(IGatheredHost)
+
+    def __init__(self, hostname, stats):
+        self.__name__ = hostname
+        self.hostname = hostname
+        for counter in GatherStats.counters:
+            setattr(self, counter, stats[counter])
+
+
+class GatheredHosts(ReadonlyContainer):
+    """Metrics gather counters of each host"""
+    __name__ = 'hosts'
+
+    @property
+    def _items(self):
+        return dict((hostname, GatheredHost(hostname, stats))
+                    for hostname, stats in host_stats.hosts.iteritems())
+
+
+class GatheredHostsInjector(ContainerInjector):
+    context(MetricsDaemonProcess)
+    __class__ = GatheredHosts
+
+
+class IIngestStats(Interface):
+    points = schema.Int(title=u"Points written", readonly=True)
+    dropped = schema.Int(title=u"Points dropped, their metric was not found", readonly=True)
+    batches = schema.Int(title=u"Batches written", readonly=True)
+    points_per_sec = schema.Float(title=u"Points per second, as of the last batch", readonly=True)
+    batch_latency = schema.Float(title=u"Latency of the last batch (s)", readonly=True)
+    max_batch_latency = schema.Float(title=u"Highest batch latency (s)", readonly=True)
+
+
+def ingest_stat(name):
+    return property(lambda self: ingestor.stats[name])
+
+
+class IngestStats(ReadonlyContainer):
+    """Throughput of the metrics ingestor"""
+    implements(IIngestStats)
+    __name__ = 'ingest'
+
+    points = ingest_stat('points')
+    dropped = ingest_stat('dropped')
+    batches = ingest_stat('batches')
+    points_per_sec = ingest_stat('points_per_sec')
+    batch_latency = ingest_stat('batch_latency')
+    max_batch_latency = ingest_stat('max_batch_latency')
+
+
+class IngestStatsInjector(ContainerInjector):
+    context(MetricsDaemonProcess)
+    __class__ = IngestStats
+
+
 class VirtualComputeMetricGatherer(Adapter):
     """Gathers VM metrics using IVirtualizationContainerSubmitter"""
 
     implements(IMetricsGatherer)
     context(IManageable)
 
+    @db.assert_transact
+    def prepare(self):
+        self.host = self.context.__name__
+        self.path = canonical_path(self.context)
+        self.hostname = self.context.hostname
+        self.state = self.context.state
+
+        vms = follow_symlinks(self.context['vms'])
+        if vms and any(IVirtualCompute.providedBy(vm) for vm in vms):
+            self.vms = vms
+            self.vms_path = canonical_path(vms)
+        else:
+            self.vms = self.vms_path = None
+            log.msg('%s: no VMs' % (self.hostname), system='metrics', logLevel=logging.DEBUG)
+
     @defer.inlineCallbacks
-    def gather(self):
-        self._killhook = defer.Deferred()
+    def gather(self, killhook=None):
+        self._killhook = killhook if killhook is not None else defer.Deferred()
         yield self.gather_vms()
-        yield self.gather_phy()
+        if not self._killhook.called:
+            yield self.gather_phy()
 
     def kill(self):
-        self._killhook.callback(None)
+        if not self._killhook.called:
+            self._killhook.callback(None)
 
     @defer.inlineCallbacks
     def gather_vms(self):
-
-        @db.ro_transact
-        def get_vms_if_not_empty():
-            vms = follow_symlinks(self.context['vms']) or []
-
-            for vm in vms:
-                if IVirtualCompute.providedBy(vm):
-                    return vms
-
-            log.msg('%s: no VMs' % (self.context.hostname), system='metrics', logLevel=logging.DEBUG)
-
-        vms = yield get_vms_if_not_empty()
+        vms = self.vms
 
         # get the metrics for all running VMS
-        if not vms or self.context.state != u'active':
+        if not vms or self.state != u'active':
             return
 
-        name = yield db.get(self.context, 'hostname')
+        name = self.hostname
 
         try:
             log.msg('%s: gather VM metrics' % (name), system='metrics', logLevel=logging.DEBUG)
-            submitter = IVirtualizationContainerSubmitter(vms)
-            metrics = yield submitter.submit(IGetGuestMetrics, __killhook=self._killhook)
+            metrics = yield self.fetch_vm_metrics(vms)
         except OperationRemoteError as e:
             log.msg('%s: remote error: %s' % (name, e), system='metrics', logLevel=logging.DEBUG)
             if e.remote_tb:
@@ -156,6 +305,7 @@ class VirtualComputeMetricGatherer(Adapter):
             log.msg("%s: error gathering VM metrics" % name, system='metrics', logLevel=logging.ERROR)
             if get_config().getboolean('debug', 'print_exceptions'):
                 log.err(system='metrics')
+            return
 
         if not metrics:
             log.msg('%s: no VM metrics received!' % name, system='metrics', logLevel=logging.WARNING)
@@ -164,25 +314,39 @@ class VirtualComputeMetricGatherer(Adapter):
         log.msg('%s: VM metrics received: %s' % (name, len(metrics)), system='metrics')
         timestamp = int(time.time() * 1000)
 
-        # db transact is needed only to traverse the zodb.
-        @db.ro_transact
-        def get_streams():
-            streams = []
-            for uuid, data in metrics.items():
-                if vms[uuid] and vms[uuid]['metrics']:
-                    vm_metrics = vms[uuid]['metrics']
-                    for k in data:
-                        if vm_metrics[k]:
-                            streams.append((IStream(vm_metrics[k]), (timestamp, data[k])))
-            return streams
-
-        # streams could defer the data appending but we don't care
-        for stream, data_point in (yield get_streams()):
-            stream.add(data_point)
+        self.ingest(['%s/%s/metrics' % (self.vms_path, uuid) for uuid in metrics],
+                    metrics.values(), timestamp)
+
+    @defer.inlineCallbacks
+    def fetch_vm_metrics(self, vms):
+        """Fetches only the VM metrics that changed since the last gather when the agent supports it,
+        merging them into the last known snapshot of the host; falls back to the full metrics"""
+        submitter = IVirtualizationContainerSubmitter(vms)
+        config = get_config()
+        use_delta = config.getboolean('metrics', 'delta', False)
+        if use_delta and capabilities.supported(self.host, 'metrics_delta'):
+            snapshot = snapshots.get(self.host)
+            try:
+                delta = yield submitter.submit(IGetGuestMetricsDelta, snapshot.seq,
+                                               float(config.getstring('metrics', 'delta_threshold', '0')),
+                                               __killhook=self._killhook)
+            except OperationRemoteError as e:
+                if not is_unsupported_error(e):
+                    raise
+                capabilities.mark_unsupported(self.host, 'metrics_delta')
+            else:
+                metrics = snapshot.merge(delta or {})
+                if metrics is not None:
+                    defer.returnValue(metrics)
+                log.msg('%s: VM metrics delta out of sequence, fetching all metrics' % (self.hostname),
+                        system='metrics', logLevel=logging.DEBUG)
+
+        metrics = yield submitter.submit(IGetGuestMetrics, __killhook=self._killhook)
+        defer.returnValue(metrics)
 
     @defer.inlineCallbacks
     def gather_phy(self):
-        name = yield db.get(self.context, 'hostname')
+        name = self.hostname
         try:
             data = yield IGetHostMetrics(self.context).run(__killhook=self._killhook)
 
@@ -190,22 +354,16 @@ class VirtualComputeMetricGatherer(Adapter):
                     logLevel=logging.DEBUG)
             timestamp = int(time.time() * 1000)
 
-            # db transact is needed only to traverse the zodb.
-            @db.ro_transact
-            def get_streams():
-                streams = []
-                host_metrics = self.context['metrics']
-                if host_metrics:
-                    for k in data:
-                        if host_metrics[k]:
-                            streams.append((IStream(host_metrics[k]), (timestamp, data[k])))
-                return streams
-
-            for stream, data_point in (yield get_streams()):
-                stream.add(data_point)
+            self.ingest(['%s/metrics' % self.path], [data], timestamp)
         except OperationRemoteError as e:
             log.msg('%s: remote error: %s' % (name, e), system='metrics', logLevel=logging.WARNING)
         except Exception:
             log.msg("%s: error gathering host metrics" % name, system='metrics', logLevel=logging.ERROR)
             if get_config().getboolean('debug', 'print_exceptions'):
                 log.err(system='metrics')
+
+    def ingest(self, metrics_paths, values, timestamp):
+        """Queues the values of each metrics container to the ingestor"""
+        ingestor.add_many(('%s/%s' % (path, k), (timestamp, v))
+                          for path, data in zip(metrics_paths, values)
+                          for k, v in data.iteritems())
@@ -0,0 +1,63 @@
+from grokcore.component import subscribe
+
+from opennode.knot.model.compute import ICompute
+from opennode.oms.model.model.events import IModelDeletedEvent
+
+
+class MetricsSnapshot(object):
+    """Last known VM metrics of a host, kept up to date with the deltas returned by the agent.
+
+    A delta is a dict with the sequence number of the snapshot it brings the agent to (`seq`), the
+    sequence number it was computed against (`base`), the metrics that changed beyond the threshold
+    per VM uuid (`changed`) and the uuids of the VMs that are gone (`removed`). Agents that lost their
+    state reply with a `full` snapshot instead.
+
+    """
+
+    def __init__(self):
+        self.seq = None
+        self.metrics = {}
+
+    def reset(self):
+        self.seq = None
+        self.metrics = {}
+
+    def merge(self, delta):
+        """Applies the delta and returns the resulting metrics, or None if the delta does not apply to
+        this snapshot, in which case the next request will ask for a full snapshot"""
+        if delta.get('full'):
+            self.metrics = {}
+        elif self.seq is None or delta.get('base') != self.seq:
+            self.reset()
+            return None
+
+        for uuid, values in delta.get('changed', {}).iteritems():
+            self.metrics.setdefault(uuid, {}).update(values)
+        for uuid in delta.get('removed', ()):
+            self.metrics.pop(uuid, None)
+
+        self.seq = delta.get('seq')
+        return self.metrics
+
+
+class MetricsSnapshots(object):
+
+    def __init__(self):
+        self._snapshots = {}
+
+    def get(self, host):
+        snapshot = self._snapshots.get(host)
+        if snapshot is None:
+            snapshot = self._snapshots[host] = MetricsSnapshot()
+        return snapshot
+
+    def forget(self, host):
+        self._snapshots.pop(host, None)
+
+
+snapshots = MetricsSnapshots()
+
+
+@subscribe(ICompute, IModelDeletedEvent)
+def forget_deleted_host_snapshot(model, event):
+    snapshots.forget(model.__name__)
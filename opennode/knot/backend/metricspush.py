@@ -0,0 +1,276 @@
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import os
+import time
+
+from twisted.internet import defer
+from twisted.internet.protocol import Factory
+from twisted.protocols.basic import LineReceiver
+from twisted.python import log
+from zope.component import provideSubscriptionAdapter, queryAdapter
+from zope.interface import implements
+
+from opennode.knot.backend.ingest import ingestor
+from opennode.knot.model.compute import ICompute
+from opennode.oms.config import get_config
+from opennode.oms.model.model.proc import IProcess, Proc, DaemonProcess
+from opennode.oms.util import subscription_factory, async_sleep
+from opennode.oms.zodb import db
+
+
+def verify_signature(pem, message, signature, hash_type='sha256'):
+    """Checks the signature of `message` made with the private key of the PEM public key, the way salt
+    signs with its keys"""
+    from M2Crypto import BIO, RSA
+
+    try:
+        key = RSA.load_pub_key_bio(BIO.MemoryBuffer(pem))
+        return bool(key.verify(getattr(hashlib, hash_type)(message).digest(), signature, hash_type))
+    except (RSA.RSAError, ValueError):
+        return False
+
+
+class TokenBucket(object):
+    """Allows `rate` operations per second on average, with bursts of up to `burst` operations"""
+
+    def __init__(self, rate, burst, clock=time.time):
+        self.rate = float(rate)
+        self.burst = float(max(burst, 1))
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def consume(self, amount=1):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < amount:
+            return False
+        self.tokens -= amount
+        return True
+
+
+class PushRegistry(object):
+    """Hosts that recently pushed metrics; the metrics daemon does not poll them"""
+
+    def __init__(self, ttl=5, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self._seen = {}
+
+    def seen(self, host):
+        self._seen[host] = self.clock()
+
+    def is_pushing(self, host):
+        last_seen = self._seen.get(host)
+        return last_seen is not None and self.clock() - last_seen <= self.ttl
+
+    def forget(self, host):
+        self._seen.pop(host, None)
+
+
+push_registry = PushRegistry()
+
+
+class MetricsPushProtocol(LineReceiver):
+    """Receives metrics samples pushed by an agent.
+
+    On connection the server sends `NONCE <nonce>`. The first line of the agent authenticates it:
+    `AUTH <minion id> <signature>`, the base64 signature of the nonce made with the private salt key of
+    the minion, checked against its accepted public key. Every following line is a JSON sample with the
+    host metrics under `host` and the metrics of each VM under `vms`, keyed by VM uuid, i.e. the same
+    data IGetHostMetrics and IGetGuestMetrics return.
+
+    """
+
+    delimiter = '\n'
+    MAX_LENGTH = 1048576
+
+    # seconds after which the paths of the host and its VMs are read again
+    refresh_interval = 60
+
+    def connectionMade(self):
+        self.nonce = binascii.hexlify(os.urandom(16))
+        self.minion_id = None
+        self.gatherer = None
+        self.bucket = None
+        self.prepared = None
+        self.refreshing = False
+        self.sendLine('NONCE %s' % self.nonce)
+
+    def lineReceived(self, line):
+        line = line.strip()
+        if not line:
+            return
+
+        if self.gatherer is None:
+            self.pauseProducing()
+            d = self.authenticate(line)
+            d.addCallbacks(lambda r: self.resumeProducing(), self.handle_auth_error)
+            return
+
+        if not self.bucket.consume():
+            self.factory.stats['throttled'] += 1
+            return
+
+        try:
+            sample = json.loads(line)
+        except ValueError:
+            sample = None
+
+        if not isinstance(sample, dict):
+            self.factory.stats['invalid'] += 1
+            return
+
+        self.factory.ingest(self.gatherer, sample)
+
+        if not self.refreshing and time.time() - self.prepared > self.refresh_interval:
+            self.refresh()
+
+    @defer.inlineCallbacks
+    def refresh(self):
+        self.refreshing = True
+        try:
+            gatherer = yield self.factory.get_gatherer(self.minion_id)
+            if gatherer is None:
+                self.transport.loseConnection()
+            else:
+                self.gatherer = gatherer
+        except Exception:
+            log.err(system='metrics-push')
+        finally:
+            self.prepared = time.time()
+            self.refreshing = False
+
+    @defer.inlineCallbacks
+    def authenticate(self, line):
+        parts = line.split()
+        if len(parts) != 3 or parts[0] != 'AUTH':
+            raise ValueError('expected AUTH <minion id> <signature>')
+
+        minion_id, signature = parts[1:]
+        if not self.factory.check_signature(minion_id, self.nonce, signature):
+            raise ValueError('unknown minion or bad signature')
+
+        gatherer = yield self.factory.get_gatherer(minion_id)
+        if gatherer is None:
+            raise ValueError('%s is not a managed host' % minion_id)
+
+        self.minion_id = minion_id
+        self.gatherer = gatherer
+        self.prepared = time.time()
+        self.bucket = self.factory.get_bucket(gatherer.host)
+        self.sendLine('OK')
+        log.msg('%s: pushing metrics' % minion_id, system='metrics-push')
+
+    def handle_auth_error(self, f):
+        self.factory.stats['rejected'] += 1
+        log.msg('Rejected metrics push from %s: %s' % (self.transport.getPeer(), f.getErrorMessage()),
+                system='metrics-push', logLevel=logging.WARNING)
+        self.sendLine('ERR %s' % f.getErrorMessage())
+        self.transport.loseConnection()
+
+    def lineLengthExceeded(self, line):
+        self.factory.stats['invalid'] += 1
+        self.transport.loseConnection()
+
+
+class MetricsPushFactory(Factory):
+    protocol = MetricsPushProtocol
+
+    def __init__(self, pki_dir, hash_type, rate, burst, registry=push_registry, verify=verify_signature):
+        self.pki_dir = pki_dir
+        self.hash_type = hash_type
+        self.verify = verify
+        self.rate = rate
+        self.burst = burst
+        self.registry = registry
+        self.buckets = {}
+        self.stats = {'samples': 0, 'throttled': 0, 'invalid': 0, 'rejected': 0}
+
+    def check_signature(self, minion_id, nonce, signature):
+        """Checks the signature of the nonce against the accepted salt key of the minion"""
+        if '/' in minion_id or minion_id.startswith('.'):
+            return False
+
+        try:
+            signature = base64.b64decode(signature)
+        except (TypeError, binascii.Error):
+            return False
+
+        path = os.path.join(self.pki_dir, 'minions', minion_id)
+        try:
+            with open(path) as f:
+                pem = f.read()
+        except IOError:
+            return False
+        return self.verify(pem, nonce, signature, self.hash_type)
+
+    @db.ro_transact
+    def get_gatherer(self, minion_id):
+        from opennode.knot.backend.metrics import IMetricsGatherer
+
+        machines = db.get_root()['oms_root']['machines']
+        for host in machines.listcontent():
+            if ICompute.providedBy(host) and host.hostname == minion_id:
+                gatherer = queryAdapter(host, IMetricsGatherer)
+                if gatherer is not None:
+                    gatherer.prepare()
+                return gatherer
+
+    def get_bucket(self, host):
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            bucket = self.buckets[host] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def ingest(self, gatherer, sample):
+        timestamp = int(time.time() * 1000)
+        vms = sample.get('vms')
+        if vms and gatherer.vms_path:
+            gatherer.ingest(['%s/%s/metrics' % (gatherer.vms_path, uuid) for uuid in vms],
+                            vms.values(), timestamp)
+        if sample.get('host'):
+            gatherer.ingest(['%s/metrics' % gatherer.path], [sample['host']], timestamp)
+
+        self.stats['samples'] += 1
+        self.registry.seen(gatherer.host)
+
+
+class MetricsPushDaemonProcess(DaemonProcess):
+    """Listens for metrics pushed by agents, as an alternative to polling them"""
+    implements(IProcess)
+
+    __name__ = "metrics-push"
+
+    def __init__(self):
+        super(MetricsPushDaemonProcess, self).__init__()
+        config = get_config()
+        self.interval = config.getint('metrics', 'interval')
+        push_registry.ttl = config.getint('metrics', 'push_ttl')
+        self.factory = MetricsPushFactory(config.getstring('salt', 'pki_dir', '/etc/salt/pki/master'),
+                                          config.getstring('metrics', 'push_hash_type', 'sha256'),
+                                          config.getint('metrics', 'push_rate'),
+                                          config.getint('metrics', 'push_burst'))
+        self.listening_port = None
+
+    @defer.inlineCallbacks
+    def run(self):
+        from twisted.internet import reactor
+
+        config = get_config()
+        self.listening_port = reactor.listenTCP(config.getint('metrics', 'push_port'), self.factory,
+                                                interface=config.getstring('metrics', 'push_interface', ''))
+        while True:
+            try:
+                yield ingestor.flush()
+            except Exception:
+                log.err(system='metrics-push')
+
+            yield async_sleep(self.interval)
+
+
+provideSubscriptionAdapter(subscription_factory(MetricsPushDaemonProcess), adapts=(Proc,))
@@ -0,0 +1,65 @@
+import math
+
+from opennode.knot.backend.metricstore import get_store
+from opennode.oms.model.traversal import canonical_path
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a non-empty list of values"""
+    values = sorted(values)
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+AGGREGATIONS = {
+    'sum': sum,
+    'avg': lambda values: sum(values) / len(values),
+    'max': max,
+    'min': min,
+    'p95': lambda values: percentile(values, 95),
+}
+
+
+def bucketize(points, step, reduce_max=False):
+    """Reduces (timestamp in ms, value) points to one value per bucket of `step` seconds: their mean, or
+    their max if `reduce_max` is set"""
+    step = step * 1000
+    buckets = {}
+    for timestamp, value in points:
+        buckets.setdefault(timestamp - timestamp % step, []).append(value)
+
+    if reduce_max:
+        return dict((bucket, max(values)) for bucket, values in buckets.iteritems())
+    return dict((bucket, sum(values) / len(values)) for bucket, values in buckets.iteritems())
+
+
+def aggregate_series(series, step, aggregation):
+    """Combines the bucketized series of several computes into one [bucket, value] list, applying
+    `aggregation` to the values the computes have in each bucket"""
+    fn = AGGREGATIONS[aggregation]
+
+    columns = {}
+    for buckets in series:
+        for bucket, value in buckets.iteritems():
+            columns.setdefault(bucket, []).append(value)
+
+    return [[bucket, fn(columns[bucket])] for bucket in sorted(columns)]
+
+
+def query_metrics(computes, metric, start, end, step, aggregation, store=None):
+    """Aggregates the `metric` series of `computes` between `start` and `end` (ms timestamps) in buckets
+    of `step` seconds, reading from the coarsest rollup tier that fits the step"""
+    if aggregation not in AGGREGATIONS:
+        raise ValueError('Unknown aggregation %s, expected one of %s' % (aggregation, sorted(AGGREGATIONS)))
+
+    store = store or get_store()
+    # the max of a bucket must come from the per-bucket maxima, the other aggregations work on means
+    reduce_max = aggregation == 'max'
+    series = []
+    for compute in computes:
+        key = '%s/metrics/%s' % (canonical_path(compute), metric)
+        points = store.read(key, start, end, resolution=step, aggregate='max' if reduce_max else 'avg')
+        if points:
+            series.append(bucketize(points, step, reduce_max))
+
+    return {'metric': metric, 'start': start, 'end': end, 'step': step, 'aggregation': aggregation,
+            'computes': len(series), 'points': aggregate_series(series, step, aggregation)}
@@ -0,0 +1,597 @@
+import hashlib
+import os
+import struct
+import time
+import zlib
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+from grokcore.component import Adapter, context, implements, name
+from twisted.internet import task
+from twisted.python import log
+from zope.component import getSiteManager, provideAdapter
+from zope.interface import implementedBy
+
+from opennode.oms.config import get_config
+from opennode.oms.model.model.base import Model
+from opennode.oms.model.model.stream import IStream
+from opennode.oms.model.traversal import canonical_path
+
+
+# deltas are stored as int32 milliseconds: a segment may not span more than ~24 days
+MAX_DELTA = 2 ** 31 - 1
+
+SEGMENT_HEADER = struct.Struct('<qI')
+
+ROLLUP_AGGREGATES = ('min', 'max', 'avg', 'last')
+
+
+class Segment(object):
+    __slots__ = ('base', 'deltas', 'values', 'capacity')
+
+    def __init__(self, base, capacity):
+        self.base = base
+        self.capacity = capacity
+        self.deltas = array('i')
+        self.values = array('d')
+
+    def __len__(self):
+        return len(self.deltas)
+
+    @property
+    def start(self):
+        return self.base + self.deltas[0] if self.deltas else self.base
+
+    @property
+    def end(self):
+        return self.base + self.deltas[-1] if self.deltas else self.base
+
+    def accepts(self, timestamp):
+        delta = timestamp - self.base
+        return (len(self.deltas) < self.capacity and 0 <= delta <= MAX_DELTA and
+                (not self.deltas or delta >= self.deltas[-1]))
+
+    def append(self, timestamp, value):
+        self.deltas.append(timestamp - self.base)
+        self.values.append(value)
+
+    def slice(self, start=None, end=None):
+        """Returns the (deltas, values) arrays of the points with start <= timestamp <= end"""
+        lo = bisect_left(self.deltas, start - self.base) if start is not None else 0
+        hi = bisect_right(self.deltas, end - self.base) if end is not None else len(self.deltas)
+        return self.deltas[lo:hi], self.values[lo:hi]
+
+    def points(self, start=None, end=None):
+        deltas, values = self.slice(start, end)
+        base = self.base
+        return [(base + d, v) for d, v in zip(deltas, values)]
+
+    def dumps(self):
+        return zlib.compress(SEGMENT_HEADER.pack(self.base, len(self.deltas)) +
+                             self.deltas.tostring() + self.values.tostring())
+
+    @classmethod
+    def loads(cls, data):
+        data = zlib.decompress(data)
+        base, count = SEGMENT_HEADER.unpack_from(data)
+        segment = cls(base, count)
+        offset = SEGMENT_HEADER.size
+        segment.deltas.fromstring(data[offset:offset + count * segment.deltas.itemsize])
+        offset += count * segment.deltas.itemsize
+        segment.values.fromstring(data[offset:offset + count * segment.values.itemsize])
+        return segment
+
+
+class Rollup(object):
+    """Aggregates of the bucket of `step` seconds a series is currently filling"""
+    __slots__ = ('step', 'bucket', 'min', 'max', 'sum', 'count', 'last')
+
+    def __init__(self, step):
+        self.step = step * 1000
+        self.bucket = None
+
+    def add(self, timestamp, value):
+        """Adds a point, returning the aggregates of the bucket it closed, if any"""
+        bucket = timestamp - timestamp % self.step
+        closed = None
+        if bucket != self.bucket:
+            closed = self.aggregates()
+            self.bucket, self.min, self.max, self.sum, self.count = bucket, value, value, 0.0, 0
+
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+        self.sum += value
+        self.count += 1
+        self.last = value
+        return closed
+
+    def aggregates(self):
+        if self.bucket is None:
+            return None
+        return self.bucket, {'min': self.min, 'max': self.max, 'avg': self.sum / self.count,
+                             'last': self.last}
+
+
+class Series(object):
+    """Points of one metric: recent segments in memory, older ones in compressed files"""
+
+    def __init__(self, key, directory, segment_size, memory_segments, retention=None, max_points=None):
+        self.key = key
+        self.directory = directory
+        self.segment_size = segment_size
+        self.memory_segments = max(1, memory_segments)
+        # ms after which rolled segments are deleted, None to keep them forever
+        self.retention = retention
+        # number of points after which the oldest rolled segments are deleted, None for no limit
+        self.max_points = max_points
+        self.segments = []
+        self._files = None
+
+    @property
+    def files(self):
+        """Sorted (start, end, count, filename) of the segments rolled to disk"""
+        if self._files is None:
+            self._files = []
+            if os.path.isdir(self.directory):
+                for filename in os.listdir(self.directory):
+                    if filename.endswith('.seg'):
+                        fields = map(int, filename[:-len('.seg')].split('-'))
+                        if len(fields) == 2:
+                            fields.append(self.segment_size)  # written before counts were recorded
+                        self._files.append(tuple(fields) + (filename,))
+                self._files.sort()
+        return self._files
+
+    def add(self, timestamp, value):
+        timestamp = int(timestamp)
+        if not self.segments or not self.segments[-1].accepts(timestamp):
+            if self.segments and timestamp < self.segments[-1].end:
+                return False  # out of order
+            self.segments.append(Segment(timestamp, self.segment_size))
+            if len(self.segments) > self.memory_segments:
+                self.roll(self.segments.pop(0))
+
+        self.segments[-1].append(timestamp, float(value))
+        return True
+
+    def write(self, segment):
+        files = self.files
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+            with open(os.path.join(self.directory, 'key'), 'w') as f:
+                f.write(self.key)
+
+        filename = '%s-%s-%s.seg' % (segment.start, segment.end, len(segment))
+        tmp = os.path.join(self.directory, filename + '.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(segment.dumps())
+        os.rename(tmp, os.path.join(self.directory, filename))
+        files.append((segment.start, segment.end, len(segment), filename))
+        files.sort()
+
+    def roll(self, segment):
+        if not len(segment):
+            return
+
+        self.write(segment)
+        if self.retention is not None:
+            self.expire(segment.end - self.retention)
+        if self.max_points:
+            self.trim(self.max_points)
+
+    def flush(self):
+        """Rolls all the in-memory segments to disk, returning the number of points written"""
+        points = self.memory_points
+        segments, self.segments = self.segments, []
+        for segment in segments:
+            self.roll(segment)
+        return points
+
+    def unlink(self, entry):
+        self.files.remove(entry)
+        os.unlink(os.path.join(self.directory, entry[3]))
+        return entry[2]
+
+    def expire(self, before):
+        """Deletes the rolled segments holding only points older than `before`. Returns the number of
+        points deleted"""
+        points = 0
+        while self.files and self.files[0][1] < before:
+            points += self.unlink(self.files[0])
+        return points
+
+    def trim(self, max_points):
+        """Deletes the oldest rolled segments until at most `max_points` points are kept. Returns the
+        number of points deleted"""
+        points = 0
+        while self.files and self.disk_points + self.memory_points > max_points:
+            points += self.unlink(self.files[0])
+        return points
+
+    def compact(self):
+        """Merges runs of adjacent rolled segments that fit together in a full segment, e.g. the partial
+        segments written when a series is evicted from memory. Returns the number of files merged"""
+        merged = 0
+        groups = []
+        for entry in list(self.files):
+            group = groups[-1] if groups else None
+            if (group and sum(e[2] for e in group) + entry[2] <= self.segment_size and
+                    entry[1] - group[0][0] <= MAX_DELTA):
+                group.append(entry)
+            else:
+                groups.append([entry])
+
+        for group in groups:
+            if len(group) < 2:
+                continue
+
+            segments = [self.load(entry[3]) for entry in group]
+            compacted = Segment(segments[0].start, self.segment_size)
+            for segment in segments:
+                for timestamp, value in segment.points():
+                    compacted.append(timestamp, value)
+
+            self.write(compacted)
+            for entry in group:
+                self.unlink(entry)
+            merged += len(group)
+        return merged
+
+    def load(self, filename):
+        with open(os.path.join(self.directory, filename), 'rb') as f:
+            return Segment.loads(f.read())
+
+    def iter_segments(self, start=None, end=None):
+        for seg_start, seg_end, count, filename in self.files:
+            if (start is None or seg_end >= start) and (end is None or seg_start <= end):
+                yield self.load(filename)
+
+        for segment in self.segments:
+            if (start is None or segment.end >= start) and (end is None or segment.start <= end):
+                yield segment
+
+    def read(self, start=None, end=None, limit=None):
+        points = []
+        for segment in self.iter_segments(start, end):
+            points.extend(segment.points(start, end))
+        if limit is not None:
+            points = points[-limit:]
+        return points
+
+    def last(self):
+        for segment in reversed(self.segments):
+            if len(segment):
+                return segment.end, segment.values[-1]
+
+    @property
+    def memory_points(self):
+        return sum(len(segment) for segment in self.segments)
+
+    @property
+    def disk_points(self):
+        return sum(entry[2] for entry in self.files)
+
+
+class MetricStore(object):
+    """Compact storage for metrics time series.
+
+    Each series keeps its points in fixed-size segments made of two arrays: timestamps as int32
+    millisecond deltas from the segment base, and float64 values, i.e. 12 bytes per point instead of a
+    tuple of boxed objects. The last `memory_segments` segments of a series stay in memory, older ones
+    are rolled to zlib compressed files under a per-series directory.
+
+    Raw points are kept for `raw_retention` seconds. Each (step, retention) pair of `tiers` adds a rollup
+    tier: as points arrive they are folded into buckets of `step` seconds, and every closed bucket appends
+    its min, max, avg and last value to a series of its own, kept for `retention` seconds. Reads asking
+    for a resolution are served from the coarsest tier that is not coarser than that resolution.
+
+    `retention` overrides the raw retention per metric name with (seconds, max points) pairs. When the
+    series in memory hold more than `memory_budget` points, the least recently used ones are rolled to
+    disk and dropped from memory. The points in memory are counted as they are added and evicted.
+
+    """
+
+    def __init__(self, directory, segment_size=3600, memory_segments=2, raw_retention=None, tiers=(),
+                 retention=None, memory_budget=None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.memory_segments = memory_segments
+        self.raw_retention = raw_retention
+        self.tiers = sorted(tiers)
+        self.retention = retention or {}
+        self.memory_budget = memory_budget
+        self.series = {}
+        self.rollups = {}
+        self._lru = OrderedDict()
+        self._non_numeric = set()
+        self._memory_points = 0
+
+    def _settings(self, key):
+        """Returns the (memory segments, retention in seconds, max points) of a series"""
+        if '@' in key:
+            step = int(key.rsplit('@', 1)[1].split('/')[0])
+            # closed buckets are only read back by range queries, one in-memory segment is enough
+            return 1, dict(self.tiers).get(step), None
+
+        retention, max_points = self.retention.get(key.rsplit('/', 1)[-1], (self.raw_retention, None))
+        return self.memory_segments, retention, max_points
+
+    def _make_series(self, key, directory=None):
+        if directory is None:
+            directory = os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+        memory_segments, retention, max_points = self._settings(key)
+        return Series(key, directory, self.segment_size, memory_segments,
+                      retention * 1000 if retention else None, max_points or None)
+
+    def _series(self, key):
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = self._make_series(key)
+        else:
+            del self._lru[key]
+        self._lru[key] = True
+        return series
+
+    def _raw_series(self, key):
+        return self._series(key)
+
+    def _tier_series(self, key, step, retention, aggregate):
+        return self._series('%s@%s/%s' % (key, step, aggregate))
+
+    def _add(self, series, timestamp, value):
+        """Adds the point to the series, keeping count of the points in memory"""
+        before = series.memory_points
+        added = series.add(timestamp, value)
+        self._memory_points += series.memory_points - before
+        return added
+
+    def _rollups(self, key):
+        rollups = self.rollups.get(key)
+        if rollups is None:
+            rollups = self.rollups[key] = [Rollup(step) for step, retention in self.tiers]
+        return rollups
+
+    def add(self, key, timestamp, value):
+        return self.add_many(key, [(timestamp, value)])
+
+    def add_many(self, key, points):
+        series = self._raw_series(key)
+        rollups = self._rollups(key)
+        added = 0
+        for timestamp, value in points:
+            try:
+                timestamp, value = int(timestamp), float(value)
+            except (TypeError, ValueError):
+                if key not in self._non_numeric:
+                    self._non_numeric.add(key)
+                    log.msg('Ignoring non-numeric values for %s: %r' % (key, value), system='metricstore')
+                continue
+
+            if not self._add(series, timestamp, value):
+                continue
+            added += 1
+
+            for (step, retention), rollup in zip(self.tiers, rollups):
+                closed = rollup.add(timestamp, value)
+                if closed is not None:
+                    bucket, aggregates = closed
+                    for aggregate in ROLLUP_AGGREGATES:
+                        self._add(self._tier_series(key, step, retention, aggregate), bucket,
+                                  aggregates[aggregate])
+        return added
+
+    def tier_for(self, resolution):
+        """Returns the (step, retention) of the coarsest tier with a step of at most `resolution` seconds,
+        None if raw points are needed"""
+        if resolution is None:
+            return None
+
+        chosen = None
+        for tier in self.tiers:
+            if tier[0] <= resolution:
+                chosen = tier
+        return chosen
+
+    def read(self, key, start=None, end=None, limit=None, resolution=None, aggregate='avg'):
+        """Returns the (timestamp, value) points of `key` in the range. When `resolution` (in seconds) is
+        given, points are the `aggregate` of the buckets of the matching rollup tier"""
+        tier = self.tier_for(resolution)
+        if tier is None:
+            return self._raw_series(key).read(start, end, limit)
+
+        if aggregate not in ROLLUP_AGGREGATES:
+            raise ValueError('Unknown aggregate %s, expected one of %s' % (aggregate, ROLLUP_AGGREGATES))
+
+        step, retention = tier
+        points = self._tier_series(key, step, retention, aggregate).read(start, end)
+
+        rollup = self._rollups(key)[self.tiers.index(tier)]
+        current = rollup.aggregates()
+        if current is not None:
+            bucket, aggregates = current
+            if (start is None or bucket >= start) and (end is None or bucket <= end):
+                points.append((bucket, aggregates[aggregate]))
+
+        if limit is not None:
+            points = points[-limit:]
+        return points
+
+    def last(self, key):
+        series = self.series.get(key)
+        return series.last() if series is not None else None
+
+    @property
+    def memory_points(self):
+        return self._memory_points
+
+    def evict(self, key):
+        """Rolls the series to disk and drops it from memory. Returns the number of points evicted"""
+        del self._lru[key]
+        points = self.series.pop(key).flush()
+        self._memory_points -= points
+        return points
+
+    def enforce_budget(self):
+        """Rolls the least recently used series to disk until the points in memory fit the budget.
+        Returns the number of points evicted"""
+        if not self.memory_budget:
+            return 0
+
+        evicted = 0
+        while self._memory_points > self.memory_budget and self._lru:
+            evicted += self.evict(next(iter(self._lru)))
+        return evicted
+
+    def gc(self, now=None):
+        """Evicts series beyond the memory budget, deletes the points past their retention, including
+        the series on disk only, and compacts the rolled segments. Returns what was reclaimed"""
+        report = {}
+        for step in self.iter_gc(report, now):
+            pass
+        return report
+
+    def cooperative_gc(self, now=None, cooperator=task):
+        """Runs `gc` one series at a time, between the other work of the reactor. Returns a deferred
+        fired with what was reclaimed"""
+        report = {}
+        d = cooperator.cooperate(self.iter_gc(report, now)).whenDone()
+        d.addCallback(lambda r: report)
+        return d
+
+    def iter_gc(self, report, now=None):
+        """Does the work of `gc`, yielding after each series; fills `report` as it goes"""
+        now = now if now is not None else int(time.time() * 1000)
+        report.update({'series': 0, 'evicted_points': self.enforce_budget(), 'expired_points': 0,
+                       'merged_files': 0, 'removed_series': 0, 'reclaimed_bytes': 0})
+
+        if not os.path.isdir(self.directory):
+            return
+
+        for name in os.listdir(self.directory):
+            directory = os.path.join(self.directory, name)
+            try:
+                with open(os.path.join(directory, 'key')) as f:
+                    key = f.read().decode('utf-8')
+            except IOError:
+                continue
+
+            series = self.series.get(key) or self._make_series(key, directory)
+            size = directory_size(directory)
+            report['series'] += 1
+
+            if series.retention is not None:
+                report['expired_points'] += series.expire(now - series.retention)
+            if series.max_points:
+                report['expired_points'] += series.trim(series.max_points)
+            report['merged_files'] += series.compact()
+
+            if not series.files and key not in self.series:
+                os.unlink(os.path.join(directory, 'key'))
+                os.rmdir(directory)
+                report['removed_series'] += 1
+                report['reclaimed_bytes'] += size
+            else:
+                report['reclaimed_bytes'] += size - directory_size(directory)
+            yield
+
+
+def directory_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory))
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        config = get_config()
+        _store = MetricStore(config.getstring('metrics', 'store_path', 'metrics'),
+                             config.getint('metrics', 'segment_size'),
+                             config.getint('metrics', 'memory_segments'),
+                             config.getint('metrics', 'raw_retention'),
+                             parse_tiers(config.getstring('metrics', 'rollups', '')),
+                             parse_retention(config.items('metrics-retention')
+                                             if config.has_section('metrics-retention') else []),
+                             config.getint('metrics', 'memory_budget'))
+    return _store
+
+
+def parse_tiers(spec):
+    """Parses a space separated list of `step:retention` pairs, in seconds"""
+    tiers = []
+    for tier in spec.split():
+        step, retention = tier.split(':')
+        tiers.append((int(step), int(retention)))
+    return tiers
+
+
+def parse_retention(items):
+    """Parses (metric name, `seconds [max points]`) pairs; 0 means unlimited"""
+    retention = {}
+    for metric, spec in items:
+        fields = map(int, spec.split())
+        retention[metric] = (fields[0] or None, fields[1] if len(fields) > 1 else None)
+    return retention
+
+
+def metric_store_enabled():
+    return get_config().getboolean('metrics', 'store', True)
+
+
+def is_numeric(value):
+    return isinstance(value, (int, long, float))
+
+
+# classes of the metric objects whose default IStream is the store-backed one
+_metric_classes = set()
+
+
+def serve_from_store(metric):
+    """Makes the store-backed stream the default IStream of the class of the metric, the one read by the
+    stream and subscribe views"""
+    cls = type(metric)
+    if cls not in _metric_classes:
+        _metric_classes.add(cls)
+        provideAdapter(MetricStoreStream, adapts=(cls,), provides=IStream)
+
+
+def default_stream(context):
+    """Returns the generic in-memory IStream of a model, bypassing the store-backed one"""
+    factory = getSiteManager().adapters.lookup((implementedBy(Model),), IStream)
+    return factory(context)
+
+
+class MetricStoreStream(Adapter):
+    """IStream of a metric backed by the metrics store. Points are (timestamp in ms, value); values the
+    store cannot hold (e.g. load average tuples) are kept in the default stream of the metric"""
+    implements(IStream)
+    context(Model)
+    name('metrics')
+
+    def __init__(self, context):
+        super(MetricStoreStream, self).__init__(context)
+        self.key = canonical_path(context)
+        self.fallback = default_stream(context)
+
+    def add(self, item):
+        self.add_many([item])
+
+    def add_many(self, items):
+        numeric = []
+        for item in items:
+            if is_numeric(item[1]):
+                numeric.append(item)
+            else:
+                self.fallback.add(item)
+
+        if numeric:
+            get_store().add_many(self.key, numeric)
+
+    def events(self, after, limit=None):
+        points = get_store().read(self.key, start=after + 1 if after is not None else None, limit=limit)
+        return points or self.fallback.events(after, limit=limit)
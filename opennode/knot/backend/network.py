@@ -3,10 +3,9 @@ from twisted.internet import defer
 from twisted.python import log
 from netaddr import IPAddress
 
-from opennode.knot.model.compute import ICompute
+from opennode.knot.model.computes import query_values
 from opennode.knot.model.network import IPv4Pools
 from opennode.oms.model.model.actions import Action
-from opennode.oms.model.model.symlink import follow_symlinks
 from opennode.oms.zodb import db
 
 
@@ -22,12 +21,9 @@ class SyncIPUsageAction(Action):
         @db.transact
         def get_compute_ips():
             try:
-                computes = map(follow_symlinks,
-                               filter(lambda c: ICompute.providedBy(follow_symlinks(c)),
-                                  db.get_root()['oms_root']['computes'].listcontent()))
                 pools = db.get_root()['oms_root']['ippools']
-                for c in computes:
-                    ip = IPAddress(c.ipv4_address.split('/')[0])
+                for address in query_values('ipv4'):
+                    ip = IPAddress(address)
                     pool = pools.find_pool(ip)
                     if pool is not None and not pool.get(ip):
                         log.msg('Marking %s as used...' % ip, system='sync-ippool')
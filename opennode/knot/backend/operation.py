@@ -42,6 +42,11 @@ class IGetGuestMetrics(IJob):
     """Returns guest VM metrics."""
 
 
+class IGetGuestMetricsDelta(IJob):
+    """Returns the guest VM metrics that changed beyond a threshold since the given snapshot sequence
+    number, or a full snapshot when the sequence number is unknown to the agent."""
+
+
 class IGetHostMetrics(IJob):
     """Returns host (PHY) metrics."""
 
@@ -58,6 +63,11 @@ class IGetVirtualizationContainers(IJob):
     """Get virtualization container provided by a compute"""
 
 
+class IGetInventory(IJob):
+    """Returns hardware info, uptime, disk usage, interfaces, virtualization containers and the VMs of
+    each container of a host in a single call."""
+
+
 class IDeployVM(IJob):
     """Deploys a vm."""
 
@@ -5,6 +5,7 @@ from twisted.python import log
 from zope.component import provideSubscriptionAdapter
 from zope.interface import implements
 
+from opennode.knot.model.catalog import catalog_compute
 from opennode.knot.model.compute import ICompute
 from opennode.knot.utils.icmp import ping
 from opennode.oms.config import get_config
@@ -50,6 +51,7 @@ class PingCheckAction(Action):
 
         self.context.suspicious = not all(ping_results)
         self.context.failure = not any(ping_results)
+        catalog_compute(self.context)
 
 
 class PingCheckDaemonProcess(DaemonProcess):
@@ -0,0 +1,318 @@
+import bisect
+import time
+
+from grokcore.component import GlobalUtility, implements, name
+from twisted.internet import defer
+from zope.component import getUtility
+from zope.interface import Interface
+
+from opennode.knot.model.compute import ICompute, IDeployed
+from opennode.knot.model.template import ITemplate, get_template_catalogue
+from opennode.knot.model.virtualizationcontainer import IVirtualizationContainer
+from opennode.oms.config import get_config
+from opennode.oms.zodb import db
+
+
+def number(value):
+    return value if isinstance(value, (int, long, float)) else 0
+
+
+class Demand(object):
+    """Resources requested by a VM: memory (MB), disk (sum of its partitions) and cores, and its template"""
+    __slots__ = ('memory', 'disk', 'cores', 'template')
+
+    def __init__(self, memory, disk, cores, template):
+        self.memory = memory
+        self.disk = disk
+        self.cores = cores
+        self.template = template
+
+    def __repr__(self):
+        return '<Demand memory=%s disk=%s cores=%s template=%s>' % (self.memory, self.disk, self.cores,
+                                                                    self.template)
+
+
+def vm_demand(vm):
+    """Must be called in a transaction"""
+    diskspace = getattr(vm, 'diskspace', None) or {}
+    return Demand(number(vm.memory), sum(number(v) for k, v in diskspace.iteritems() if k != 'total'),
+                  number(vm.num_cores), vm.template)
+
+
+class HostCapacity(object):
+    """Free capacity of the virtualization container of a host: memory not reserved by the deployed VMs
+    of the host, free disk on the configured partition, cores, load per core and the templates it offers.
+
+    The memory and disk are those of the whole host, shared by the entries of its containers.
+
+    """
+    __slots__ = ('host', 'hostname', 'backend', 'memory', 'disk', 'cores', 'load', 'templates')
+
+    def __init__(self, host, hostname, backend, memory, disk, cores, load, templates):
+        self.host = host
+        self.hostname = hostname
+        self.backend = backend
+        self.memory = memory
+        self.disk = disk
+        self.cores = cores
+        self.load = load
+        self.templates = templates
+
+    def unfit(self, demand, overcommit):
+        """Returns why the demand does not fit on the host, or None if it does"""
+        if not overcommit.get('memory') and demand.memory > self.memory:
+            return 'Has %s MB free memory, needs %s MB' % (self.memory, demand.memory)
+        if not overcommit.get('disk') and demand.disk > self.disk:
+            return 'Not enough diskspace'
+        if not overcommit.get('cores') and demand.cores > self.cores:
+            return 'Not enough CPU cores'
+        if demand.template not in self.templates:
+            return 'Template is unavailable'
+
+    def fits(self, demand, overcommit):
+        return self.unfit(demand, overcommit) is None
+
+
+class SortedHosts(object):
+    """Capacities of the hosts of a backend, kept sorted by the key of the placement strategy"""
+
+    def __init__(self, strategy):
+        self.strategy = strategy
+        self.keys = []
+        self.hosts = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, capacity):
+        bisect.insort(self.keys, (self.strategy.key(capacity), capacity.host))
+        self.hosts[capacity.host] = capacity
+
+    def remove(self, host):
+        capacity = self.hosts.pop(host)
+        del self.keys[bisect.bisect_left(self.keys, (self.strategy.key(capacity), host))]
+        return capacity
+
+    def at(self, index):
+        return self.hosts[self.keys[index][1]]
+
+
+class IPlacementStrategy(Interface):
+    """Scores the hosts a VM can be placed on"""
+
+    def key(capacity):
+        """Returns the key hosts are sorted by"""
+
+    def candidates(hosts, demand, overcommit):
+        """Yields the hosts of a SortedHosts in order of preference, starting from a bisection of the keys
+        where possible; hosts that cannot fit the demand may be yielded, they are skipped"""
+
+
+class BestFitStrategy(GlobalUtility):
+    """Places VMs on the host with the least free memory that fits them, filling up hosts one at a
+    time"""
+    implements(IPlacementStrategy)
+    name('best-fit')
+
+    def key(self, capacity):
+        return capacity.memory
+
+    def candidates(self, hosts, demand, overcommit):
+        start = 0 if overcommit.get('memory') else bisect.bisect_left(hosts.keys, (demand.memory,))
+        for index in xrange(start, len(hosts)):
+            yield hosts.at(index)
+
+
+class SpreadStrategy(GlobalUtility):
+    """Places VMs on the host with the most free memory (worst fit), spreading them across hosts"""
+    implements(IPlacementStrategy)
+    name('spread')
+
+    def key(self, capacity):
+        return capacity.memory
+
+    def candidates(self, hosts, demand, overcommit):
+        for index in xrange(len(hosts) - 1, -1, -1):
+            if not overcommit.get('memory') and hosts.keys[index][0] < demand.memory:
+                return
+            yield hosts.at(index)
+
+
+class LeastLoadedStrategy(GlobalUtility):
+    """Places VMs on the host with the lowest load per core, as last reported by its metrics"""
+    implements(IPlacementStrategy)
+    name('least-loaded')
+
+    def key(self, capacity):
+        return capacity.load
+
+    def candidates(self, hosts, demand, overcommit):
+        for index in xrange(len(hosts)):
+            yield hosts.at(index)
+
+
+def get_overcommit():
+    config = get_config()
+    return dict((resource, config.getboolean('overcommit', resource, False))
+                for resource in ('memory', 'disk', 'cores'))
+
+
+def host_load(host):
+    load = getattr(host, 'cpu_usage', None)
+    if isinstance(load, (tuple, list)):
+        load = load[0] if load else None
+    return number(load) / max(number(host.num_cores), 1)
+
+
+@db.ro_transact
+def read_capacities():
+    """Reads the capacity of the hosts that accept allocations, and the (VM uuid, host uuid) pairs of the
+    deployed VMs"""
+    param = unicode(get_config().getstring('allocate', 'diskspace_filter_param', default=u'/storage'))
+
+    offered = {}
+    catalogue = get_template_catalogue()
+    if catalogue is not None:
+        for template_name, offers in catalogue.iteritems():
+            for key in offers.keys():
+                offered.setdefault(key, set()).add(template_name)
+
+    capacities = []
+    deployed = set()
+    for host in db.get_root()['oms_root']['machines'].listcontent():
+        if not ICompute.providedBy(host):
+            continue
+
+        containers = [container for container in host.listcontent()
+                      if IVirtualizationContainer.providedBy(container)]
+        vms = [vm for container in containers for vm in container.listcontent() if IDeployed.providedBy(vm)]
+        deployed.update((vm.__name__, host.__name__) for vm in vms)
+
+        if getattr(host, 'exclude_from_allocation', None) or getattr(host, 'degraded', False):
+            continue
+
+        memory = number(host.memory) - sum(number(vm.memory) for vm in vms)
+        disk = number(host.diskspace.get(param, 0)) - number(host.diskspace_usage.get(param, 0))
+
+        for container in containers:
+            templates = offered.get((host.__name__, container.backend))
+            if catalogue is None:
+                templates = set(t.name for t in (container['templates'].listcontent()
+                                                  if container['templates'] else [])
+                                if ITemplate.providedBy(t))
+
+            capacities.append(HostCapacity(host.__name__, host.hostname, container.backend, memory, disk,
+                                           number(host.num_cores), host_load(host), templates or set()))
+
+    return capacities, deployed
+
+
+class PlacementTable(object):
+    """Free capacity of the hosts per backend, sorted for the placement strategy.
+
+    The table is read from the database every `refresh_interval` seconds. In between, placed VMs reserve
+    their resources on every backend of their host and undeployed VMs give them back. Reservations are
+    applied again on top of fresh reads until the VM shows up as deployed on its host, the deployment fails
+    or `pending_ttl` passes.
+
+    """
+
+    pending_ttl = 3600
+
+    def __init__(self, strategy, refresh_interval=60, clock=time.time):
+        self.strategy = strategy
+        self.refresh_interval = refresh_interval
+        self.clock = clock
+        self.backends = {}
+        self.pending = {}
+        self.refreshed = None
+
+    def load(self, capacities, deployed=()):
+        self.backends = {}
+        for capacity in capacities:
+            hosts = self.backends.get(capacity.backend)
+            if hosts is None:
+                hosts = self.backends[capacity.backend] = SortedHosts(self.strategy)
+            hosts.add(capacity)
+
+        now = self.clock()
+        for vm, (host, backend, demand, timestamp) in self.pending.items():
+            if (vm, host) in deployed or now - timestamp > self.pending_ttl:
+                del self.pending[vm]
+            else:
+                self._adjust(host, demand, -1)
+
+        self.refreshed = now
+
+    def is_stale(self):
+        return self.refreshed is None or self.clock() - self.refreshed >= self.refresh_interval
+
+    @defer.inlineCallbacks
+    def refresh(self, force=False):
+        if force or self.is_stale():
+            capacities, deployed = yield read_capacities()
+            self.load(capacities, deployed)
+
+    def place(self, vm, backend, demand, overcommit):
+        """Picks the best host of the backend for the VM and reserves its resources there. Returns the
+        capacity of the host, or None if no host fits"""
+        hosts = self.backends.get(backend)
+        if hosts is None:
+            return None
+
+        for capacity in self.strategy.candidates(hosts, demand, overcommit):
+            if capacity.fits(demand, overcommit):
+                self.reserve(vm, capacity.host, backend, demand)
+                return capacity
+
+    def reserved(self, vm):
+        """Returns the capacity of the host the VM has a reservation on, if any"""
+        reservation = self.pending.get(vm)
+        if reservation is not None:
+            host, backend, demand, timestamp = reservation
+            hosts = self.backends.get(backend)
+            return hosts.hosts.get(host) if hosts is not None else None
+
+    def explain(self, backend, demand, overcommit):
+        """Returns why each host of the backend does not fit the demand"""
+        hosts = self.backends.get(backend)
+        return dict((capacity.hostname, capacity.unfit(demand, overcommit) or 'Match')
+                    for capacity in (hosts.hosts.values() if hosts else []))
+
+    def reserve(self, vm, host, backend, demand):
+        self.release(vm)
+        self.pending[vm] = (host, backend, demand, self.clock())
+        self._adjust(host, demand, -1)
+
+    def release(self, vm):
+        """Gives back the resources reserved for a VM that was not deployed"""
+        reservation = self.pending.pop(vm, None)
+        if reservation is not None:
+            host, backend, demand, timestamp = reservation
+            self._adjust(host, demand, 1)
+
+    def undeployed(self, host, backend, demand):
+        self._adjust(host, demand, 1)
+
+    def _adjust(self, host, demand, sign):
+        # the backends of a host share its memory and disk
+        for hosts in self.backends.itervalues():
+            if host not in hosts.hosts:
+                continue
+
+            capacity = hosts.remove(host)
+            capacity.memory += sign * demand.memory
+            capacity.disk += sign * demand.disk
+            hosts.add(capacity)
+
+
+_table = None
+
+
+def get_placement_table():
+    global _table
+    if _table is None:
+        config = get_config()
+        strategy = getUtility(IPlacementStrategy, name=config.getstring('allocate', 'strategy', 'best-fit'))
+        _table = PlacementTable(strategy, config.getint('allocate', 'refresh_interval'))
+    return _table
@@ -1,18 +1,23 @@
 from __future__ import absolute_import
 
 from grokcore.component import Adapter, context, baseclass
-from twisted.internet import defer, reactor
+from twisted.internet import defer, reactor, threads
+from twisted.internet.error import ProcessTerminated
+from twisted.python import failure
 from twisted.python import log
 from zope.interface import classImplements
 
 import cPickle
 import json
+import json.scanner
 import logging
 import multiprocessing
 import time
 
 from opennode.knot.backend import operation as op
 from opennode.knot.backend import subprocess
+from opennode.knot.backend.salt.eventbus import get_bus
+from opennode.knot.backend.salt.pool import get_pool
 from opennode.knot.model.compute import ISaltInstalled
 from opennode.oms.config import get_config
 from opennode.oms.zodb import db
@@ -54,6 +59,57 @@ def dict_to_kwargs(arg):
     return ['%s=%s' % (k, str(v) if not type(v) in (list, tuple) else '"%s"' % v) for k, v in arg.iteritems()]
 
 
+def format_args(args):
+    return (list(reduce(lambda a, b: a + b,
+                        map(lambda a: (dict_to_kwargs(a) if type(a) is dict else ['"%s"' % str(a)]),
+                            args)))
+            if args else [])
+
+
+def json_loads_merged(output, decoder=None):
+    """ Parses salt JSON output, which contains one document per minion unless --static is used """
+    decoder = decoder or json.JSONDecoder()
+    output = output.strip()
+    data = {}
+    idx = 0
+    while idx < len(output):
+        obj, idx = decoder.raw_decode(output, idx)
+        if type(obj) is not dict:
+            raise TypeError('data received from salt is not dict: %s (%s)' % (type(obj).__name__, obj))
+        data.update(obj)
+        while idx < len(output) and output[idx].isspace():
+            idx += 1
+    return data
+
+
+def _threaded_decoder():
+    """ Decoder using the pure python scanner: slower than the C one, but it lets the reactor thread
+    run while decoding in a thread instead of holding the GIL for the whole document """
+    decoder = json.JSONDecoder()
+    decoder.scan_once = json.scanner.py_make_scanner(decoder)
+    return decoder
+
+
+def decode_output(output, merged=False):
+    """ Decodes salt JSON output. Outputs larger than `[salt] json_thread_threshold` bytes are decoded
+    in a thread so that large payloads do not stall the reactor. Returns a deferred """
+    if not output:
+        return defer.succeed({})
+
+    threshold = get_config().getint('salt', 'json_thread_threshold')
+    if not threshold or len(output) < threshold:
+        return defer.maybeDeferred(json_loads_merged if merged else json.loads, output)
+
+    log.msg('Decoding %s bytes of output in a thread' % len(output), system='salt', logLevel=logging.DEBUG)
+    if merged:
+        return threads.deferToThread(lambda: json_loads_merged(output, _threaded_decoder()))
+    return threads.deferToThread(lambda: _threaded_decoder().decode(output))
+
+
+def max_output():
+    return get_config().getint('salt', 'max_output') or None
+
+
 class SimpleSaltExecutor(object):
     """ Simple executor implementation.
     NOTE: Ignores hard_timeout configuration parameter and obsoletes other parameters under salt section
@@ -78,19 +134,16 @@ class SimpleSaltExecutor(object):
 
         timeout = ('--timeout=%s' % self.timeout) if self.timeout is not None else None
 
-        args = (list(reduce(lambda a, b: a + b,
-                            map(lambda a: (dict_to_kwargs(a) if type(a) is dict else ['"%s"' % str(a)]),
-                                args)))
-                if args else [])
+        args = format_args(args)
 
         output = yield subprocess.async_check_output(
             filter(None, (cmd.split(' ') +
                           ['--no-color', '--out=json', timeout, self.hostname, self.action] + args)),
-            killhook=killhook)
+            killhook=killhook, max_output=max_output())
 
         log.msg('Action "%s" to "%s" finished.' % (self.action, self.hostname),
                 system='salt-simple', logLevel=logging.DEBUG)
-        data = json.loads(output) if output else {}
+        data = yield decode_output(output)
         rdata = self._handle_errors(data)
         defer.returnValue(rdata)
 
@@ -119,6 +172,168 @@ class SimpleSaltExecutor(object):
         return data[hostkey]
 
 
+class SaltBatch(object):
+    """ A single list-targeted salt invocation shared by callers of the same action and arguments.
+
+    Errors are reported per host: the hosts that returned get their result even if others timed out or
+    failed remotely. `missing` holds the hosts that did not return after `run`.
+    """
+
+    def __init__(self, action, args, timeout):
+        self.action = action
+        self.args = args
+        self.timeout = timeout
+        self.waiters = []
+        self.missing = set()
+        self.process_killhook = defer.Deferred()
+
+    @property
+    def hostnames(self):
+        return sorted(set(executor.hostname for executor, d in self.waiters))
+
+    def add(self, executor, killhook=None):
+        d = defer.Deferred()
+        self.waiters.append((executor, d))
+        if killhook:
+            killhook.addCallback(self.detach, executor, d)
+        return d
+
+    def detach(self, r, executor, d):
+        """ Aborts a single caller. The salt process is only killed once no caller is left """
+        if d.called:
+            return
+
+        self.waiters.remove((executor, d))
+        log.msg('"%s" to "%s" aborted' % (self.action, executor.hostname), system='salt-batch')
+        d.errback(op.OperationRemoteError(msg='"%s" to "%s" aborted' % (self.action, executor.hostname)))
+
+        if not self.waiters and not self.process_killhook.called:
+            self.process_killhook.callback(None)
+
+    @defer.inlineCallbacks
+    def run(self):
+        hostnames = self.hostnames
+        cmd = get_config().getstring('salt', 'remote_command', 'salt')
+        timeout = ('--timeout=%s' % self.timeout) if self.timeout is not None else None
+        # the output limit is meant per host
+        limit = max_output() and max_output() * len(hostnames)
+
+        log.msg('Running action against %s hosts: %s args: %s timeout: %s' % (len(hostnames), self.action,
+                                                                               self.args, self.timeout),
+                system='salt-batch', logLevel=logging.DEBUG)
+
+        error = None
+        try:
+            output = yield subprocess.async_check_output(
+                filter(None, (cmd.split(' ') +
+                              ['--no-color', '--out=json', '--static', timeout,
+                               '-L', ','.join(hostnames), self.action] + format_args(self.args))),
+                killhook=self.process_killhook, max_output=limit)
+        except ProcessTerminated as e:
+            # salt exits with an error when some minions did not return; the others are in the output
+            error = failure.Failure()
+            output = getattr(e, 'output', '')
+            log.msg('Action "%s" to %s hosts exited with %s' % (self.action, len(hostnames), e.exitCode),
+                    system='salt-batch', logLevel=logging.DEBUG)
+        except Exception:
+            self.fail(failure.Failure())
+            return
+
+        try:
+            data = yield decode_output(output, merged=True)
+        except Exception:
+            self.fail(error or failure.Failure())
+            return
+
+        if error is not None and not data:
+            self.fail(error)
+            return
+
+        log.msg('Action "%s" to %s hosts finished.' % (self.action, len(hostnames)),
+                system='salt-batch', logLevel=logging.DEBUG)
+
+        results = self.split(hostnames, data)
+        for executor, d in self.waiters:
+            if d.called:
+                continue
+
+            if executor.hostname not in results:
+                self.missing.add(executor.hostname)
+
+            try:
+                result = executor._handle_errors(results.get(executor.hostname, {}))
+            except Exception:
+                d.errback(failure.Failure())
+            else:
+                d.callback(result)
+
+    def fail(self, f):
+        for executor, d in self.waiters:
+            if not d.called:
+                d.errback(f)
+
+    @staticmethod
+    def split(hostnames, data):
+        """ Splits the output per host. Like the simple executor does for a single host, a single
+        result under an unexpected minion id goes to the single host without a result """
+        results = dict((hostname, {hostname: data[hostname]}) for hostname in hostnames if hostname in data)
+        unclaimed = [key for key in data if key not in results]
+        missing = [hostname for hostname in hostnames if hostname not in results]
+        if len(unclaimed) == 1 and len(missing) == 1:
+            results[missing[0]] = {unclaimed[0]: data[unclaimed[0]]}
+        return results
+
+
+class BatchingSaltExecutor(SimpleSaltExecutor):
+    """ Coalesces identical calls to different hosts issued within `[salt] batch_window` seconds into one
+    list-targeted (-L) salt invocation, and splits its output back to each caller.
+
+    A host that did not return in a batch would hold the next batches until the salt timeout, so its
+    calls run on their own until it answers again.
+    """
+
+    _pending = {}
+    _unresponsive = set()
+    clock = reactor
+
+    @property
+    def batch_key(self):
+        return (self.action, json.dumps(self.args, sort_keys=True, default=str), self.timeout)
+
+    def run(self, *args, **kwargs):
+        if self.hostname in self._unresponsive:
+            d = SimpleSaltExecutor.run(self, *args, **kwargs)
+            d.addCallback(self._responsive)
+            return d
+
+        self.args = args
+        key = self.batch_key
+        batch = self._pending.get(key)
+
+        if batch is None:
+            batch = self._pending[key] = SaltBatch(self.action, args, self.timeout)
+            window = float(get_config().getstring('salt', 'batch_window', '0.05'))
+            batch.call = self.clock.callLater(window, self._flush, key)
+
+        d = batch.add(self, kwargs.get('__killhook'))
+
+        if len(batch.hostnames) >= get_config().getint('salt', 'batch_max_hosts'):
+            batch.call.cancel()
+            self._flush(key)
+
+        return d
+
+    def _responsive(self, result):
+        self._unresponsive.discard(self.hostname)
+        return result
+
+    @classmethod
+    def _flush(cls, key):
+        batch = cls._pending.pop(key, None)
+        if batch is not None and batch.waiters:
+            batch.run().addCallback(lambda r: cls._unresponsive.update(batch.missing))
+
+
 class SaltExecutor(object):
 
     def _get_client(self):
@@ -135,10 +350,11 @@ class SaltExecutor(object):
 class AsynchronousSaltExecutor(SaltExecutor):
     interval = 0.1
 
-    def __init__(self, hostname, action, interaction):
+    def __init__(self, hostname, action, interaction, timeout=None):
         self.hostname = hostname
         self.action = action
         self.interaction = interaction
+        self.timeout = timeout
         self.hard_timeout = get_config().getint('salt', 'hard_timeout')
 
     def run(self, *args, **kwargs):
@@ -191,6 +407,38 @@ class AsynchronousSaltExecutor(SaltExecutor):
             self.deferred.callback(data[hostkey])
 
 
+class PooledSaltExecutor(AsynchronousSaltExecutor):
+    """Runs the call on a persistent worker of the salt LocalClient pool, avoiding the startup cost of a
+    new process and client per call"""
+
+    def run(self, *args, **kwargs):
+        self.deferred = defer.Deferred()
+
+        pool = get_pool()
+        job = pool.submit(self.hostname, self.action, args, timeout=self.timeout)
+
+        killhook = kwargs.get('__killhook')
+        if killhook is not None:
+            killhook.addCallback(lambda r: pool.cancel(job))
+
+        job.deferred.addCallback(self._fire_events)
+        job.deferred.addErrback(self.deferred.errback)
+        return self.deferred
+
+
+class EventBusSaltExecutor(AsynchronousSaltExecutor):
+    """Publishes the job without blocking and waits for its return on the master event bus"""
+
+    def run(self, *args, **kwargs):
+        self.deferred = defer.Deferred()
+
+        d = get_bus().submit(self.hostname, self.action, args, self.timeout or self.hard_timeout,
+                             killhook=kwargs.get('__killhook'))
+        d.addCallback(self._fire_events)
+        d.addErrback(self.deferred.errback)
+        return self.deferred
+
+
 class SaltBase(Adapter):
     """Base class for all Salt method calls."""
     context(ISaltInstalled)
@@ -202,7 +450,10 @@ class SaltBase(Adapter):
     # 'sync' and 'async' are left for backwards compatibility with older configs
     executor_classes = {'sync': SimpleSaltExecutor,
                         'async': AsynchronousSaltExecutor,
-                        'simple': SimpleSaltExecutor}
+                        'simple': SimpleSaltExecutor,
+                        'batch': BatchingSaltExecutor,
+                        'pool': PooledSaltExecutor,
+                        'event': EventBusSaltExecutor}
 
     @defer.inlineCallbacks
     def run(self, *args, **kwargs):
@@ -222,9 +473,11 @@ ACTIONS = {
     op.IGetComputeInfo: 'onode.hardware_info',
     op.IGetDiskUsage: 'onode.host_disk_usage',
     op.IGetGuestMetrics: 'onode.vm_metrics',
+    op.IGetGuestMetricsDelta: 'onode.vm_metrics_delta',
     op.IGetHWUptime: 'onode.host_uptime',
     op.IGetHostMetrics: 'onode.host_metrics',
     op.IGetIncomingHosts: 'saltmod.get_hosts_to_sign',
+    op.IGetInventory: 'onode.host_inventory',
     op.IGetLocalTemplates: 'onode.vm_get_local_templates',
     op.IGetRoutes: 'onode.network_show_routing_table',
     op.IGetSignedCertificateNames: 'saltmod.get_signed_certs',
@@ -251,6 +504,7 @@ TIMEOUTS = {
     op.IMigrateVM: 3600,
     op.IDeployVM: 600,
     op.IGetGuestMetrics: 5,
+    op.IGetGuestMetricsDelta: 5,
     op.IGetHostMetrics: 5,
     op.IShutdownVM: 630,
     op.IStartVM: 30
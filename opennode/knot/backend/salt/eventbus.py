@@ -0,0 +1,208 @@
+from __future__ import absolute_import
+
+from twisted.internet import defer, threads
+from twisted.python import log
+
+import logging
+import threading
+import time
+
+from opennode.knot.backend import operation as op
+from opennode.oms.config import get_config
+
+
+def parse_return_event(tag, data):
+    """Returns (jid, minion, return) of a job return event, or None for any other event.
+
+    Handles both the namespaced tags (salt/job/<jid>/ret/<minion>) and the legacy ones, where the tag
+    is the bare jid.
+    """
+    if not isinstance(data, dict) or 'return' not in data:
+        return
+
+    if tag.startswith('salt/job/'):
+        parts = tag.split('/')
+        if len(parts) < 4 or parts[3] != 'ret':
+            return
+        jid = parts[2]
+    elif tag.isdigit():
+        jid = tag
+    else:
+        return
+
+    return data.get('jid', jid), data.get('id'), data['return']
+
+
+class MasterEventSource(object):
+    """Subscription to the event bus of the local salt master"""
+
+    def __init__(self, c_path):
+        import salt.config
+        import salt.utils.event
+        opts = salt.config.master_config(c_path)
+        self.event = salt.utils.event.MasterEvent(opts['sock_dir'])
+
+    def get_event(self, wait=1):
+        event = self.event.get_event(wait=wait, full=True)
+        if event is None:
+            return
+        return event['tag'], event['data']
+
+
+class MasterPublisher(object):
+    """Publishes jobs to the minions without waiting for their returns"""
+
+    def __init__(self, c_path):
+        self.c_path = c_path
+        self.client = None
+        self.lock = threading.Lock()
+
+    def __call__(self, hostname, action, args):
+        with self.lock:
+            if self.client is None:
+                from salt.client import LocalClient
+                self.client = LocalClient(c_path=self.c_path)
+            return self.client.cmd_async(hostname, action, arg=args)
+
+
+class SaltEventBus(object):
+    """Matches job returns read from the salt master event bus with the deferreds waiting for them.
+
+    A single thread reads the bus and hands the returns over to the reactor, so any number of
+    outstanding jobs wait at the cost of a dict entry and a delayed call. Returns arriving before their
+    waiter is registered (publishing races with the minion reply) are buffered for `early_ttl` seconds,
+    only while jobs are being published: other returns belong to jobs of other clients.
+
+    """
+
+    def __init__(self, source_factory, publisher, early_ttl=60, clock=None, deliver=None):
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.clock = clock
+        self.deliver = deliver or getattr(clock, 'callFromThread', None)
+        self.source_factory = source_factory
+        self.publisher = publisher
+        self.early_ttl = early_ttl
+
+        self.running = False
+        self._waiting = {}
+        self._early = {}
+        self._publishing = 0
+
+    @property
+    def outstanding(self):
+        return len(self._waiting)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        thread = threading.Thread(target=self._read_loop, name='salt-eventbus')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.running = False
+
+    def _read_loop(self):
+        source = None
+        while self.running:
+            try:
+                if source is None:
+                    source = self.source_factory()
+                event = source.get_event()
+            except Exception:
+                log.err(system='salt-eventbus')
+                source = None
+                time.sleep(1)
+                continue
+
+            if event is not None:
+                self.deliver(self.dispatch, *event)
+
+    def dispatch(self, tag, data):
+        """Reactor side of the reader thread"""
+        parsed = parse_return_event(tag, data)
+        if parsed is None:
+            return
+
+        jid, minion, result = parsed
+        waiter = self._waiting.pop(jid, None)
+        if waiter is None:
+            if self._publishing:
+                self._expire_early()
+                self._early[jid] = (self.clock.seconds(), minion, result)
+            return
+
+        self._complete(waiter, minion, result)
+
+    def _expire_early(self):
+        deadline = self.clock.seconds() - self.early_ttl
+        for jid, entry in self._early.items():
+            if entry[0] < deadline:
+                del self._early[jid]
+
+    def _complete(self, waiter, minion, result):
+        d, call = waiter
+        if call.active():
+            call.cancel()
+        d.callback({minion: result})
+
+    @defer.inlineCallbacks
+    def submit(self, hostname, action, args, timeout, killhook=None):
+        """Publishes the job and returns the return data keyed by minion id, like LocalClient.cmd"""
+        self.start()
+        self._publishing += 1
+        try:
+            jid = yield threads.deferToThread(self.publisher, hostname, action, args)
+            if not jid:
+                raise op.OperationRemoteError(msg='Failed to publish "%s" to "%s"' % (action, hostname))
+            d = self.wait(jid, hostname, action, timeout, killhook=killhook)
+        finally:
+            self._publishing -= 1
+            if not self._publishing:
+                # every published job has its waiter, the returns left over are not ours
+                self._early.clear()
+
+        log.msg('Published %s to %s as job %s' % (action, hostname, jid),
+                system='salt-eventbus', logLevel=logging.DEBUG)
+        res = yield d
+        defer.returnValue(res)
+
+    def wait(self, jid, hostname, action, timeout, killhook=None):
+        jid = str(jid)
+        d = defer.Deferred()
+
+        early = self._early.pop(jid, None)
+        if early is not None:
+            d.callback({early[1]: early[2]})
+            return d
+
+        def expire(reason):
+            if self._waiting.get(jid, (None,))[0] is not d:
+                return
+            del self._waiting[jid]
+            if call.active():
+                call.cancel()
+            d.errback(op.OperationRemoteError(msg='%s waiting for response from %s (%s)' %
+                                              (reason, hostname, action)))
+
+        call = self.clock.callLater(timeout, expire, 'Timeout')
+        self._waiting[jid] = (d, call)
+
+        if killhook is not None:
+            killhook.addCallback(lambda r: expire('Aborted'))
+
+        return d
+
+
+_bus = None
+
+
+def get_bus():
+    global _bus
+    if _bus is None:
+        c_path = get_config().getstring('salt', 'master_config_path', '/etc/salt/master')
+        _bus = SaltEventBus(lambda: MasterEventSource(c_path), MasterPublisher(c_path))
+    return _bus
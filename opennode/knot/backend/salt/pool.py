@@ -0,0 +1,295 @@
+from __future__ import absolute_import
+
+from collections import deque
+from twisted.internet import defer, reactor
+from twisted.internet.interfaces import IReadDescriptor
+from twisted.python import log
+from zope.interface import implements
+
+import cPickle as pickle
+import errno
+import fcntl
+import itertools
+import logging
+import multiprocessing
+import os
+import struct
+import time
+
+from opennode.knot.backend import operation as op
+from opennode.oms.config import get_config
+
+
+def frame(message):
+    """Pickles a message with its length prefixed, so that the reactor can read it in chunks"""
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    return struct.pack('!I', len(data)) + data
+
+
+class FrameBuffer(object):
+    """Reassembles the framed messages of a worker from the chunks read off its result pipe"""
+
+    def __init__(self):
+        self.data = ''
+
+    def feed(self, chunk):
+        """Adds a chunk, returns the messages completed by it"""
+        self.data += chunk
+        messages = []
+        while len(self.data) >= 4:
+            length = struct.unpack('!I', self.data[:4])[0]
+            if len(self.data) < 4 + length:
+                break
+            messages.append(pickle.loads(self.data[4:4 + length]))
+            self.data = self.data[4 + length:]
+        return messages
+
+
+def write_all(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def send_result(fd, job_id, data):
+    try:
+        message = frame((job_id, data))
+    except Exception as e:
+        # unpicklable result or exception
+        message = frame((job_id, {'_error': Exception('%s: %s' % (type(e).__name__, e))}))
+    write_all(fd, message)
+
+
+def worker_main(conn, result_fd, c_path):
+    """Worker process loop: keeps one initialised LocalClient and serves jobs received over the pipe,
+    writing the results framed to `result_fd`"""
+    from salt.client import LocalClient
+    client = LocalClient(c_path=c_path)
+
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+
+        if job is None:
+            return
+
+        job_id, hostname, action, args, timeout = job
+        try:
+            kwargs = {'timeout': timeout} if timeout is not None else {}
+            data = client.cmd(hostname, action, arg=args, **kwargs)
+        except SystemExit:
+            data = {}
+        except Exception as e:
+            data = {'_error': e}
+
+        send_result(result_fd, job_id, data)
+
+
+class SaltJob(object):
+
+    def __init__(self, job_id, hostname, action, args, timeout, hard_timeout):
+        self.id = job_id
+        self.hostname = hostname
+        self.action = action
+        self.args = args
+        self.timeout = timeout
+        self.hard_timeout = hard_timeout
+        self.deferred = defer.Deferred()
+        self.cancelled = False
+        self.call = None
+
+    @property
+    def message(self):
+        return (self.id, self.hostname, self.action, self.args, self.timeout)
+
+    def __str__(self):
+        return '%s@%s#%s' % (self.action, self.hostname, self.id)
+
+
+class SaltWorker(object):
+    """Reactor side of a worker process. The reactor watches the result pipe, so completion is signalled
+    without polling. The pipe is read without blocking and results are reassembled from their frames, so
+    a result written in several pieces never stalls the reactor"""
+    implements(IReadDescriptor)
+
+    def __init__(self, pool, target=worker_main):
+        self.pool = pool
+        self.job = None
+        self.stopped = False
+        self.buffer = FrameBuffer()
+        child_conn, self.conn = multiprocessing.Pipe(duplex=False)
+        self._fileno, result_fd = os.pipe()
+        fcntl.fcntl(self._fileno, fcntl.F_SETFL, fcntl.fcntl(self._fileno, fcntl.F_GETFL) | os.O_NONBLOCK)
+        c_path = get_config().getstring('salt', 'master_config_path', '/etc/salt/master')
+        self.process = multiprocessing.Process(target=target, args=(child_conn, result_fd, c_path))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        os.close(result_fd)
+        reactor.addReader(self)
+
+    def fileno(self):
+        return self._fileno
+
+    def logPrefix(self):
+        return 'salt-pool'
+
+    def doRead(self):
+        try:
+            chunk = os.read(self._fileno, 65536)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            chunk = ''
+
+        if not chunk:
+            self.stop()
+            self.pool.worker_lost(self)
+            return
+
+        for job_id, data in self.buffer.feed(chunk):
+            self.pool.job_done(self, job_id, data)
+
+    def connectionLost(self, reason):
+        self.stop()
+        self.pool.worker_lost(self)
+
+    def dispatch(self, job):
+        self.job = job
+        self.conn.send(job.message)
+
+    def stop(self, kill=False):
+        if self.stopped:
+            return
+
+        self.stopped = True
+        reactor.removeReader(self)
+        if kill and self.process.is_alive():
+            self.process.terminate()
+        for close in (self.conn.close, lambda: os.close(self._fileno)):
+            try:
+                close()
+            except (IOError, OSError):
+                pass
+
+
+class SaltWorkerPool(object):
+    """Pool of long-lived worker processes holding a salt LocalClient.
+
+    Jobs are queued and dispatched to idle workers. A worker running a job longer than its hard timeout
+    is killed and replaced, failing the job.
+
+    """
+
+    def __init__(self, size, hard_timeout, worker_factory=SaltWorker, clock=reactor):
+        self.size = max(1, size)
+        self.hard_timeout = hard_timeout
+        self.worker_factory = worker_factory
+        self.clock = clock
+        self.workers = []
+        self.idle = []
+        self.queue = deque()
+        self._ids = itertools.count()
+
+    def submit(self, hostname, action, args, timeout=None):
+        job = SaltJob(next(self._ids), hostname, action, args, timeout,
+                      max(self.hard_timeout, timeout or 0))
+        self.queue.append(job)
+        self._dispatch()
+        return job
+
+    def cancel(self, job):
+        if job.deferred.called:
+            return
+
+        job.cancelled = True
+        for worker in self.workers:
+            if worker.job is job:
+                self._kill(worker)
+                break
+
+        job.deferred.errback(op.OperationRemoteError(msg='"%s" to "%s" aborted' % (job.action, job.hostname)))
+        self._dispatch()
+
+    def _dispatch(self):
+        while self.queue and (self.idle or len(self.workers) < self.size):
+            job = self.queue.popleft()
+            if job.cancelled:
+                continue
+
+            if self.idle:
+                worker = self.idle.pop()
+            else:
+                worker = self.worker_factory(self)
+                self.workers.append(worker)
+
+            log.msg('Dispatching %s' % job, system='salt-pool', logLevel=logging.DEBUG)
+            job.started = time.time()
+            job.call = self.clock.callLater(job.hard_timeout, self._expire, worker, job)
+            worker.dispatch(job)
+
+    def job_done(self, worker, job_id, data):
+        job = worker.job
+        if job is None or job.id != job_id:
+            log.msg('Discarding stale result for job #%s' % job_id, system='salt-pool')
+            return
+
+        worker.job = None
+        self.idle.append(worker)
+
+        if job.call.active():
+            job.call.cancel()
+
+        if not job.deferred.called:
+            log.msg('%s finished in %.2fs' % (job, time.time() - job.started),
+                    system='salt-pool', logLevel=logging.DEBUG)
+            job.deferred.callback(data)
+
+        self._dispatch()
+
+    def worker_lost(self, worker):
+        if worker not in self.workers:
+            return
+
+        self._remove(worker)
+        job = worker.job
+        if job is not None and not job.deferred.called:
+            if job.call.active():
+                job.call.cancel()
+            job.deferred.errback(op.OperationRemoteError(msg='Salt worker died executing "%s" on %s' %
+                                                         (job.action, job.hostname)))
+        self._dispatch()
+
+    def _expire(self, worker, job):
+        if worker.job is not job or job.deferred.called:
+            return
+
+        log.msg("Timeout while executing '%s' @ '%s'" % (job.action, job.hostname), system='salt-pool')
+        self._kill(worker)
+        job.deferred.errback(op.OperationRemoteError(msg='Timeout waiting for response from %s (%s)' %
+                                                     (job.hostname, job.action)))
+        self._dispatch()
+
+    def _kill(self, worker):
+        if worker.job is not None and worker.job.call is not None and worker.job.call.active():
+            worker.job.call.cancel()
+        self._remove(worker)
+        worker.stop(kill=True)
+
+    def _remove(self, worker):
+        if worker in self.workers:
+            self.workers.remove(worker)
+        if worker in self.idle:
+            self.idle.remove(worker)
+
+
+_pool = None
+
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        config = get_config()
+        _pool = SaltWorkerPool(config.getint('salt', 'pool_size'), config.getint('salt', 'hard_timeout'))
+    return _pool
@@ -0,0 +1,159 @@
+import heapq
+import itertools
+import logging
+
+from twisted.internet import defer
+from twisted.python import log
+from twisted.python.failure import Failure
+
+
+class JobTimeoutError(Exception):
+    """ Raised into the waiters of a job that did not finish before its deadline """
+
+
+class BoundedScheduler(object):
+    """Runs keyed jobs with a bounded number of jobs in flight.
+
+    Jobs are queued in FIFO order within the same priority (lower value runs first). A key may only
+    have one job queued or running at a time: submitting it again is counted as skipped. Jobs are
+    callables that receive a `killhook` deferred as the first argument, which is fired when the job
+    exceeds its timeout, and return a (possibly deferred) result.
+
+    A timed out job keeps its key and its slot until its deferred actually fires, so that a job which
+    ignores the killhook can neither run twice for the same key nor push the concurrency over the bound.
+
+    """
+
+    def __init__(self, max_concurrency, timeout=None, name='scheduler', clock=None):
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = timeout
+        self.name = name
+
+        if clock is None:
+            from twisted.internet import reactor
+            clock = reactor
+        self.clock = clock
+
+        self._queue = []
+        self._queued = {}
+        self._running = {}
+        self._seq = itertools.count()
+        self.stats = self._empty_stats()
+        self.last_stats = self._empty_stats()
+
+    def _empty_stats(self):
+        return {'queued': 0, 'running': 0, 'completed': 0, 'failed': 0, 'timed_out': 0, 'skipped': 0}
+
+    def is_pending(self, key):
+        return key in self._queued or key in self._running
+
+    @property
+    def running(self):
+        return len(self._running)
+
+    @property
+    def waiting(self):
+        return len(self._queued)
+
+    def new_cycle(self):
+        """Closes the current statistics cycle and returns its counters"""
+        self.stats['running'] = self.running
+        self.last_stats = self.stats
+        self.stats = self._empty_stats()
+        return self.last_stats
+
+    def submit(self, key, job, *args, **kwargs):
+        """Enqueues job for key. Returns a deferred fired with the job outcome, or None if another
+        job for the same key is still queued or running."""
+        priority = kwargs.pop('priority', 0)
+        timeout = kwargs.pop('timeout', self.timeout)
+
+        if self.is_pending(key):
+            self.stats['skipped'] += 1
+            log.msg('%s: skipping %s: previous job not finished yet' % (self.name, key),
+                    system=self.name, logLevel=logging.DEBUG)
+            return
+
+        d = defer.Deferred()
+        entry = [priority, next(self._seq), key, job, args, kwargs, timeout, d]
+        heapq.heappush(self._queue, entry)
+        self._queued[key] = entry
+        self.stats['queued'] += 1
+        self._pump()
+        return d
+
+    def cancel(self, key):
+        """Drops a queued job, failing its waiters with CancelledError, or kills a running one"""
+        entry = self._queued.pop(key, None)
+        if entry is not None:
+            entry[3] = None
+            entry[7].errback(defer.CancelledError())
+            return True
+
+        running = self._running.get(key)
+        if running is not None:
+            self._expire(key, running)
+            return True
+
+        return False
+
+    def _pump(self):
+        while self._queue and len(self._running) < self.max_concurrency:
+            priority, seq, key, job, args, kwargs, timeout, d = heapq.heappop(self._queue)
+            if job is None:
+                continue  # cancelled while waiting
+
+            del self._queued[key]
+            self._start(key, job, args, kwargs, timeout, d)
+
+    def _start(self, key, job, args, kwargs, timeout, d):
+        killhook = defer.Deferred()
+        running = {'killhook': killhook, 'deferred': d, 'started': self.clock.seconds(), 'call': None,
+                   'expired': False}
+        self._running[key] = running
+
+        if timeout:
+            running['call'] = self.clock.callLater(timeout, self._expire, key, running)
+
+        jd = defer.maybeDeferred(job, killhook, *args, **kwargs)
+        jd.addBoth(self._finished, key, running)
+
+    def _finished(self, result, key, running):
+        del self._running[key]
+        if running['expired']:
+            # outcome already reported, only the slot was still held
+            log.msg('%s: %s finished %.1fs after being killed' %
+                    (self.name, key, self.clock.seconds() - running['started']),
+                    system=self.name, logLevel=logging.DEBUG)
+            self._pump()
+            return
+
+        if running['call'] is not None and running['call'].active():
+            running['call'].cancel()
+
+        if isinstance(result, Failure):
+            self.stats['failed'] += 1
+            running['deferred'].errback(result)
+        else:
+            self.stats['completed'] += 1
+            running['deferred'].callback(result)
+
+        self._pump()
+
+    def _expire(self, key, running):
+        if self._running.get(key) is not running or running['expired']:
+            return
+
+        running['expired'] = True
+        if running['call'] is not None and running['call'].active():
+            running['call'].cancel()
+
+        self.stats['timed_out'] += 1
+        log.msg('%s: %s timed out after %.1fs, killing' % (self.name, key,
+                                                           self.clock.seconds() - running['started']),
+                system=self.name)
+
+        if not running['killhook'].called:
+            running['killhook'].callback(None)
+
+        running['deferred'].errback(JobTimeoutError('%s timed out' % key))
@@ -10,9 +10,9 @@ import sys
 from opennode.knot.model.user import IUserStatisticsProvider
 from opennode.knot.model.user import IUserStatisticsLogger
 from opennode.knot.model.compute import IVirtualCompute, IDeployed
+from opennode.knot.model.computes import query_computes
 
 from opennode.oms.config import get_config
-from opennode.oms.model.model.symlink import follow_symlinks
 from opennode.oms.zodb import db
 
 
@@ -24,14 +24,8 @@ class UserComputeStatisticsAggregator(GlobalUtility):
 
     @db.assert_transact
     def get_computes(self, username):
-        computes = db.get_root()['oms_root']['computes']
-        user_computes = []
-        for compute in map(follow_symlinks, computes.listcontent()):
-            if not IVirtualCompute.providedBy(compute):
-                continue
-            if compute.__owner__ == username and IDeployed.providedBy(compute):
-                user_computes.append(compute)
-        return user_computes
+        return [compute for compute in query_computes(owner=username)
+                if IVirtualCompute.providedBy(compute) and IDeployed.providedBy(compute)]
 
     @db.assert_transact
     def get_credit(self, username):
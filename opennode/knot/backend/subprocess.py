@@ -4,35 +4,71 @@
 import logging
 
 from twisted.internet.defer import Deferred
-from twisted.internet.error import ProcessDone
+from twisted.internet.error import ProcessDone, ProcessExitedAlready
 from twisted.internet.protocol import ProcessProtocol
 
 log = logging.getLogger(__name__)
 
+class OutputLimitExceeded(Exception):
+    """ Raised when a process writes more than the allowed amount of output; the process is killed """
+
+
 class SubprocessProtocol(ProcessProtocol):
-    outBuffer = ""
-    errBuffer = ""
+    """ Collects the output in lists of chunks, joined once, to avoid quadratic string concatenation
+    on large outputs """
+
+    def __init__(self, max_output=None):
+        self.max_output = max_output
+        self.outChunks = []
+        self.errChunks = []
+        self.outSize = 0
+        self.overflow = False
+
+    @property
+    def outBuffer(self):
+        if len(self.outChunks) > 1:
+            self.outChunks = [''.join(self.outChunks)]
+        return self.outChunks[0] if self.outChunks else ''
+
+    @property
+    def errBuffer(self):
+        return ''.join(self.errChunks)
 
     def connectionMade(self):
         self.d = Deferred()
 
     def outReceived(self, data):
-        self.outBuffer += data
+        if self.overflow:
+            return
+
+        self.outSize += len(data)
+        if self.max_output and self.outSize > self.max_output:
+            self.overflow = True
+            self.outChunks = []
+            self.transport.signalProcess('KILL')
+            return
+
+        self.outChunks.append(data)
 
     def errReceived(self, data):
-        self.errBuffer += data
+        self.errChunks.append(data)
 
     def processEnded(self, reason):
-        if reason.check(ProcessDone):
+        if self.overflow:
+            self.d.errback(OutputLimitExceeded('Process output exceeded %s bytes' % self.max_output))
+        elif reason.check(ProcessDone):
             self.d.callback(self.outBuffer)
         else:
+            # callers may still use what the process wrote before failing
+            reason.value.output = self.outBuffer
             self.d.errback(reason)
 
 
-def async_check_output(args, ireactorprocess=None, killhook=None):
+def async_check_output(args, ireactorprocess=None, killhook=None, max_output=None):
     """
     :type args: list of str
     :type ireactorprocess: :class: twisted.internet.interfaces.IReactorProcess
+    :type max_output: int, output size in bytes after which the process is killed
     :rtype: Deferred
     """
     log.debug('%s (killhook=%s)', ' '.join(map(str, args)), killhook is not None)
@@ -41,8 +77,16 @@ def async_check_output(args, ireactorprocess=None, killhook=None):
         from twisted.internet import reactor
         ireactorprocess = reactor
 
-    pprotocol = SubprocessProtocol()
+    pprotocol = SubprocessProtocol(max_output=max_output)
     ireactorprocess.spawnProcess(pprotocol, args[0], map(str, args), env=None)
     if killhook and type(killhook) is Deferred:
-        killhook.addCallback(lambda r: pprotocol.transport.signalProcess('KILL'))
+        killhook.addCallback(lambda r: kill_process(pprotocol.transport))
     return pprotocol.d
+
+
+def kill_process(transport):
+    """Kills the process, unless it already exited (e.g. when a killhook fires late)"""
+    try:
+        transport.signalProcess('KILL')
+    except ProcessExitedAlready:
+        pass
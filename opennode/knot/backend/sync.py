@@ -1,25 +1,33 @@
 from datetime import datetime, timedelta
-from logging import ERROR
+from grokcore.component import context
+from logging import ERROR, WARNING
 import re
+import time
 
 from twisted.internet import defer
 from twisted.python import log
 
+from zope import schema
 from zope.authentication.interfaces import IAuthentication
 from zope.component import provideSubscriptionAdapter, getAllUtilitiesRegisteredFor
 from zope.component import getUtility
-from zope.interface import implements
+from zope.interface import Interface, implements
 
+from opennode.knot.backend.scheduler import BoundedScheduler, JobTimeoutError
 from opennode.knot.backend.syncaction import SyncAction
+from opennode.knot.backend.syncschedule import get_sync_schedule
 from opennode.knot.backend.network import SyncIPUsageAction
 from opennode.knot.backend.operation import OperationRemoteError
 from opennode.knot.backend.operation import IPing
 from opennode.knot.model.backend import IKeyManager
 from opennode.knot.model.compute import ICompute, IManageable
+from opennode.knot.model.computes import check_computes_index
+from opennode.knot.model.template import build_template_catalogue
 from opennode.knot.model.user import UserProfile
 from opennode.knot.model.user import IUserStatisticsProvider
 from opennode.oms.config import get_config
 from opennode.oms.endpoint.ssh.detached import DetachedProtocol
+from opennode.oms.model.model.base import ContainerInjector, ReadonlyContainer
 from opennode.oms.model.model.proc import IProcess, Proc, DaemonProcess
 from opennode.oms.model.model.symlink import follow_symlinks
 from opennode.oms.security.principals import User
@@ -82,7 +90,11 @@ class SyncDaemonProcess(DaemonProcess):
         super(SyncDaemonProcess, self).__init__()
         config = get_config()
         self.interval = config.getint('sync', 'interval')
-        self.outstanding_requests = {}
+        self.scheduler = BoundedScheduler(config.getint('sync', 'max_concurrency'),
+                                          timeout=config.getint('sync', 'timeout') or None,
+                                          name='sync')
+        self.index_check_interval = config.getint('sync', 'index_check_interval')
+        self.last_index_check = None
 
     @defer.inlineCallbacks
     def run(self):
@@ -98,6 +110,7 @@ class SyncDaemonProcess(DaemonProcess):
 
     @defer.inlineCallbacks
     def sync(self):
+        yield self.check_indexes()
         log.msg('Synchronizing system users', system='sync')
         yield self.gather_users()
         log.msg('Synchronizing machines: %s' % (yield get_manageable_machine_hostnames()), system='sync')
@@ -111,6 +124,21 @@ class SyncDaemonProcess(DaemonProcess):
         log.msg('Synchronizing user VM statistics', system='sync')
         yield self.gather_user_vm_stats()
 
+    @defer.inlineCallbacks
+    def check_indexes(self):
+        now = time.time()
+        if self.last_index_check is not None and now - self.last_index_check < self.index_check_interval:
+            return
+
+        self.last_index_check = now
+        missing, stale, recataloged = yield db.transact(check_computes_index)()
+        if missing or stale or recataloged:
+            log.msg('Repaired the computes index: %s missing, %s stale, %s recataloged' %
+                    (len(missing), len(stale), recataloged), system='sync', logLevel=WARNING)
+
+        catalogue = yield db.transact(lambda: len(build_template_catalogue()))()
+        log.msg('Rebuilt the template catalogue: %s templates' % catalogue, system='sync')
+
     @defer.inlineCallbacks
     def cleanup_machines(self, accepted):
         hosts_to_delete = [(host, hostname) for host, hostname in (yield get_manageable_machines())
@@ -119,6 +147,8 @@ class SyncDaemonProcess(DaemonProcess):
         if hosts_to_delete:
             log.msg('Deleting machines: %s' % (hosts_to_delete), system='sync')
             yield delete_machines(hosts_to_delete)
+            for host, hostname in hosts_to_delete:
+                get_sync_schedule().forget(host.__name__)
 
     @defer.inlineCallbacks
     def gather_users(self):
@@ -207,26 +237,17 @@ class SyncDaemonProcess(DaemonProcess):
 
         yield ensure_hangar_v12ncontainers()
 
-    def delete_outstanding_request(self, compute):
-        if str(compute) in self.outstanding_requests:
-            del self.outstanding_requests[str(compute)]
-        else:
-            log.msg('Unlock: %s not in outstanding requests: %s'
-                    % (str(compute), self.outstanding_requests.keys()), system='sync-unlock')
-
     @db.transact
     def handle_error(self, e, action, c, compute, status_name):
         e.trap(Exception)
         log.msg("Got exception on %s of '%s'" % (action, c), system='sync')
         if get_config().getboolean('debug', 'print_exceptions'):
             log.err(e, system='sync')
-        self.delete_outstanding_request(compute)
         set_compute_status(compute.__name__, status_name, True)
 
     @db.transact
     def handle_success(self, r, action, hostname, compute, status_name):
         log.msg("%s completed: '%s'" % (action, hostname), system='sync')
-        self.delete_outstanding_request(compute)
         set_compute_status(compute.__name__, status_name, False)
 
     @db.transact
@@ -236,47 +257,73 @@ class SyncDaemonProcess(DaemonProcess):
             log.err(ore, system='sync')
         else:
             log.msg(str(ore.value), system='sync', logLevel=ERROR)
-        self.delete_outstanding_request(compute)
         set_compute_status(compute.__name__, status_name, True)
 
-    def execute_sync_action(self, hostname, compute):
+    def execute_sync_action(self, hostname, compute, on_failure=None):
+        """ Returns a deferred fired with the number of objects touched by the sync """
         log.msg("Syncing started: '%s' (%s)" % (hostname, str(compute)), system='sync')
-        curtime = datetime.now().isoformat()
         syncaction = SyncAction(compute)
         deferred = syncaction.execute(DetachedProtocol(), object())
-        self.outstanding_requests[str(compute)] = [deferred, curtime, 0, defer.Deferred()]
+        if on_failure is not None:
+            deferred.addErrback(on_failure)
         deferred.addCallback(self.handle_success, 'synchronization', hostname, compute, 'suspicious')
         deferred.addErrback(self.handle_remote_error, hostname, compute, 'suspicious')
         deferred.addErrback(self.handle_error, 'Synchronization', hostname, compute, 'suspicious')
+        deferred.addCallback(lambda r: syncaction.touched)
+        return deferred
+
+    def sync_host(self, killhook, hostname, compute):
+        """ Ping test followed by a SyncAction. Runs as a scheduler job: the killhook only aborts the
+        ping, a SyncAction already in progress is left to finish on its own, holding the scheduler slot of
+        the host until it does. The outcome adjusts the next sync time of the host """
+        failures = []
+
+        def on_failure(f):
+            failures.append(f)
+            return f
+
+        log.msg('Pinging %s (%s)...' % (hostname, compute), system='sync')
+        pingtest = IPing(compute)
+        deferred = pingtest.run(__killhook=killhook)
+        deferred.addErrback(on_failure)
+        deferred.addCallback(self.handle_success, 'ping test', hostname, compute, 'failure')
+        deferred.addErrback(self.handle_remote_error, hostname, compute, 'failure')
+        deferred.addErrback(self.handle_error, 'Ping test', hostname, compute, 'failure')
+
+        def sync_action(r, hostname, compute):
+            return self.execute_sync_action(hostname, compute, on_failure)
+
+        def reschedule(touched):
+            entry = get_sync_schedule().record(compute.__name__, hostname, touched, bool(failures))
+            log.msg("Next sync of '%s' in %ss" % (hostname, entry.interval), system='sync')
+
+        deferred.addCallback(sync_action, hostname, compute)
+        deferred.addCallback(reschedule)
         return deferred
 
     @defer.inlineCallbacks
     def execute_ping_tests(self):
+        stats = self.scheduler.new_cycle()
+        log.msg('Previous cycle: %(queued)s queued, %(running)s running, %(completed)s completed, '
+                '%(failed)s failed, %(timed_out)s timed out, %(skipped)s skipped' % stats, system='sync')
+
+        def handle_timeout(e, compute, hostname):
+            e.trap(JobTimeoutError)
+            log.msg("Syncing '%s' timed out" % hostname, system='sync', logLevel=ERROR)
+            get_sync_schedule().record(compute.__name__, hostname, 0, True)
+
+        schedule = get_sync_schedule()
         for compute, hostname in (yield get_manageable_machines()):
-            targetkey = str(compute)
-            curtime = datetime.now().isoformat()
-
-            if (targetkey in self.outstanding_requests and self.outstanding_requests[targetkey][2] > 5):
-                log.msg('Killing all previous requests to %s (%s)' % (hostname, targetkey), system='sync')
-                self.outstanding_requests[targetkey][3].callback(None)
-                del self.outstanding_requests[targetkey]
-
-            if (targetkey not in self.outstanding_requests or self.outstanding_requests[targetkey][2] > 5):
-                log.msg('Pinging %s (%s)...' % (hostname, compute), system='sync')
-                pingtest = IPing(compute)
-                killhook = defer.Deferred()
-                deferred = pingtest.run(__killhook=killhook)
-                self.outstanding_requests[targetkey] = [deferred, curtime, 0, killhook]
-                deferred.addCallback(self.handle_success, 'ping test', hostname, compute, 'failure')
-                deferred.addErrback(self.handle_remote_error, hostname, compute, 'failure')
-                deferred.addErrback(self.handle_error, 'Ping test', hostname, compute, 'failure')
-
-                def sync_action(r, hostname, compute):
-                    return self.execute_sync_action(hostname, compute)
-
-                deferred.addCallback(sync_action, hostname, compute)
-            else:
-                log.msg("Pinging %s skipped: previous test not finished yet" % hostname, system='sync')
+            if not schedule.is_due(compute.__name__, hostname):
+                continue
+
+            deferred = self.scheduler.submit(str(compute), self.sync_host, hostname, compute)
+            if deferred is None:
+                log.msg("Syncing %s skipped: previous sync not finished yet" % hostname, system='sync')
+                continue
+
+            deferred.addErrback(handle_timeout, compute, hostname)
+            deferred.addErrback(log.err, system='sync')
 
     @defer.inlineCallbacks
     def gather_ippools(self):
@@ -288,3 +335,44 @@ class SyncDaemonProcess(DaemonProcess):
 
 
 provideSubscriptionAdapter(subscription_factory(SyncDaemonProcess), adapts=(Proc,))
+
+
+class IScheduledHost(Interface):
+    hostname = schema.TextLine(title=u"Hostname", readonly=True)
+    interval = schema.Float(title=u"Current sync interval (s)", readonly=True)
+    next_due = schema.TextLine(title=u"Next sync", readonly=True)
+    last_sync = schema.TextLine(title=u"Last sync", required=False, readonly=True)
+    last_touched = schema.Int(title=u"Objects touched by the last sync", required=False, readonly=True)
+    idle_streak = schema.Int(title=u"Consecutive syncs without changes", readonly=True)
+    failures = schema.Int(title=u"Consecutive failed syncs", readonly=True)
+
+
+class ScheduledHost(ReadonlyContainer):
+    implements(IScheduledHost)
+
+    def __init__(self, entry):
+        def timestamp(t):
+            return unicode(datetime.fromtimestamp(t).isoformat()) if t is not None else None
+
+        self.__name__ = entry.host
+        self.hostname = entry.hostname
+        self.interval = float(entry.interval)
+        self.next_due = timestamp(entry.next_due)
+        self.last_sync = timestamp(entry.last_sync)
+        self.last_touched = entry.last_touched
+        self.idle_streak = entry.idle_streak
+        self.failures = entry.failures
+
+
+class SyncSchedule(ReadonlyContainer):
+    """Current per-host sync schedule"""
+    __name__ = 'schedule'
+
+    @property
+    def _items(self):
+        return dict((entry.host, ScheduledHost(entry)) for entry in get_sync_schedule().entries())
+
+
+class SyncScheduleInjector(ContainerInjector):
+    context(SyncDaemonProcess)
+    __class__ = SyncSchedule
@@ -1,14 +1,20 @@
 import logging
 import netaddr
 import argparse
+import time
+
+from functools import partial
 
 from twisted.internet import defer
+from twisted.python import failure
 from twisted.python import log
 from zope.authentication.interfaces import IAuthentication
 from zope.component import getUtility
 
+from opennode.knot.backend.capabilities import capabilities, is_unsupported_error
 from opennode.knot.backend.compute import any_stack_installed
 from opennode.knot.backend.compute import ComputeAction
+from opennode.knot.backend.fingerprint import fingerprints, payload_digest, update_changed
 from opennode.knot.backend.operation import IAgentVersion
 from opennode.knot.backend.operation import IListVMS
 from opennode.knot.backend.operation import IGetComputeInfo
@@ -17,6 +23,8 @@ from opennode.knot.backend.operation import IGetLocalTemplates
 from opennode.knot.backend.operation import IGetRoutes
 from opennode.knot.backend.operation import IGetHWUptime
 from opennode.knot.backend.operation import IGetDiskUsage
+from opennode.knot.backend.operation import IGetInventory
+from opennode.knot.backend.operation import IHostInterfaces
 from opennode.knot.backend.operation import ISetOwner
 from opennode.knot.backend.operation import OperationRemoteError
 from opennode.knot.backend.syncvmsaction import SyncVmsAction
@@ -26,7 +34,7 @@ from opennode.knot.model.compute import IUndeployed, IDeployed, IDeploying
 from opennode.knot.model.compute import IVirtualCompute
 from opennode.knot.model.console import TtyConsole, SshConsole, OpenVzConsole, VncConsole
 from opennode.knot.model.network import NetworkInterface, NetworkRoute
-from opennode.knot.model.template import Template, Templates
+from opennode.knot.model.template import ITemplate, Template, Templates, catalogue_templates
 from opennode.knot.model.virtualizationcontainer import IVirtualizationContainer, VirtualizationContainer
 
 from opennode.oms.endpoint.ssh.cmdline import VirtualConsoleArgumentParser
@@ -41,6 +49,14 @@ from opennode.oms.util import get_u, get_i, get_f
 from opennode.oms.zodb import db
 
 
+# sync data names and the inventory sections providing them
+INVENTORY_SECTIONS = {'info': 'hardware_info',
+                      'uptime': 'host_uptime',
+                      'disk_usage': 'host_disk_usage',
+                      'containers': 'vm_autodetected_backends',
+                      'interfaces': 'host_interfaces'}
+
+
 class SyncAction(ComputeAction):
     """Force compute sync"""
     action('sync')
@@ -48,6 +64,8 @@ class SyncAction(ComputeAction):
     _do_not_enqueue = True
     _additional_keys = tuple()
     _full = False
+    _inventory = None
+    touched = 0
 
     @db.ro_transact(proxy=False)
     def subject(self, *args, **kwargs):
@@ -76,23 +94,30 @@ class SyncAction(ComputeAction):
             self._full = args.full
         log.msg('Executing SyncAction on %s (%s)' % (self.context, canonical_path(self.context)),
                  system='sync-action')
-
-        if any_stack_installed(self.context):
-            yield self.sync_agent_version(self._full)
-            yield self.sync_hw(self._full)
-            yield self.ensure_vms(self._full)
-            if self._full:
-                yield SyncTemplatesAction(self.context)._execute(DetachedProtocol(), object())
+        self.touched = 0
+        self.timings = []
+        self._inventory = None
+
+        remote = yield self.timed('fetch', self.fetch_remote, self._full)
+        for key in ('containers', 'virtual'):
+            if isinstance(remote.get(key), failure.Failure):
+                remote[key].raiseException()
+
+        hardware = None
+        stack_installed = any_stack_installed(self.context)
+        if stack_installed:
+            yield self.timed('agent-version', self.sync_agent_version, self._full, remote)
+            hardware = yield self.prepare_hw(self._full, remote)
         else:
             log.msg('No stacks installed on %s: %s' % (self.context, self.context.features))
 
-        default = yield self.default_console()
-        yield self.sync_consoles()
-
-        if IVirtualCompute.providedBy(self.context):
-            yield self._sync_virtual()
+        self.touched += yield self.timed('apply', self.apply, hardware, remote)
+        if hardware is not None and hardware[-1] is not None:
+            fingerprints.update((yield db.get(self.context, '__name__')), 'hardware', hardware[-1])
 
-        yield self._create_default_console(default)
+        if stack_installed and self._full:
+            yield self.timed('templates', SyncTemplatesAction(self.context)._execute,
+                             DetachedProtocol(), object())
 
         @db.transact
         def set_additional_keys():
@@ -105,18 +130,159 @@ class SyncAction(ComputeAction):
         if dl is not None:
             return
 
-        yield self.sync_vms()
+        yield self.timed('vms', self.sync_vms, remote)
+
+        log.msg('Sync of %s touched %s objects (%s)' % (self.context, self.touched, self.format_timings()),
+                system='sync-action')
+
+    @defer.inlineCallbacks
+    def timed(self, stage, fn, *args):
+        start = time.time()
+        try:
+            res = yield fn(*args)
+        finally:
+            self.timings.append((stage, time.time() - start))
+        defer.returnValue(res)
+
+    def format_timings(self):
+        return ', '.join('%s: %.2fs' % timing for timing in self.timings)
+
+    @db.ro_transact
+    def get_fetch_targets(self, full):
+        """Returns the virtualization containers of the host as (name, backend uri, container), whether
+        the list of containers must be fetched and the container of the compute if it is a VM"""
+        containers = [(vms.__name__, backends.get(vms.backend, vms.backend), vms)
+                      for vms in self.context.listcontent() if IVirtualizationContainer.providedBy(vms)]
+        parent = self.context.__parent__ if IVirtualCompute.providedBy(self.context) else None
+        # unless full sync, only when there are no virtualization containers available
+        return containers, full or not containers, parent
+
+    @defer.inlineCallbacks
+    def fetch_remote(self, full):
+        """Issues the remote calls of a sync concurrently, so that fetching takes as long as the slowest
+        call: the data of the host, the VM lists of its virtualization containers and, for a VM, the VM
+        list of its container. Returns the results by name; failed calls map to their failure"""
+        # XXX: Salt-specific
+        from opennode.knot.backend.salt import get_master_version
+
+        containers, needs_containers, parent = yield self.get_fetch_targets(full)
+
+        calls = {}
+        if any_stack_installed(self.context):
+            calls['info'] = IGetComputeInfo(self.context).run
+            calls['uptime'] = IGetHWUptime(self.context).run
+            calls['disk_usage'] = IGetDiskUsage(self.context).run
+
+            if full:
+                calls['agent_version'] = IAgentVersion(self.context).run
+                calls['master_version'] = get_master_version
+                calls['routes'] = IGetRoutes(self.context).run
+
+            if needs_containers:
+                calls['containers'] = IGetVirtualizationContainers(self.context).run
+
+            if containers:
+                calls['interfaces'] = IHostInterfaces(self.context).run
+            for name, uri, vms in containers:
+                calls['vms:%s' % name] = partial(IVirtualizationContainerSubmitter(vms).submit, IListVMS)
+
+        if parent is not None:
+            calls['virtual'] = partial(IVirtualizationContainerSubmitter(parent).submit, IListVMS)
+
+        sections = dict(INVENTORY_SECTIONS)
+        sections.update(('vms:%s' % name, ('vm_list_vms', uri)) for name, uri, vms in containers)
+
+        # the inventory is fetched along with the individual calls; those it covers are only left out
+        # once the agent is known to support it
+        covered = {}
+        if any_stack_installed(self.context) and IGetInventory(self.context, None) is not None:
+            host = yield db.get(self.context, '__name__')
+            if capabilities.supported(host, 'inventory'):
+                calls['inventory'] = self.fetch_inventory
+                if capabilities.known_supported(host, 'inventory'):
+                    covered = dict((name, calls.pop(name)) for name in sections if name in calls)
+
+        remote = yield self.fetch_calls(calls)
+        inventory = remote.pop('inventory', None)
+        if isinstance(inventory, failure.Failure):
+            log.msg('Inventory of %s failed, falling back: %s' % (self.context, inventory.getErrorMessage()),
+                    system='sync-action')
+        self._inventory = inventory if type(inventory) is dict else None
+
+        if self._inventory is not None:
+            for name, section in sections.iteritems():
+                data = self.inventory_section(section)
+                if ((name in calls or name in covered) and data is not None and
+                        (name not in remote or isinstance(remote[name], failure.Failure))):
+                    remote[name] = data
+
+        # the inventory failed after all, fall back to the individual calls
+        missing = dict((name, call) for name, call in covered.iteritems() if name not in remote)
+        if missing:
+            remote.update((yield self.fetch_calls(missing)))
+
+        defer.returnValue(remote)
+
+    @defer.inlineCallbacks
+    def fetch_calls(self, calls):
+        """Issues the calls concurrently, returns their results by name; failed calls map to their
+        failure"""
+        def timed_call(name):
+            start = time.time()
+            d = defer.maybeDeferred(calls[name])
+
+            def done(r):
+                self.timings.append(('fetch-%s' % name, time.time() - start))
+                return r
+            return d.addBoth(done)
+
+        names = calls.keys()
+        results = yield defer.DeferredList(map(timed_call, names), consumeErrors=True)
+        defer.returnValue(dict((name, result) for name, (success, result) in zip(names, results)))
+
+    def inventory_section(self, section):
+        """Returns a section of the inventory, given by name or by a path of names, or None"""
+        data = self._inventory
+        for name in (section if type(section) is tuple else (section,)):
+            if type(data) is not dict:
+                return
+            data = data.get(name)
+        return data
+
+    @defer.inlineCallbacks
+    def fetch_inventory(self):
+        """Fetches all the data of a host sync in a single call. Returns None if the agent does not
+        support it or the call fails, in which case the data is fetched with the individual calls"""
+        host = yield db.get(self.context, '__name__')
+        try:
+            inventory = yield IGetInventory(self.context).run()
+        except OperationRemoteError as e:
+            if is_unsupported_error(e):
+                capabilities.mark_unsupported(host, 'inventory')
+            else:
+                log.msg('Inventory of %s failed, falling back: %s' % (self.context, e), system='sync-action')
+            return
+
+        if type(inventory) is not dict:
+            log.msg('Unexpected inventory of %s: %s' % (self.context, type(inventory).__name__),
+                    system='sync-action', logLevel=logging.WARNING)
+            return
+
+        capabilities.mark_supported(host, 'inventory')
+        defer.returnValue(inventory)
 
     @defer.inlineCallbacks
-    def sync_agent_version(self, full):
+    def sync_agent_version(self, full, remote):
         if not full:
             return
 
         log.msg('Syncing version on %s...' % (self.context), system='sync-action')
-        minion_v = (yield IAgentVersion(self.context).run()).split('.')
-        # XXX: Salt-specific
-        from opennode.knot.backend.salt import get_master_version
-        master_v = (yield get_master_version()).split('.')
+        for key in ('agent_version', 'master_version'):
+            if isinstance(remote[key], failure.Failure):
+                remote[key].raiseException()
+
+        minion_v = remote['agent_version'].split('.')
+        master_v = remote['master_version'].split('.')
 
         if master_v[0] != minion_v[0]:
             @db.transact
@@ -141,10 +307,6 @@ class SyncAction(ComputeAction):
                     % (master_v, minion_v, self.context),
                     system='sync-action')
 
-    @db.ro_transact
-    def default_console(self):
-        return self._default_console()
-
     @db.assert_transact
     def _default_console(self):
         if self.context['consoles']:
@@ -154,19 +316,6 @@ class SyncAction(ComputeAction):
         if default:
             return default.target.__name__
 
-    @defer.inlineCallbacks
-    def _create_default_console(self, default):
-        @db.ro_transact
-        def check():
-            return not default or not self.context.consoles[default]
-
-        @db.transact
-        def create():
-            self.create_default_console(default)
-
-        if (yield check()):
-            yield create()
-
     @db.assert_transact
     def create_default_console(self, default):
         if not default or not self.context.consoles[default]:
@@ -179,10 +328,6 @@ class SyncAction(ComputeAction):
 
             self.context.consoles.add(Symlink('default', self.context.consoles[default]))
 
-    @db.transact
-    def sync_consoles(self):
-        return self._sync_consoles()
-
     @db.assert_transact
     def _sync_consoles(self):
         if self.context['consoles'] and self.context.consoles['ssh']:
@@ -203,41 +348,30 @@ class SyncAction(ComputeAction):
             if console.hostname != address:
                 console.hostname = address
 
-    @defer.inlineCallbacks
-    def _sync_virtual(self):
-        parent = yield db.get(self.context, '__parent__')
-        name = yield db.get(self.context, '__name__')
-        submitter = IVirtualizationContainerSubmitter(parent)
-        vmlist = yield submitter.submit(IListVMS)
-        for vm in vmlist:
-            if vm['uuid'] == name:
-                yield self.sync_owner(vm)
-                yield self._sync_vm(vm)
-
     @db.transact
-    def _sync_vm(self, vm):
-        return self.sync_vm(vm)
+    def apply(self, hardware, remote):
+        """Applies the fetched data of the host in a single transaction: hardware, new virtualization
+        containers, consoles and, for a VM, its state as reported by its container"""
+        default = self._default_console()
+        touched = 0
 
-    @defer.inlineCallbacks
-    def sync_owner(self, vm):
-        owner = yield db.get(self.context, '__owner__')
-        parent = yield db.get(self.context, '__parent__')
-        uuid = yield db.get(self.context, '__name__')
+        if hardware is not None:
+            touched += self._sync_hw(*hardware[:-1])
 
-        if vm.get('owner'):
-            if owner != vm['owner']:
-                @db.transaft
-                def pull_owner():
-                    compute = TmpObj(self.context)
-                    newowner = getUtility(IAuthentication).getPrincipal(vm['owner'])
-                    compute.__owner__ = newowner
-                    compute.apply()
-                yield pull_owner()
-        elif owner is not None:
-            log.msg('Attempting to push owner (%s) of %s to agent' % (owner, self.context), system='sync')
-            submitter = IVirtualizationContainerSubmitter(parent)
-            yield submitter.submit(ISetOwner, uuid, owner)
-            log.msg('Owner pushing for %s successful' % self.context, system='sync')
+        if any_stack_installed(self.context):
+            touched += self.add_containers(remote.get('containers'))
+
+        self._sync_consoles()
+
+        if IVirtualCompute.providedBy(self.context):
+            vm = next((vm for vm in remote.get('virtual') or [] if vm['uuid'] == self.context.__name__),
+                      None)
+            if vm is not None:
+                self.sync_owner_transact(vm)
+                touched += self.sync_vm(vm)
+
+        self.create_default_console(default)
+        return touched
 
     @db.assert_transact
     def sync_owner_transact(self, vm):
@@ -264,26 +398,28 @@ class SyncAction(ComputeAction):
 
     @db.assert_transact
     def sync_vm(self, vm):
+        """ Applies the agent-reported state of the VM. Returns the number of changes made """
         compute = TmpObj(self.context)
-        compute.state = unicode(vm['state'])
+        changed = update_changed(compute, {'state': unicode(vm['state'])})
 
         # Ensure IDeployed marker is set, unless not in another state
         if not IDeployed.providedBy(compute):
             noLongerProvides(self.context, IUndeployed)
             noLongerProvides(self.context, IDeploying)
             alsoProvides(self.context, IDeployed)
-
-        if 'ctid' in vm:
-            compute.ctid = vm['ctid'] if vm['ctid'] != '-' else -1
+            changed += 1
 
         for idx, console in enumerate(vm['consoles']):
             if console['type'] == 'pty' and not self.context.consoles['tty%s' % idx]:
                 self.context.consoles.add(TtyConsole('tty%s' % idx, console['pty']))
+                changed += 1
             if console['type'] == 'openvz' and not self.context.consoles['tty%s' % idx]:
                 self.context.consoles.add(OpenVzConsole('tty%s' % idx, console['cid']))
+                changed += 1
             if console['type'] == 'vnc' and not self.context.consoles['vnc']:
                 self.context.consoles.add(VncConsole(
                     self.context.__parent__.__parent__.hostname, int(console['port'])))
+                changed += 1
 
         # XXX TODO: handle removal of consoles when they are no longer reported from upstream
         # networks
@@ -293,12 +429,9 @@ class SyncAction(ComputeAction):
                 if 'ipv4_address' in interface:
                     iface.ipv4_address = interface['ipv4_address']
                 self.context.interfaces.add(iface)
+                changed += 1
 
         # XXX TODO: handle removal of interfaces when they are no longer reported from upstream
-        # XXX hack, openvz specific
-        compute.cpu_info = self.context.__parent__.__parent__.cpu_info
-        compute.memory = vm['memory']
-
         diskspace = dict((unicode(k), v) for k, v in vm['diskspace'].items())
         diskspace[u'total'] = sum([0.0] + vm['diskspace'].values())
 
@@ -306,34 +439,39 @@ class SyncAction(ComputeAction):
         for i in diskspace:
             diskspace[i] = round(diskspace[i], 2)
 
-        compute.diskspace = diskspace
-
-        if compute.state == 'active':
-            compute.uptime = get_f(vm, 'uptime')
-        else:
-            compute.uptime = None
+        # XXX hack, openvz specific
+        values = {'cpu_info': self.context.__parent__.__parent__.cpu_info,
+                  'memory': vm['memory'],
+                  'diskspace': diskspace,
+                  'uptime': get_f(vm, 'uptime') if vm['state'] == 'active' else None,
+                  'num_cores': vm['vcpu'],
+                  'swap_size': vm.get('swap') or compute.swap_size,
+                  'kernel': vm.get('kernel') or compute.kernel}
 
-        compute.num_cores = vm['vcpu']
-        compute.swap_size = vm.get('swap') or compute.swap_size
-        compute.kernel = vm.get('kernel') or compute.kernel
+        if 'ctid' in vm:
+            values['ctid'] = vm['ctid'] if vm['ctid'] != '-' else -1
 
+        changed += update_changed(compute, values)
         compute.apply()
+        return changed
 
     @defer.inlineCallbacks
-    def sync_hw(self, full):
-        if not any_stack_installed(self.context):
-            return
-
+    def prepare_hw(self, full, remote):
+        """Checks the fetched hardware data of the host. Returns the arguments of `_sync_hw` followed by
+        the digest of the hardware data, or None if there is nothing to apply. When the hardware data is
+        unchanged, only the disk usage is passed on, without a digest"""
         try:
-            info = yield IGetComputeInfo(self.context).run()
-            uptime = yield IGetHWUptime(self.context).run()
-            disk_usage = yield IGetDiskUsage(self.context).run()
+            for key in ('info', 'uptime', 'disk_usage'):
+                if isinstance(remote.get(key), failure.Failure):
+                    remote[key].raiseException()
         except OperationRemoteError as e:
             log.msg(e.message, system='sync-hw')
             if e.remote_tb:
                 log.msg(e.remote_tb, system='sync-hw')
             return
 
+        info, uptime, disk_usage = remote['info'], remote['uptime'], remote['disk_usage']
+
         # TODO: Improve error handling
         def disk_info(aspect):
             res = dict((unicode(k), round(float(v[aspect]) / 1024, 2))
@@ -342,32 +480,54 @@ class SyncAction(ComputeAction):
             res[u'total'] = sum([0.0] + res.values())
             return res
 
-        routes = yield IGetRoutes(self.context).run() if full else []
+        routes = remote.get('routes', [])
+        if isinstance(routes, failure.Failure):
+            # routes are optional, the known ones are kept
+            log.msg('Could not fetch the routes of %s: %s' % (self.context, routes.getErrorMessage()),
+                    system='sync-hw')
+            routes = []
 
-        yield self._sync_hw(info, disk_info('total'), disk_info('used'), routes, uptime)
+        disk_space = disk_info('total')
+        disk_used = disk_info('used')
 
-    @db.transact
+        host = yield db.get(self.context, '__name__')
+        # the used disk space changes between syncs, so it is left out of the digest
+        digest = payload_digest((info, disk_space, routes))
+        if not full and fingerprints.unchanged(host, 'hardware', digest):
+            log.msg('Hardware info of %s is unchanged' % self.context, system='sync-hw',
+                    logLevel=logging.DEBUG)
+            defer.returnValue((None, None, disk_used, None, None, None))
+
+        defer.returnValue((info, disk_space, disk_used, routes, uptime, digest))
+
+    @db.assert_transact
     def _sync_hw(self, info, disk_space, disk_usage, routes, uptime):
-        self.context.uptime = uptime
+        touched = update_changed(self.context, {'diskspace_usage': disk_usage})
+        if info is None:
+            # unchanged hardware, see `prepare_hw`
+            return touched
+
+        touched += update_changed(self.context, {'uptime': uptime})
 
         if any((not info, 'cpuModel' not in info, 'kernelVersion' not in info)):
             log.msg('Nothing to update: info does not include required data', system='sync-hw')
-            return
+            return touched
+
+        values = {'architecture': (unicode(info['platform']), u'linux', self.distro(info)),
+                  'kernel': unicode(info['kernelVersion']),
+                  'memory': info['systemMemory'],
+                  'num_cores': info['numCpus'],
+                  'os_release': unicode(info['os']),
+                  'swap_size': info['systemSwap'],
+                  'diskspace': disk_space,
+                  'template': u'Hardware node'}
 
         if IVirtualCompute.providedBy(self.context):
-            self.context.cpu_info = self.context.__parent__.__parent__.cpu_info
+            values['cpu_info'] = self.context.__parent__.__parent__.cpu_info
         else:
-            self.context.cpu_info = unicode(info['cpuModel'])
-
-        self.context.architecture = (unicode(info['platform']), u'linux', self.distro(info))
-        self.context.kernel = unicode(info['kernelVersion'])
-        self.context.memory = info['systemMemory']
-        self.context.num_cores = info['numCpus']
-        self.context.os_release = unicode(info['os'])
-        self.context.swap_size = info['systemSwap']
-        self.context.diskspace = disk_space
-        self.context.diskspace_usage = disk_usage
-        self.context.template = u'Hardware node'
+            values['cpu_info'] = unicode(info['cpuModel'])
+
+        touched = 1 if update_changed(self.context, values) or touched else 0
 
         # XXX TODO: handle removal of routes
         for r in routes:
@@ -391,6 +551,9 @@ class SyncAction(ComputeAction):
                 route.add(Symlink('interface', interface))
 
             self.context.routes.add(route)
+            touched += 1
+
+        return touched
 
     def distro(self, info):
         if 'os' in info:
@@ -398,46 +561,67 @@ class SyncAction(ComputeAction):
         else:
             return 'Unknown'
 
-    @defer.inlineCallbacks
-    def ensure_vms(self, full):
-        if (not any_stack_installed(self.context) or
-            # if not full sync and there are virtualization containers available
-            (not full and len(filter(lambda n: 'vms' in n, self.context.listnames())) > 0)):
-            return
-
-        vms_types = yield IGetVirtualizationContainers(self.context).run()
-
+    @db.assert_transact
+    def add_containers(self, vms_types):
+        """Adds the virtualization containers reported by the agent that are missing"""
         if not vms_types:
-            return
+            return 0
 
         url_to_backend_type = dict((v, k) for k, v in backends.items())
+        touched = 0
 
-        @db.transact
-        def add_container(backend_type):
-            log.msg('Adding backend %s' % backend_type, system='sync')
-            vms = VirtualizationContainer(unicode(backend_type))
+        for vms_type in vms_types:
+            backend_type = url_to_backend_type.get(vms_type)
+            if not backend_type:
+                log.msg('Unrecognized backend: %s. Skipping' % vms_type, system='sync')
+                continue
 
+            vms = VirtualizationContainer(unicode(backend_type))
             if vms.__name__ in self.context.listnames():
-                return
+                continue
 
+            log.msg('Adding backend %s' % backend_type, system='sync')
             self.context.add(vms)
             if not self.context['vms']:
                 self.context.add(Symlink('vms', self.context[vms.__name__]))
+            touched += 1
 
-        for vms_type in vms_types:
-            backend_type = url_to_backend_type.get(vms_type)
-            if not backend_type:
-                log.msg('Unrecognized backend: %s. Skipping' % vms_type, system='sync')
-                continue
-
-            yield add_container(backend_type)
+        return touched
 
     @defer.inlineCallbacks
-    def sync_vms(self):
-        for vms in self.context.listcontent():
-            if not IVirtualizationContainer.providedBy(vms):
-                continue
-            yield SyncVmsAction(vms)._execute(DetachedProtocol(), object())
+    def sync_vms(self, remote):
+        """Applies the VM lists of all the virtualization containers of the host in a single transaction.
+        The lists of containers added by this sync were not fetched with the rest, they are fetched now"""
+        @db.ro_transact
+        def get_containers():
+            return [(vms.__name__, vms) for vms in self.context.listcontent()
+                    if IVirtualizationContainer.providedBy(vms)]
+
+        actions = []
+        for name, vms in (yield get_containers()):
+            action = SyncVmsAction(vms)
+            action._full = self._full
+            action._ifaces = remote.get('interfaces')
+            action._remote_vms = remote.get('vms:%s' % name)
+            # the interfaces of the host are synced once
+            action._with_ifaces = not actions
+            actions.append(action)
+
+        results = yield defer.DeferredList([action.fetch() for action in actions], consumeErrors=True)
+        fetched = [action for action, (success, result) in zip(actions, results) if success]
+
+        self.touched += yield self.apply_vms(fetched)
+        for action in fetched:
+            action.update_fingerprints()
+
+        # the containers that could be fetched are synced, but the sync still fails
+        for success, result in results:
+            if not success:
+                result.raiseException()
+
+    @db.transact
+    def apply_vms(self, actions):
+        return sum(action.apply_transact() for action in actions)
 
 
 class SyncTemplatesAction(ComputeAction):
@@ -459,6 +643,7 @@ class SyncTemplatesAction(ComputeAction):
                 container.add(Templates())
 
             template_container = container['templates']
+            touched = 0
 
             for template in templates:
                 name = template['template_name']
@@ -467,26 +652,27 @@ class SyncTemplatesAction(ComputeAction):
                     template_container.add(Template(unicode(name), get_u(template, 'domain_type')))
 
                 t = template_container['by-name'][name].target
-                t.cores = (get_i(template, 'vcpu_min'),
-                           get_i(template, 'vcpu'),
-                           max(-1, get_i(template, 'vcpu_max')))
-                t.memory = (get_f(template, 'memory_min'),
-                            get_f(template, 'memory'),
-                            max(-1.0, get_f(template, 'memory_max')))
-                t.swap = (get_f(template, 'swap_min'),
-                          get_f(template, 'swap'),
-                          max(-1.0, get_f(template, 'swap_max')))
-                t.disk = (get_f(template, 'disk_min'),
-                          get_f(template, 'disk'),
-                          max(-1.0, get_f(template, 'disk_max')))
-                t.nameserver = get_u(template, 'nameserver')
-
-                t.username = get_u(template, 'username')
-                t.password = get_u(template, 'passwd')
-
-                t.cpu_limit = (get_i(template, 'vcpulimit_min'),
-                               get_i(template, 'vcpulimit'))
-                t.ip = get_u(template, 'ip_address')
+                values = {'cores': (get_i(template, 'vcpu_min'),
+                                    get_i(template, 'vcpu'),
+                                    max(-1, get_i(template, 'vcpu_max'))),
+                          'memory': (get_f(template, 'memory_min'),
+                                     get_f(template, 'memory'),
+                                     max(-1.0, get_f(template, 'memory_max'))),
+                          'swap': (get_f(template, 'swap_min'),
+                                   get_f(template, 'swap'),
+                                   max(-1.0, get_f(template, 'swap_max'))),
+                          'disk': (get_f(template, 'disk_min'),
+                                   get_f(template, 'disk'),
+                                   max(-1.0, get_f(template, 'disk_max'))),
+                          'nameserver': get_u(template, 'nameserver'),
+                          'username': get_u(template, 'username'),
+                          'password': get_u(template, 'passwd'),
+                          'cpu_limit': (get_i(template, 'vcpulimit_min'),
+                                        get_i(template, 'vcpulimit')),
+                          'ip': get_u(template, 'ip_address')}
+
+                if update_changed(t, values):
+                    touched += 1
 
             # delete templates no more offered upstream
             template_names = template_container['by-name'].listnames()
@@ -495,6 +681,14 @@ class SyncTemplatesAction(ComputeAction):
 
             for template in vanished_template_names:
                 template_container.remove(follow_symlinks(template_container['by-name'][template]))
+                touched += 1
+
+            catalogue_templates(self.context.__name__, container.backend,
+                                dict((t.name, t) for t in template_container.listcontent()
+                                     if ITemplate.providedBy(t)))
+            return touched
+
+        host = yield db.get(self.context, '__name__')
 
         for container in self.context.listcontent():
             if not IVirtualizationContainer.providedBy(container):
@@ -508,7 +702,17 @@ class SyncTemplatesAction(ComputeAction):
                         system='sync-templates')
                 continue
 
+            section = 'templates-%s' % container.__name__
+            digest = payload_digest(templates)
+            if fingerprints.unchanged(host, section, digest):
+                log.msg('Templates on %s (%s) are unchanged' % (self.context, container),
+                        system='sync-templates', logLevel=logging.DEBUG)
+                continue
+
             log.msg('Synced templates on %s (%s). Updating %s templates' %
                     (self.context, container, len(templates)), system='sync-templates')
 
-            yield update_templates(container, templates)
+            touched = yield update_templates(container, templates)
+            fingerprints.update(host, section, digest)
+            log.msg('Templates sync on %s (%s) touched %s objects' % (self.context, container, touched),
+                    system='sync-templates')
@@ -0,0 +1,95 @@
+import time
+
+from opennode.oms.config import get_config
+
+
+class ScheduleEntry(object):
+
+    def __init__(self, host, hostname, interval, now):
+        self.host = host
+        self.hostname = hostname
+        self.interval = interval
+        self.next_due = now
+        self.last_sync = None
+        self.last_touched = None
+        self.idle_streak = 0
+        self.failures = 0
+
+
+class AdaptiveSyncSchedule(object):
+    """Per-host next-due times for host syncs.
+
+    A host is synced again after `min_interval` seconds. Its interval is multiplied by `backoff` after
+    each sync that changed nothing or failed, up to `max_interval`, and reset to `min_interval` when a
+    sync finds changes or a user action touched the host.
+
+    """
+
+    def __init__(self, min_interval, max_interval, backoff=2.0, clock=time.time):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = max(1.0, backoff)
+        self.clock = clock
+        self._entries = {}
+
+    def entries(self):
+        return self._entries.values()
+
+    def get(self, host):
+        return self._entries.get(host)
+
+    def is_due(self, host, hostname=None):
+        entry = self._entries.get(host)
+        if entry is None:
+            entry = self._entries[host] = ScheduleEntry(host, hostname, self.min_interval, self.clock())
+        return entry.next_due <= self.clock()
+
+    def record(self, host, hostname, touched, failed):
+        now = self.clock()
+        entry = self._entries.get(host)
+        if entry is None:
+            entry = self._entries[host] = ScheduleEntry(host, hostname, self.min_interval, now)
+
+        entry.last_sync = now
+        entry.last_touched = touched
+
+        if failed:
+            entry.failures += 1
+            entry.interval = min(self.max_interval, entry.interval * self.backoff)
+        elif touched:
+            entry.failures = 0
+            entry.idle_streak = 0
+            entry.interval = self.min_interval
+        else:
+            entry.failures = 0
+            entry.idle_streak += 1
+            entry.interval = min(self.max_interval, entry.interval * self.backoff)
+
+        entry.next_due = now + entry.interval
+        return entry
+
+    def expedite(self, host):
+        """Makes the host due at the next check and resets its interval"""
+        entry = self._entries.get(host)
+        if entry is None:
+            return
+
+        entry.idle_streak = 0
+        entry.interval = self.min_interval
+        entry.next_due = self.clock()
+
+    def forget(self, host):
+        self._entries.pop(host, None)
+
+
+_schedule = None
+
+
+def get_sync_schedule():
+    global _schedule
+    if _schedule is None:
+        config = get_config()
+        _schedule = AdaptiveSyncSchedule(config.getint('sync', 'min_interval'),
+                                         config.getint('sync', 'max_interval'),
+                                         float(config.getstring('sync', 'backoff', '2')))
+    return _schedule
@@ -1,5 +1,6 @@
 from grokcore.component import context
 from twisted.internet import defer
+from twisted.python import failure
 from twisted.python import log
 from zope.component import handle
 
@@ -9,18 +10,20 @@ from opennode.knot.backend.operation import IHostInterfaces
 from opennode.knot.backend.operation import IListVMS
 from opennode.knot.backend.v12ncontainer import IVirtualizationContainerSubmitter
 from opennode.knot.backend.compute import ComputeAction
+from opennode.knot.backend.fingerprint import fingerprints, payload_digest, update_changed
 from opennode.knot.model.compute import Compute, IVirtualCompute
 from opennode.knot.model.compute import IUndeployed, IDeployed, IDeploying
 from opennode.knot.model.compute import IManageable
+from opennode.knot.model.computes import index_compute, query_computes
 from opennode.knot.model.network import NetworkInterface, BridgeInterface
 from opennode.knot.model.virtualizationcontainer import IVirtualizationContainer
+from opennode.knot.utils.vmdiff import diff_vms
 
 from opennode.oms.config import get_config
 from opennode.oms.model.form import alsoProvides
 from opennode.oms.model.form import noLongerProvides
 from opennode.oms.model.model.actions import action
 from opennode.oms.model.model.events import ModelDeletedEvent
-from opennode.oms.model.model.symlink import follow_symlinks
 from opennode.oms.model.model.symlink import Symlink
 from opennode.oms.model.traversal import canonical_path
 from opennode.oms.zodb import db
@@ -32,6 +35,15 @@ class SyncVmsAction(ComputeAction):
 
     action('sync')
 
+    _full = False
+    _host = None
+    # data fetched by the host sync along with its other remote calls, if any; a failure when the call
+    # failed
+    _ifaces = None
+    _remote_vms = None
+    # whether the interfaces of the host are synced along with the VMs
+    _with_ifaces = True
+
     @db.ro_transact(proxy=False)
     def subject(self, *args, **kwargs):
         return tuple((self.context.__parent__,))
@@ -45,37 +57,98 @@ class SyncVmsAction(ComputeAction):
 
     @defer.inlineCallbacks
     def _execute(self, cmd, args):
+        yield self.fetch()
+        touched = yield self.apply()
+        self.update_fingerprints()
+        defer.returnValue(touched)
+
+    @defer.inlineCallbacks
+    def fetch(self):
+        """Fetches the data not fetched by the host sync and checks what changed since the last sync.
+        Applying the changes is left to `apply`"""
         @db.ro_transact
         def get_ifaces_job():
             host_compute = self.context.__parent__
             return IHostInterfaces(host_compute)
 
-        ifaces = yield (yield get_ifaces_job()).run()
-
-        yield self._sync_ifaces(ifaces)
-
-        yield self._sync_vms(cmd)
-
-    @defer.inlineCallbacks
-    def _sync_vms(self, cmd):
-        submitter = IVirtualizationContainerSubmitter(self.context)
-        remote_vms = yield submitter.submit(IListVMS)
-        yield self._sync_vms_transact(remote_vms)
+        @db.ro_transact
+        def get_names():
+            return self.context.__parent__.__name__, self.context.__name__
+
+        self._host, self._name = yield get_names()
+
+        if self._with_ifaces and self._ifaces is None:
+            self._ifaces = yield (yield get_ifaces_job()).run()
+        if self._remote_vms is None:
+            submitter = IVirtualizationContainerSubmitter(self.context)
+            self._remote_vms = yield submitter.submit(IListVMS)
+
+        for data in (self._ifaces, self._remote_vms):
+            if isinstance(data, failure.Failure):
+                data.raiseException()
+
+        self._ifaces_digest = None
+        if self._with_ifaces:
+            digest = payload_digest(self._ifaces)
+            if self._full or not fingerprints.unchanged(self._host, 'interfaces', digest):
+                self._ifaces_digest = digest
+
+        self._vms_digest = None
+        self._vm_digests = {}
+        digest = payload_digest(self._remote_vms)
+        if self._full or not fingerprints.unchanged(self._host, 'vms-%s' % self._name, digest):
+            self._vms_digest = digest
+            self._vm_digests = dict((vm['uuid'], payload_digest(vm)) for vm in self._remote_vms)
+        else:
+            log.msg('VM list of %s is unchanged' % self.context, system='sync-vms', logLevel=logging.DEBUG)
 
     @db.transact
-    def _sync_vms_transact(self, remote_vms):
-        local_vms = [i for i in self.context.listcontent() if IVirtualCompute.providedBy(i)]
-
-        remote_uuids = set(i['uuid'] for i in remote_vms)
-        local_uuids = set(i.__name__ for i in local_vms)
+    def apply(self):
+        return self.apply_transact()
+
+    @db.assert_transact
+    def apply_transact(self):
+        """Applies the fetched changes, returns the number of objects touched"""
+        touched = 0
+        if self._ifaces_digest is not None:
+            touched += self._sync_ifaces(self._ifaces)
+        if self._vms_digest is not None:
+            touched += self._sync_vms(self._remote_vms, self._vm_digests)
+            log.msg('VM sync of %s touched %s objects' % (self.context, touched), system='sync-vms')
+        return touched
+
+    def update_fingerprints(self):
+        """Remembers the applied data, once the transaction applying it is committed"""
+        if self._ifaces_digest is not None:
+            fingerprints.update(self._host, 'interfaces', self._ifaces_digest)
+        if self._vms_digest is not None:
+            for vm_uuid, vm_digest in self._vm_digests.iteritems():
+                fingerprints.update(self._host, 'vm:%s' % vm_uuid, vm_digest)
+            fingerprints.update(self._host, 'vms-%s' % self._name, self._vms_digest)
+
+    def _is_unchanged(self, vm_digests):
+        def is_unchanged(vm_uuid, remote_vm):
+            vm_digest = vm_digests.get(vm_uuid)
+            return (not self._full and vm_digest is not None and
+                    fingerprints.unchanged(self._host, 'vm:%s' % vm_uuid, vm_digest))
+        return is_unchanged
+
+    @db.assert_transact
+    def _sync_vms(self, remote_vms, vm_digests):
+        touched = 0
+        local_uuids = [i.__name__ for i in self.context.listcontent() if IVirtualCompute.providedBy(i)]
+
+        diff = diff_vms(remote_vms, local_uuids, self._is_unchanged(vm_digests))
+        log.msg('VM diff of %s: %s' % (self.context, diff), system='sync-vms', logLevel=logging.DEBUG)
 
         root = db.get_root()['oms_root']
         machines = root['machines']
 
-        for vm_uuid in remote_uuids.difference(local_uuids):
-            remote_vm = [rvm for rvm in remote_vms if rvm['uuid'] == vm_uuid][0]
+        for vm_uuid in diff.added:
+            remote_vm = diff.remote[vm_uuid]
 
-            existing_machine = follow_symlinks(machines['by-name'][remote_vm['name']])
+            existing_machine = next((m for m in query_computes(hostname=unicode(remote_vm['name']))
+                                     if m.__parent__ is machines), None)
             if existing_machine:
                 # XXX: this VM is a nested VM, for now let's hack it this way
                 new_compute = Symlink(existing_machine.__name__, existing_machine)
@@ -91,25 +164,36 @@ class SyncVmsAction(ComputeAction):
                 # XXX: not sure if removing a parent interface will remove the child also
                 noLongerProvides(new_compute, IManageable)
                 self.context.add(new_compute)
+                index_compute(new_compute)
+            touched += 1
 
-        for vm_uuid in remote_uuids.intersection(local_uuids):
-            noLongerProvides(self.context[vm_uuid], IUndeployed)
-            alsoProvides(self.context[vm_uuid], IDeployed)
+        for vm_uuid in diff.changed + diff.unchanged:
+            compute = self.context[vm_uuid]
+            if IUndeployed.providedBy(compute) or not IDeployed.providedBy(compute):
+                noLongerProvides(compute, IUndeployed)
+                alsoProvides(compute, IDeployed)
+                touched += 1
 
-        for vm_uuid in local_uuids.difference(remote_uuids):
+        for vm_uuid in diff.removed:
             if IDeploying.providedBy(self.context[vm_uuid]):
                 log.msg("Don't delete undeployed VM while in IDeploying state", system='v12n')
                 continue
 
-            noLongerProvides(self.context[vm_uuid], IDeployed)
-            alsoProvides(self.context[vm_uuid], IUndeployed)
-            self.context[vm_uuid].state = u'inactive'
+            fingerprints.forget(self._host, 'vm:%s' % vm_uuid)
+
+            compute = self.context[vm_uuid]
+            if (IDeployed.providedBy(compute) or not IUndeployed.providedBy(compute)
+                    or compute.state != u'inactive'):
+                noLongerProvides(compute, IDeployed)
+                alsoProvides(compute, IUndeployed)
+                update_changed(compute, {'state': u'inactive'})
+                touched += 1
 
             if get_config().getboolean('sync', 'delete_on_sync'):
                 log.msg("Deleting compute %s" % vm_uuid, system='v12n')
-                compute = self.context[vm_uuid]
                 del self.context[vm_uuid]
                 handle(compute, ModelDeletedEvent(self.context))
+                touched += 1
 
         # TODO: eliminate cross-import between compute and v12ncontainer
         from opennode.knot.backend.compute import ICompute
@@ -117,7 +201,7 @@ class SyncVmsAction(ComputeAction):
 
         # sync each vm
         for compute in self.context.listcontent():
-            if not IVirtualCompute.providedBy(compute):
+            if not IVirtualCompute.providedBy(compute) or not diff.needs_sync(compute.__name__):
                 continue
 
             log.msg('Attempting to sync %s' % compute, system='sync-vms')
@@ -135,27 +219,25 @@ class SyncVmsAction(ComputeAction):
                         system='sync-vms', logLevel=logging.WARNING)
 
                 if not ICompute.providedBy(compute.__parent__.__parent__):
-                    return
+                    return touched
 
             action = SyncAction(compute)
-
-            matching = [rvm for rvm in remote_vms if rvm['uuid'] == compute.__name__]
-
-            if not matching:
-                continue
-
-            remote_vm = matching[0]
+            remote_vm = diff.remote[compute.__name__]
 
             # todo delegate all this into the action itself
             default_console = action._default_console()
             action._sync_consoles()
             action.sync_owner_transact(remote_vm)
-            action.sync_vm(remote_vm)
+            if action.sync_vm(remote_vm):
+                touched += 1
             action.create_default_console(default_console)
 
-    @db.transact
+        return touched
+
+    @db.assert_transact
     def _sync_ifaces(self, ifaces):
         host_compute = self.context.__parent__
+        touched = 0
 
         local_interfaces = host_compute.interfaces
         local_names = set(i.__name__ for i in local_interfaces)
@@ -180,22 +262,29 @@ class SyncVmsAction(ComputeAction):
                 iface_node.primary = True
 
             host_compute.interfaces.add(iface_node)
+            touched += 1
 
         # modify interfaces
         for iface_name in remote_names.intersection(local_names):
             interface = ifaces_by_name[iface_name]
             iface_node = local_interfaces[iface_name]
-            iface_node.ipv4_address = interface['ip'] if 'ip' in interface else ''
-            iface_node.hw_address = interface['mac'] if 'mac' in interface else ''
+            values = {'ipv4_address': interface['ip'] if 'ip' in interface else '',
+                      'hw_address': interface['mac'] if 'mac' in interface else ''}
 
             if interface.get('primary'):
-                iface_node.primary = True
+                values['primary'] = True
 
             # Currently doesn't handle when an interface changes type
             # it would be easier to have a code path that treats it as a removal + addition
             if interface['type'] == 'bridge' and isinstance(iface_node, BridgeInterface):
-                iface_node.members = interface['members']
+                values['members'] = interface['members']
+
+            if update_changed(iface_node, values):
+                touched += 1
 
         # remove interfaces
         for iface_name in local_names.difference(remote_names):
             del local_interfaces[iface_name]
+            touched += 1
+
+        return touched
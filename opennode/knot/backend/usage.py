@@ -0,0 +1,123 @@
+import logging
+import time
+
+from twisted.internet import defer
+from twisted.python import log
+
+from opennode.knot.backend.fingerprint import update_changed
+from opennode.knot.model.compute import ICompute
+from opennode.oms.config import get_config
+from opennode.oms.model.traversal import traverse1
+from opennode.oms.zodb import db
+
+
+# diskspace_usage is owned by the hardware sync, which knows the partitions of the host
+USAGE_FIELDS = ('cpu_usage', 'memory_usage', 'network_usage')
+
+
+def ewma(previous, value, alpha):
+    """Exponentially weighted moving average of numbers, tuples of numbers or dicts of numbers"""
+    if isinstance(value, dict):
+        previous = previous if isinstance(previous, dict) else {}
+        return dict((k, ewma(previous.get(k), v, alpha)) for k, v in value.iteritems())
+
+    if isinstance(value, (tuple, list)):
+        if not isinstance(previous, tuple) or len(previous) != len(value):
+            previous = (None,) * len(value)
+        return tuple(ewma(p, v, alpha) for p, v in zip(previous, value))
+
+    if not isinstance(value, (int, long, float)):
+        return value
+
+    if previous is None:
+        return float(value)
+    return alpha * value + (1 - alpha) * previous
+
+
+def rounded(value, digits=2):
+    """Rounds the numbers in the value, so that negligible changes do not cause DB writes"""
+    if isinstance(value, dict):
+        return dict((k, rounded(v, digits)) for k, v in value.iteritems())
+    if isinstance(value, tuple):
+        return tuple(rounded(v, digits) for v in value)
+    if isinstance(value, float):
+        return round(value, digits)
+    return value
+
+
+class UsageUpdater(object):
+    """Folds the metric samples of computes into their usage attributes (cpu_usage, memory_usage and
+    network_usage).
+
+    Samples are smoothed with an EWMA of weight `alpha` as they are ingested; the computes that received
+    samples are written at most every `interval` seconds, all in a single transaction. Samples whose
+    shape does not match the schema of the attribute (e.g. a scalar cpu_usage) are ignored.
+
+    """
+
+    def __init__(self, alpha=0.3, interval=10, clock=time.time):
+        self.alpha = alpha
+        self.interval = interval
+        self.clock = clock
+        self.smoothed = {}
+        self.dirty = set()
+        self.last_write = None
+
+    def observe(self, path, data_points):
+        compute_path, sep, field = path.rpartition('/metrics/')
+        if not sep or field not in USAGE_FIELDS:
+            return
+
+        kind = ICompute[field]._type
+        values = self.smoothed.setdefault(compute_path, {})
+        for timestamp, value in data_points:
+            # without a previous value ewma only normalizes the sample: lists to tuples, numbers to floats
+            if not isinstance(ewma(None, value, self.alpha), kind):
+                log.msg('Ignoring %s sample of %s: %r' % (field, compute_path, value),
+                        system='metrics-usage', logLevel=logging.DEBUG)
+                continue
+            values[field] = ewma(values.get(field), value, self.alpha)
+            self.dirty.add(compute_path)
+
+    def is_due(self):
+        return self.last_write is None or self.clock() - self.last_write >= self.interval
+
+    @defer.inlineCallbacks
+    def flush(self, force=False):
+        if not self.dirty or not (force or self.is_due()):
+            return
+
+        self.last_write = self.clock()
+        dirty, self.dirty = self.dirty, set()
+        updates = dict((path, rounded(self.smoothed[path])) for path in dirty)
+
+        written, missing = yield self._write(updates)
+        for path in missing:
+            self.smoothed.pop(path, None)
+
+        log.msg('Usage of %s computes updated (%s attributes written)' % (len(updates), written),
+                system='metrics-usage', logLevel=logging.DEBUG)
+
+    @db.transact
+    def _write(self, updates):
+        written = 0
+        missing = []
+        for path, values in updates.iteritems():
+            compute = traverse1(path)
+            if compute is None:
+                missing.append(path)
+                continue
+            written += update_changed(compute, values)
+        return written, missing
+
+
+_updater = None
+
+
+def get_usage_updater():
+    global _updater
+    if _updater is None:
+        config = get_config()
+        _updater = UsageUpdater(float(config.getstring('metrics', 'usage_alpha', '0.3')),
+                                config.getint('metrics', 'usage_interval'))
+    return _updater
@@ -1,22 +1,33 @@
 import json
+import time
+from uuid import uuid4
 
-from grokcore.component import context
+from grokcore.component import context, name
+from twisted.internet import defer
+from twisted.python import failure, log
 from twisted.web.server import NOT_DONE_YET
 from zope.authentication.interfaces import IAuthentication
-from zope.component import getUtility
+from zope.component import getUtility, handle
 
-from opennode.knot.model.compute import Compute, IVirtualCompute
-from opennode.knot.model.hangar import Hangar
+from opennode.knot.backend.bulkallocate import BulkAllocation, bulk_created
+from opennode.knot.backend.metricsquery import AGGREGATIONS, query_metrics
+from opennode.knot.model.compute import Compute, ICompute, IVirtualCompute
+from opennode.knot.model.computes import Computes
+from opennode.knot.model.hangar import Hangar, IHangar
 from opennode.knot.model.machines import Machines
 from opennode.knot.model.virtualizationcontainer import VirtualizationContainer
-from opennode.oms.endpoint.httprest.base import IHttpRestView
+from opennode.oms.endpoint.httprest.base import HttpRestView, IHttpRestView
 from opennode.oms.endpoint.httprest.root import BadRequest
 from opennode.oms.endpoint.httprest.view import ContainerView
 from opennode.oms.log import UserLogger
 from opennode.oms.model.form import RawDataValidatingFactory
 from opennode.oms.model.model.actions import ActionsContainer
+from opennode.oms.model.model.events import ModelDeletedEvent
 from opennode.oms.model.model.hooks import PreValidateHookMixin
+from opennode.oms.model.model.search import ITagged
 from opennode.oms.model.model.stream import Metrics
+from opennode.oms.model.model.symlink import follow_symlinks
+from opennode.oms.model.traversal import canonical_path, traverse1
 from opennode.oms.util import JsonSetEncoder
 from opennode.oms.zodb import db
 
@@ -41,9 +52,55 @@ class VirtualizationContainerView(ContainerView, PreValidateHookMixin):
         except ValueError:
             raise BadRequest("Input data could not be parsed")
 
+        if isinstance(data, list):
+            return self.render_bulk_POST(request, data)
+
         if not isinstance(data, dict):
-            raise BadRequest("Input data must be a dictionary")
+            raise BadRequest("Input data must be a dictionary or a list of dictionaries")
+
+        form, root_password, errors = self.prepare_form(data)
+        if errors:
+            return {'success': False, 'errors': errors}
+
+        compute = form.create()
+
+        principal = self.get_principal(request)
+
+        @db.transact
+        def handle_success(r, compute, principal):
+            compute.__owner__ = principal
+
+            compute.root_password = root_password
+            self.context.add(compute)
+
+            data['id'] = compute.__name__
+
+            self.add_log_event(principal,
+                               'Creation of %s (%s) (via web) successful' % (compute.hostname, compute))
+
+            request.write(json.dumps({'success': True,
+                                      'result': IHttpRestView(compute).render_GET(request)},
+                                     cls=JsonSetEncoder))
+            request.finish()
 
+        def handle_pre_execute_hook_error(f, compute, principal):
+            f.trap(Exception)
+            self.add_log_event(principal,
+                               'Creation of %s (%s) (via web) failed: %s: %s' % (compute.hostname, compute,
+                                                                                 type(f.value).__name__,
+                                                                                 f.value))
+            request.write(json.dumps({'success': False,
+                                      'errors': [{'id': 'vm', 'msg': str(f.value)}]}))
+            request.finish()
+
+        d = self.validate_hook(principal)
+        d.addCallback(handle_success, compute, principal)
+        d.addErrback(handle_pre_execute_hook_error, compute, principal)
+        return NOT_DONE_YET
+
+    def prepare_form(self, data):
+        """Converts the VM data sent by ONC to the model's, returns the validating form, the root password
+        and the validation errors"""
         if 'state' not in data:
             data['state'] = 'active' if data.get('start_on_boot') else 'inactive'
 
@@ -74,53 +131,106 @@ class VirtualizationContainerView(ContainerView, PreValidateHookMixin):
 
         form = RawDataValidatingFactory(data, Compute, marker=IVirtualCompute)
 
+        errors = []
         if form.errors or not data.get('template'):
             template_error = [dict(id='template', msg="missing value")] if not data.get('template') else []
-            return {'success': False,
-                    'errors': [dict(id=k, msg=v) for k, v in form.error_dict().items()] + template_error}
+            errors = [dict(id=k, msg=v) for k, v in form.error_dict().items()] + template_error
 
-        compute = form.create()
+        return form, root_password, errors
 
-        interaction = request.interaction
+    def render_bulk_POST(self, request, specs):
+        if not specs or not all(isinstance(spec, dict) for spec in specs):
+            raise BadRequest("Input data must be a non-empty list of dictionaries")
 
-        if not interaction:
-            auth = getUtility(IAuthentication, context=None)
-            principal = auth.getPrincipal(None)
-        else:
-            principal = interaction.participations[0].principal
+        if not IHangar.providedBy(self.context.__parent__):
+            raise BadRequest("Bulk allocation is only possible in the hangar")
 
-        @db.transact
-        def handle_success(r, compute, principal):
-            compute.__owner__ = principal
+        forms = []
+        errors = []
+        for index, spec in enumerate(specs):
+            form, root_password, spec_errors = self.prepare_form(spec)
+            errors.extend(dict(error, vm=index) for error in spec_errors)
+            forms.append((form, root_password))
 
-            compute.root_password = root_password
-            self.context.add(compute)
+        if errors:
+            return {'success': False, 'errors': errors}
 
-            data['id'] = compute.__name__
+        principal = self.get_principal(request)
 
-            self.add_log_event(principal,
-                               'Creation of %s (%s) (via web) successful' % (compute.hostname, compute))
+        @db.transact
+        def add_computes(r):
+            paths = []
+            for form, root_password in forms:
+                compute = form.create()
+                compute.__name__ = str(uuid4())
+                compute.__owner__ = principal
+                compute.root_password = root_password
+                bulk_created.add(compute.__name__)
+                self.context.add(compute)
+                paths.append(canonical_path(compute))
+
+            self.add_log_event(principal, 'Creation of %s VMs for bulk allocation (via web) successful' %
+                               len(paths))
+            return paths
 
-            request.write(json.dumps({'success': True,
-                                      'result': IHttpRestView(compute).render_GET(request)},
-                                     cls=JsonSetEncoder))
+        @db.transact
+        def delete_computes(paths):
+            """Deletes the computes created for an allocation that could not be placed"""
+            for path in paths:
+                compute = traverse1(path)
+                if compute is not None:
+                    del self.context[compute.__name__]
+                    handle(compute, ModelDeletedEvent(self.context))
+
+            self.add_log_event(principal, 'Bulk allocation (via web) failed, %s created VMs deleted' %
+                               len(paths))
+
+        @defer.inlineCallbacks
+        def allocate(paths):
+            allocation = BulkAllocation(paths)
+            try:
+                placed = yield allocation.place()
+            except Exception:
+                f = failure.Failure()
+                yield delete_computes(paths)
+                f.raiseException()
+            finally:
+                bulk_created.difference_update(path.rsplit('/', 1)[-1] for path in paths)
+
+            if placed:
+                result = dict((allocation.vms[vm], capacity.hostname)
+                              for vm, capacity in allocation.placement.iteritems())
+                request.write(json.dumps({'success': True, 'result': result}))
+                allocation.deploy().addErrback(log.err, system='bulk-allocate')
+            else:
+                # all or nothing: the VMs that fitted are not kept either
+                yield delete_computes(paths)
+                request.write(json.dumps({'success': False,
+                                          'errors': [{'id': 'vm', 'vm': paths.index(path),
+                                                      'msg': 'Cannot place the VM'}
+                                                     for path in allocation.unplaced]}))
             request.finish()
 
-        def handle_pre_execute_hook_error(f, compute, principal):
-            f.trap(Exception)
-            self.add_log_event(principal,
-                               'Creation of %s (%s) (via web) failed: %s: %s' % (compute.hostname, compute,
-                                                                                 type(f.value).__name__,
-                                                                                 f.value))
-            request.write(json.dumps({'success': False,
-                                      'errors': [{'id': 'vm', 'msg': str(f.value)}]}))
+        def handle_error(f):
+            self.add_log_event(principal, 'Bulk allocation (via web) failed: %s: %s' %
+                               (type(f.value).__name__, f.value))
+            request.write(json.dumps({'success': False, 'errors': [{'id': 'vm', 'msg': str(f.value)}]}))
             request.finish()
 
         d = self.validate_hook(principal)
-        d.addCallback(handle_success, compute, principal)
-        d.addErrback(handle_pre_execute_hook_error, compute, principal)
+        d.addCallback(add_computes)
+        d.addCallback(allocate)
+        d.addErrback(handle_error)
         return NOT_DONE_YET
 
+    def get_principal(self, request):
+        interaction = request.interaction
+
+        if not interaction:
+            auth = getUtility(IAuthentication, context=None)
+            return auth.getPrincipal(None)
+        return interaction.participations[0].principal
+
     def add_log_event(self, principal, msg, *args, **kwargs):
         owner = self.context.__owner__
         ulog = UserLogger(principal=principal, subject=self.context, owner=owner)
@@ -181,3 +291,59 @@ class ComputeView(ContainerView):
 
         data = dict(filter(filter_readonly_properties, data.iteritems()))
         return data
+
+
+class MetricsQueryView(HttpRestView):
+    """Aggregates a metric over the computes of the container in a single response.
+
+    Arguments: name (metric name), start/end (ms timestamps, default to the last hour), step (seconds per
+    bucket, default 60), aggregation (sum, avg, max, min or p95, default avg), owner and tag filters.
+
+    """
+    name('metrics')
+
+    def computes(self):
+        return [compute for compute in map(follow_symlinks, self.context.listcontent())
+                if ICompute.providedBy(compute)]
+
+    def render_GET(self, request):
+        def arg(key, default=None):
+            return request.args.get(key, [default])[0]
+
+        metric = arg('name')
+        if not metric:
+            raise BadRequest("Missing metric name")
+
+        aggregation = arg('aggregation', 'avg')
+        if aggregation not in AGGREGATIONS:
+            raise BadRequest("Unknown aggregation '%s'" % aggregation)
+
+        try:
+            end = int(arg('end', time.time() * 1000))
+            start = int(arg('start', end - 3600 * 1000))
+            step = int(arg('step', 60))
+        except ValueError:
+            raise BadRequest("start, end and step must be integers")
+
+        if step <= 0 or start > end:
+            raise BadRequest("Invalid time range or step")
+
+        owner = arg('owner')
+        tag = arg('tag')
+        computes = [compute for compute in self.computes()
+                    if (owner is None or compute.__owner__ == owner)
+                    and (tag is None or tag in ITagged(compute).tags)]
+
+        return query_metrics(computes, metric, start, end, step, aggregation)
+
+
+class ComputesMetricsQueryView(MetricsQueryView):
+    context(Computes)
+
+
+class MachinesMetricsQueryView(MetricsQueryView):
+    context(Machines)
+
+    def computes(self):
+        return [compute for compute in super(MachinesMetricsQueryView, self).computes()
+                if not IVirtualCompute.providedBy(compute)]
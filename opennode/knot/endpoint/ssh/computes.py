@@ -0,0 +1,69 @@
+from grokcore.component import implements
+from twisted.internet import defer
+
+from opennode.knot.backend.bulkallocate import BulkAllocation
+from opennode.knot.model.computes import check_computes_index
+from opennode.oms.endpoint.ssh.cmd.base import Cmd
+from opennode.oms.endpoint.ssh.cmd.directives import command
+from opennode.oms.endpoint.ssh.cmd.security import require_admins_only
+from opennode.oms.endpoint.ssh.cmdline import ICmdArgumentsSyntax, VirtualConsoleArgumentParser
+from opennode.oms.model.model.symlink import follow_symlinks
+from opennode.oms.model.traversal import canonical_path
+from opennode.oms.zodb import db
+
+
+class ReindexComputesCmd(Cmd):
+    implements(ICmdArgumentsSyntax)
+    command('reindex-computes')
+
+    def arguments(self):
+        parser = VirtualConsoleArgumentParser()
+        parser.add_argument('-n', '--dry-run', action='store_true',
+                            help="Only check the /computes index and catalog, do not repair them")
+        return parser
+
+    @require_admins_only
+    @defer.inlineCallbacks
+    def execute(self, args):
+        missing, stale, recataloged = yield db.transact(check_computes_index)(repair=not args.dry_run)
+        for uuid in missing:
+            self.write("missing: %s\n" % uuid)
+        for uuid in stale:
+            self.write("stale: %s\n" % uuid)
+        self.write("%s missing, %s stale entries, %s computes with wrong catalog entries%s\n" %
+                   (len(missing), len(stale), recataloged, '' if args.dry_run else ' repaired'))
+
+
+class BulkAllocateCmd(Cmd):
+    implements(ICmdArgumentsSyntax)
+    command('allocate-bulk')
+
+    def arguments(self):
+        parser = VirtualConsoleArgumentParser()
+        parser.add_argument('paths', nargs='+', help="Undeployed VMs of the hangar to allocate")
+        parser.add_argument('-j', '--max-per-host', type=int,
+                            help="Maximum number of VMs being deployed at the same time on each hypervisor")
+        return parser
+
+    @db.ro_transact
+    def get_paths(self, args):
+        paths = []
+        for path in args.paths:
+            obj = self.traverse(path)
+            paths.append(canonical_path(follow_symlinks(obj)) if obj is not None else path)
+        return paths
+
+    @require_admins_only
+    @defer.inlineCallbacks
+    def execute(self, args):
+        allocation = BulkAllocation((yield self.get_paths(args)), args.max_per_host)
+        if not (yield allocation.place()):
+            self.write("Nothing allocated, cannot place: %s\n" % ', '.join(allocation.unplaced))
+            return
+
+        for vm, capacity in allocation.placement.iteritems():
+            self.write("%s -> %s\n" % (allocation.vms[vm], capacity.hostname))
+
+        results = yield allocation.deploy()
+        for path, deployed in sorted(results.iteritems()):
+            self.write("%s: %s\n" % (path, 'deployed' if deployed else 'failed'))
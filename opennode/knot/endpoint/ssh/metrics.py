@@ -0,0 +1,33 @@
+from grokcore.component import implements
+from twisted.internet import defer
+
+from opennode.knot.backend.metricstore import get_store
+from opennode.oms.endpoint.ssh.cmd.base import Cmd
+from opennode.oms.endpoint.ssh.cmd.directives import command
+from opennode.oms.endpoint.ssh.cmd.security import require_admins_only
+from opennode.oms.endpoint.ssh.cmdline import ICmdArgumentsSyntax, VirtualConsoleArgumentParser
+
+
+class MetricsGcCmd(Cmd):
+    implements(ICmdArgumentsSyntax)
+    command('metrics-gc')
+
+    def arguments(self):
+        parser = VirtualConsoleArgumentParser()
+        parser.add_argument('-n', '--dry-run', action='store_true',
+                            help="Only report the metrics store usage, do not reclaim anything")
+        return parser
+
+    @require_admins_only
+    @defer.inlineCallbacks
+    def execute(self, args):
+        store = get_store()
+        self.write("%s series in memory holding %s points (budget: %s)\n" %
+                   (len(store.series), store.memory_points, store.memory_budget or 'unlimited'))
+        if args.dry_run:
+            return
+
+        report = yield store.cooperative_gc()
+        self.write("%(series)s series on disk, %(evicted_points)s points evicted from memory, "
+                   "%(expired_points)s points expired, %(merged_files)s files merged, "
+                   "%(removed_series)s series removed, %(reclaimed_bytes)s bytes reclaimed\n" % report)
@@ -0,0 +1,140 @@
+from __future__ import absolute_import
+
+from BTrees.OOBTree import OOBTree, OOTreeSet, intersection
+from persistent import Persistent
+
+from opennode.oms.zodb import db
+
+
+def _ipv4(compute):
+    address = getattr(compute, 'ipv4_address', None)
+    return address.split('/')[0] if address else None
+
+
+# index name -> function extracting the indexed value of a compute
+INDEXES = {
+    'owner': lambda c: getattr(c, '__owner__', None),
+    'state': lambda c: c.state,
+    'backend': lambda c: getattr(c.__parent__, 'backend', None),
+    'hostname': lambda c: c.hostname,
+    'ipv4': _ipv4,
+    'failure': lambda c: bool(c.failure),
+    'suspicious': lambda c: bool(c.suspicious),
+}
+
+
+def indexed_values(compute):
+    """Values of the indexed attributes of the compute; None values are not indexed"""
+    values = {}
+    for name, extract in INDEXES.iteritems():
+        value = extract(compute)
+        if value is not None:
+            values[name] = value
+    return values
+
+
+class ComputesCatalog(Persistent):
+    """Secondary indexes of the computes: for each index, a BTree of value -> set of compute uuids, and
+    the indexed values of each compute, so that changed values can be unindexed"""
+
+    def __init__(self):
+        self.indexes = OOBTree()
+        for name in INDEXES:
+            self.indexes[name] = OOBTree()
+        self.values = OOBTree()
+
+    def index(self, uuid, values):
+        """Indexes the values of the compute, returns whether the catalog changed"""
+        old = self.values.get(uuid, {})
+        if old == values:
+            return False
+
+        for name in set(old).union(values):
+            if old.get(name) == values.get(name):
+                continue
+            index = self.indexes[name]
+            if name in old:
+                self._remove(index, old[name], uuid)
+            if name in values:
+                uuids = index.get(values[name])
+                if uuids is None:
+                    uuids = index[values[name]] = OOTreeSet()
+                uuids.insert(uuid)
+
+        self.values[uuid] = values
+        return True
+
+    def unindex(self, uuid):
+        old = self.values.get(uuid)
+        if old is None:
+            return False
+
+        for name, value in old.iteritems():
+            self._remove(self.indexes[name], value, uuid)
+        del self.values[uuid]
+        return True
+
+    def _remove(self, index, value, uuid):
+        uuids = index.get(value)
+        if uuids is not None and uuid in uuids:
+            uuids.remove(uuid)
+            if not uuids:
+                del index[value]
+
+    def query(self, **criteria):
+        """Uuids of the computes whose indexed values equal all the criteria"""
+        for name in criteria:
+            if name not in INDEXES:
+                raise ValueError('Unknown index %s, expected one of %s' % (name, sorted(INDEXES)))
+
+        if not criteria:
+            return list(self.values.keys())
+
+        sets = [self.indexes[name].get(value) for name, value in criteria.iteritems()]
+        if None in sets:
+            return []
+
+        result = None
+        for uuids in sorted(sets, key=len):
+            result = uuids if result is None else intersection(result, uuids)
+            if not result:
+                return []
+        return list(result)
+
+    def distinct(self, name):
+        """Distinct indexed values of an index"""
+        return list(self.indexes[name].keys())
+
+    def update(self, computes, dry_run=False):
+        """Reindexes the computes and unindexes every other compute, returns the number of computes whose
+        entries changed (or would change, with `dry_run`)"""
+        changed = 0
+        uuids = set()
+        for compute in computes:
+            uuids.add(compute.__name__)
+            values = indexed_values(compute)
+            if dry_run:
+                changed += self.values.get(compute.__name__, {}) != values
+            else:
+                changed += self.index(compute.__name__, values)
+
+        for uuid in [uuid for uuid in self.values.keys() if uuid not in uuids]:
+            changed += dry_run or self.unindex(uuid)
+        return changed
+
+
+def get_computes_catalog():
+    """Returns the persistent computes catalog, or None if it was not built yet"""
+    return db.get_root().get('computes_catalog')
+
+
+def catalog_compute(compute):
+    catalog = get_computes_catalog()
+    if catalog is not None:
+        catalog.index(compute.__name__, indexed_values(compute))
+
+
+def uncatalog_compute(compute):
+    catalog = get_computes_catalog()
+    if catalog is not None:
+        catalog.unindex(compute.__name__)
@@ -134,6 +134,9 @@ class ICompute(Interface):
     failure = schema.Bool(title=u'Availability failure', required=False,
                           readonly=True, default=False)
 
+    degraded = schema.Bool(title=u'Degraded performance', description=u'Metrics anomaly detected',
+                           required=False, readonly=True, default=False)
+
     agent_version = schema.TextLine(title=u'Agent version', required=False,
                                     readonly=True, default=u'')
 
@@ -220,6 +223,7 @@ class Compute(Container):
     pingcheck = []
     suspicious = False
     failure = False
+    degraded = False
 
     num_cores = 1
     memory = 2048,
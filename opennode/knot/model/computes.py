@@ -1,23 +1,210 @@
 from __future__ import absolute_import
 
-from grokcore.component import context
+from BTrees.OOBTree import OOBTree
+from grokcore.component import context, subscribe
 import logging
 from types import GeneratorType
 from twisted.python import log
+from UserDict import DictMixin
 from zope.component import provideSubscriptionAdapter
 
+from opennode.knot.model.catalog import ComputesCatalog, catalog_compute, get_computes_catalog
+from opennode.knot.model.catalog import indexed_values, uncatalog_compute
 from opennode.knot.model.compute import Compute, ICompute, IVirtualCompute
 from opennode.knot.model.hangar import IHangar
+from opennode.knot.model.template import uncatalogue_host
 
 from opennode.oms.model.model.base import AddingContainer, ReadonlyContainer
 from opennode.oms.model.model.base import ContainerInjector
 from opennode.oms.model.model.byname import ByNameContainerExtension
+from opennode.oms.model.model.events import IModelCreatedEvent, IModelDeletedEvent, IModelModifiedEvent
 from opennode.oms.model.model.proc import ITask
 from opennode.oms.model.model.root import OmsRoot
-from opennode.oms.model.model.symlink import Symlink
+from opennode.oms.model.model.symlink import Symlink, follow_symlinks
 from opennode.oms.zodb import db
 
 
+def walk_computes():
+    """Finds all the computes by walking /machines, the hypervisors and the hangar"""
+    from opennode.knot.model.machines import Machines
+    from opennode.knot.model.virtualizationcontainer import IVirtualizationContainer
+
+    machines = db.get_root()['oms_root']['machines']
+
+    computes = {}
+
+    def allowed_classes_gen(item):
+        yield isinstance(item, Machines)
+        yield isinstance(item, Computes)
+        yield ICompute.providedBy(item)
+        yield IVirtualizationContainer.providedBy(item)
+        yield IHangar.providedBy(item)
+
+    def collect(container):
+        seen = set()
+        for item in container.listcontent():
+            if ICompute.providedBy(item):
+                computes[item.__name__] = item
+
+            if any(allowed_classes_gen(item)):
+                if item.__name__ not in seen:
+                    seen.add(item.__name__)
+                    collect(item)
+
+    collect(machines)
+    return computes
+
+
+def get_computes_index():
+    """Returns the persistent uuid -> compute index, or None if it was not built yet"""
+    return db.get_root().get('computes_index')
+
+
+def is_attached(compute):
+    """Whether the compute and each of its ancestors is still contained by its parent, up to /machines,
+    i.e. neither the compute nor e.g. its hypervisor was deleted or moved away"""
+    from opennode.knot.model.machines import Machines
+
+    obj = compute
+    while not isinstance(obj, Machines):
+        parent = obj.__parent__
+        if parent is None:
+            return False
+        try:
+            if follow_symlinks(parent[obj.__name__]) is not follow_symlinks(obj):
+                return False
+        except (KeyError, TypeError):
+            return False
+        obj = parent
+    return True
+
+
+def contained_computes(compute):
+    """Yields the computes in the virtualization containers of the compute, recursively"""
+    from opennode.knot.model.virtualizationcontainer import IVirtualizationContainer
+
+    for container in compute.listcontent():
+        if not IVirtualizationContainer.providedBy(container):
+            continue
+        for item in container.listcontent():
+            if ICompute.providedBy(item) and not isinstance(item, Symlink):
+                yield item
+                for vm in contained_computes(item):
+                    yield vm
+
+
+def index_compute(compute):
+    """Indexes the compute and catalogs its attributes, see `query_computes`"""
+    index = get_computes_index()
+    if index is not None and index.get(compute.__name__) is not compute:
+        index[compute.__name__] = compute
+    catalog_compute(compute)
+
+
+def unindex_compute(compute):
+    index = get_computes_index()
+    if index is not None and index.get(compute.__name__) is compute:
+        del index[compute.__name__]
+        uncatalog_compute(compute)
+
+
+def query_computes(**criteria):
+    """Returns the computes whose indexed attributes (see catalog.INDEXES) equal the criteria, e.g.
+    `query_computes(owner=u'joe', failure=False)`. Must be called in a transaction."""
+    index = get_computes_index()
+    catalog = get_computes_catalog()
+    if index is None or catalog is None or None in criteria.values():
+        computes = walk_computes().values()
+        return [c for c in computes if all(indexed_values(c).get(k) == v for k, v in criteria.iteritems())]
+
+    computes = []
+    for uuid in catalog.query(**criteria):
+        compute = index.get(uuid)
+        if compute is not None and is_attached(compute):
+            computes.append(compute)
+    return computes
+
+
+def query_values(name):
+    """Returns the distinct values of an indexed attribute of the computes. Must be called in a
+    transaction."""
+    catalog = get_computes_catalog()
+    if catalog is None:
+        return list(set(filter(None, (indexed_values(c).get(name) for c in walk_computes().itervalues()))))
+    return catalog.distinct(name)
+
+
+def check_computes_index(repair=True):
+    """Compares the index and the catalog with a walk of the tree, rebuilding them when `repair` is set.
+
+    Returns the uuids of the computes missing from the index, the uuids of the stale entries of the
+    index and the number of computes whose catalog entries were wrong. Must be called in a transaction.
+
+    """
+    computes = walk_computes()
+    index = get_computes_index()
+    indexed = dict(index.items()) if index is not None else {}
+
+    missing = sorted(uuid for uuid, compute in computes.iteritems() if indexed.get(uuid) is not compute)
+    stale = sorted(uuid for uuid in indexed if uuid not in computes)
+
+    catalog = get_computes_catalog()
+    if catalog is None and repair:
+        catalog = db.get_root()['computes_catalog'] = ComputesCatalog()
+    if catalog is not None:
+        recataloged = catalog.update(computes.values(), dry_run=not repair)
+    else:
+        recataloged = len(computes)
+
+    if repair:
+        if index is None:
+            index = db.get_root()['computes_index'] = OOBTree()
+        for uuid in stale:
+            del index[uuid]
+        for uuid in missing:
+            index[uuid] = computes[uuid]
+
+    return missing, stale, recataloged
+
+
+class ComputesIndexView(DictMixin):
+    """Read-only mapping of uuids to symlinks of the computes in the index"""
+
+    def __init__(self, index):
+        self.index = index
+
+    def _get(self, key):
+        compute = self.index.get(key)
+        return compute if compute is not None and is_attached(compute) else None
+
+    def __getitem__(self, key):
+        compute = self._get(key)
+        if compute is None:
+            raise KeyError(key)
+        return Symlink(compute.__name__, compute)
+
+    def __contains__(self, key):
+        return self._get(key) is not None
+
+    has_key = __contains__
+
+    def __iter__(self):
+        for key, compute in self.index.iteritems():
+            if is_attached(compute):
+                yield key
+
+    def iteritems(self):
+        for key, compute in self.index.iteritems():
+            if is_attached(compute):
+                yield key, Symlink(compute.__name__, compute)
+
+    def keys(self):
+        return list(self)
+
+    def __len__(self):
+        return len(self.keys())
+
+
 class Computes(AddingContainer):
     __contains__ = IVirtualCompute
     __name__ = 'computes'
@@ -27,32 +214,11 @@ class Computes(AddingContainer):
 
     @property
     def _items(self):
-        machines = db.get_root()['oms_root']['machines']
-
-        computes = {}
-
-        def allowed_classes_gen(item):
-            from opennode.knot.model.machines import Machines
-            from opennode.knot.model.virtualizationcontainer import IVirtualizationContainer
-            yield isinstance(item, Machines)
-            yield isinstance(item, Computes)
-            yield ICompute.providedBy(item)
-            yield IVirtualizationContainer.providedBy(item)
-            yield IHangar.providedBy(item)
-
-        def collect(container):
-            seen = set()
-            for item in container.listcontent():
-                if ICompute.providedBy(item):
-                    computes[item.__name__] = Symlink(item.__name__, item)
+        index = get_computes_index()
+        if index is not None:
+            return ComputesIndexView(index)
 
-                if any(allowed_classes_gen(item)):
-                    if item.__name__ not in seen:
-                        seen.add(item.__name__)
-                        collect(item)
-
-        collect(machines)
-        return computes
+        return dict((name, Symlink(name, compute)) for name, compute in walk_computes().iteritems())
 
     def _add(self, item):
         machines = db.get_root()['oms_root']['machines']
@@ -72,6 +238,25 @@ class ComputesRootInjector(ContainerInjector):
     __class__ = Computes
 
 
+@subscribe(ICompute, IModelCreatedEvent)
+def index_created_compute(model, event):
+    index_compute(model)
+
+
+@subscribe(ICompute, IModelModifiedEvent)
+def catalog_modified_compute(model, event):
+    catalog_compute(model)
+
+
+@subscribe(ICompute, IModelDeletedEvent)
+def forget_deleted_compute(model, event):
+    unindex_compute(model)
+    uncatalogue_host(model.__name__)
+    # the VMs of a deleted hypervisor go with it
+    for vm in contained_computes(model):
+        unindex_compute(vm)
+
+
 class ComputeTasks(ReadonlyContainer):
     context(Compute)
     __contains__ = ITask
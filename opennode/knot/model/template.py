@@ -1,5 +1,6 @@
 from __future__ import absolute_import
 
+from BTrees.OOBTree import OOBTree
 from grokcore.component import context, implements
 from zope import schema
 from zope.component import provideSubscriptionAdapter
@@ -83,6 +84,95 @@ class Templates(Container):
         return 'Template list'
 
 
+def get_template_catalogue():
+    """Returns the persistent catalogue of template name -> {(host uuid, backend): template}, or None if
+    it was not built yet"""
+    # break an import cycle
+    from opennode.oms.zodb import db
+    return db.get_root().get('templates_catalogue')
+
+
+def catalogue_templates(host, backend, templates, catalogue=None):
+    """Records the templates (a name -> template dict) as the ones offered by the backend of the host,
+    forgetting the ones it no longer offers"""
+    catalogue = catalogue if catalogue is not None else get_template_catalogue()
+    if catalogue is None:
+        return
+
+    key = (host, backend)
+    for name, offers in list(catalogue.items()):
+        if key in offers and name not in templates:
+            del offers[key]
+            if not offers:
+                del catalogue[name]
+
+    for name, template in templates.iteritems():
+        offers = catalogue.get(name)
+        if offers is None:
+            offers = catalogue[name] = OOBTree()
+        if offers.get(key) is not template:
+            offers[key] = template
+
+
+def uncatalogue_host(host):
+    catalogue = get_template_catalogue()
+    if catalogue is None:
+        return
+
+    for name, offers in list(catalogue.items()):
+        for key in [key for key in offers.keys() if key[0] == host]:
+            del offers[key]
+        if not offers:
+            del catalogue[name]
+
+
+def offers_template(name, host, backend):
+    """Whether the backend of the host offers the template, or None if the catalogue was not built yet"""
+    catalogue = get_template_catalogue()
+    if catalogue is None:
+        return None
+    offers = catalogue.get(name)
+    return offers is not None and (host, backend) in offers
+
+
+def build_template_catalogue():
+    """Builds the catalogue from the templates of every virtualization container. Must be called in a
+    transaction."""
+    from opennode.oms.zodb import db
+    from opennode.knot.model.compute import ICompute
+    from opennode.knot.model.virtualizationcontainer import IVirtualizationContainer
+
+    catalogue = OOBTree()
+
+    def collect(compute, seen):
+        if compute.__name__ in seen:
+            return
+        seen.add(compute.__name__)
+
+        for container in compute.listcontent():
+            if not IVirtualizationContainer.providedBy(container):
+                continue
+
+            templates = container['templates']
+            if templates:
+                catalogue_templates(compute.__name__, container.backend,
+                                    dict((t.name, t) for t in templates.listcontent()
+                                         if ITemplate.providedBy(t)),
+                                    catalogue)
+
+            for vm in container.listcontent():
+                if ICompute.providedBy(vm):
+                    collect(vm, seen)
+
+    seen = set()
+    for machine in db.get_root()['oms_root']['machines'].listcontent():
+        if ICompute.providedBy(machine):
+            collect(machine, seen)
+
+    db.get_root()['templates_catalogue'] = catalogue
+    return catalogue
+
+
 class GlobalTemplates(ReadonlyContainer):
     __contains__ = Template
     __name__ = 'templates'
@@ -92,6 +182,26 @@ class GlobalTemplates(ReadonlyContainer):
 
     @property
     def _items(self):
+        # break an import cycle
+        from opennode.knot.model.computes import get_computes_index, is_attached
+
+        catalogue = get_template_catalogue()
+        index = get_computes_index()
+        if catalogue is None or index is None:
+            return self._walk()
+
+        templates = {}
+        hosts = {}
+        for offers in catalogue.itervalues():
+            for (host, backend), template in offers.iteritems():
+                if host not in hosts:
+                    compute = index.get(host)
+                    hosts[host] = compute is not None and is_attached(compute)
+                if hosts[host] and template.__name__ not in templates:
+                    templates[template.__name__] = Symlink(template.__name__, template)
+        return templates
+
+    def _walk(self):
         # break an import cycle
         from opennode.oms.zodb import db
         machines = db.get_root()['oms_root']['machines']
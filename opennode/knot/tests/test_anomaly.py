@@ -0,0 +1,54 @@
+import unittest
+
+from opennode.knot.backend.anomaly import AnomalyDetector, EwmaDetector, signal_value
+
+
+class AnomalyDetectorTest(unittest.TestCase):
+
+    def test_signal_value(self):
+        assert signal_value((1.5, 1.0, 0.5)) == 1.5
+        assert signal_value({u'root': 10.0, u'boot': 5}) == 15.0
+        assert signal_value('n/a') is None
+
+    def test_ewma_detector(self):
+        detector = EwmaDetector(0.1, 4, warmup=5)
+        scores = [detector.update(v) for v in [1.0, 1.2, 0.9, 1.1, 1.0, 1.05]]
+        assert scores[:5] == [None] * 5
+        assert abs(scores[5]) < 1
+        assert detector.update(10.0) > 4
+
+    def test_degraded_and_recovery(self):
+        detector = AnomalyDetector(alpha=0.05, threshold=4, persistence=3, warmup=10)
+        path = '/machines/h1/metrics/cpu_usage'
+        detector.set_capacity('/machines/h1', 1, 1024)
+
+        detector.observe(path, [(i * 1000, (1.0 + (i % 3) * 0.1, 1.0, 1.0)) for i in xrange(30)])
+        assert not detector.changes
+
+        detector.observe(path, [(i * 1000, (20.0, 1.0, 1.0)) for i in xrange(30, 33)])
+        assert detector.changes == {'/machines/h1': True}
+
+        detector.changes.clear()
+        detector.observe(path, [(i * 1000, (1.1, 1.0, 1.0)) for i in xrange(33, 36)])
+        assert detector.changes == {'/machines/h1': False}
+
+    def test_vm_boot_on_idle_host(self):
+        detector = AnomalyDetector(alpha=0.05, threshold=4, persistence=3, warmup=10)
+        detector.set_capacity('/machines/h1', 8, 16384)
+
+        def observe(start, count, load, memory, disk_rate):
+            points = range(start, start + count)
+            detector.observe('/machines/h1/metrics/cpu_usage',
+                             [(i * 1000, (load, load, load)) for i in points])
+            detector.observe('/machines/h1/metrics/memory_usage', [(i * 1000, memory) for i in points])
+            detector.observe('/machines/h1/metrics/diskspace_usage',
+                             [(i * 1000, {u'root': 2000.0 + i * disk_rate}) for i in points])
+
+        observe(0, 60, 0.02, 1000.0, 0.0)
+        # the VM boots: the load goes up to 0.2 per core, 2GB of memory are used, logs are written
+        observe(60, 20, 1.6, 3000.0, 1.0)
+        assert not detector.changes
+
+        # an actual overload is still detected
+        observe(80, 5, 12.0, 3000.0, 1.0)
+        assert detector.changes == {'/machines/h1': True}
@@ -0,0 +1,105 @@
+import unittest
+
+from twisted.internet import defer
+
+from opennode.knot.backend.bulkallocate import BulkAllocation, assign_ctids, pack
+from opennode.knot.backend.placement import BestFitStrategy, Demand, HostCapacity, PlacementTable
+
+
+NO_OVERCOMMIT = {'memory': False, 'disk': False, 'cores': False}
+
+
+class PackTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = PlacementTable(BestFitStrategy())
+        self.table.load([HostCapacity(host, host, u'openvz', memory, 100000, 4, 0.0, set([u'centos']))
+                         for host, memory in (('h1', 5000), ('h2', 5000))])
+
+    def vm(self, name, memory):
+        return name, u'openvz', Demand(memory, 1000, 1, u'centos')
+
+    def test_first_fit_decreasing(self):
+        # placed in the given order, the small VMs would fill h1 and leave no room for the second big one
+        demands = [self.vm('vm%s' % i, 1000) for i in range(4)]
+        demands += [self.vm('big1', 3000), self.vm('big2', 3000)]
+        placement, unplaced = pack(self.table, demands, NO_OVERCOMMIT)
+
+        assert not unplaced
+        assert placement['big1'].host != placement['big2'].host
+        assert sorted(self.table.pending) == ['big1', 'big2', 'vm0', 'vm1', 'vm2', 'vm3']
+        assert [host.memory for host in self.table.backends[u'openvz'].hosts.values()] == [0, 0]
+
+    def test_all_or_nothing(self):
+        demands = [self.vm('vm1', 4000), self.vm('vm2', 4000), self.vm('vm3', 3000)]
+        placement, unplaced = pack(self.table, demands, NO_OVERCOMMIT)
+
+        assert placement == {} and unplaced == ['vm3']
+        assert not self.table.pending
+        assert [host.memory for host in self.table.backends[u'openvz'].hosts.values()] == [5000, 5000]
+
+    def test_overcommit(self):
+        demands = [self.vm('vm1', 3000), self.vm('vm2', 3000), self.vm('vm3', 3000)]
+        placement, unplaced = pack(self.table, demands, dict(NO_OVERCOMMIT, memory=True))
+        assert len(placement) == 3 and not unplaced
+
+
+class FakeBulkAllocation(BulkAllocation):
+    """Records the deployments instead of running them; each finishes when its deferred is fired"""
+
+    def __init__(self, placement, max_per_host):
+        super(FakeBulkAllocation, self).__init__([], max_per_host, table=object())
+        self.vms = dict((vm, '/machines/hangar/vms/%s' % vm) for vm in placement)
+        self.backends = dict((vm, u'openvz') for vm in placement)
+        self.placement = dict((vm, HostCapacity(host, host, u'openvz', 0, 0, 0, 0.0, set()))
+                              for vm, host in placement.iteritems())
+        self.running = {}
+        self.ctids = {}
+        self.overlap = set()
+        self.max_running = {}
+
+    def last_ctid(self):
+        return defer.succeed(200)
+
+    def allocate(self, vm, ctid=None):
+        host = self.placement[vm].host
+        self.ctids[vm] = ctid
+        self.running[vm] = defer.Deferred()
+        hosts = set(self.placement[v].host for v in self.running)
+        if len(hosts) > 1:
+            self.overlap.add(frozenset(hosts))
+        on_host = len([v for v in self.running if self.placement[v].host == host])
+        self.max_running[host] = max(self.max_running.get(host, 0), on_host)
+
+        def done(r):
+            del self.running[vm]
+            self.results[self.vms[vm]] = True
+        return self.running[vm].addCallback(done)
+
+    def finish(self, vm):
+        self.running[vm].callback(None)
+
+
+class DeployTest(unittest.TestCase):
+
+    def test_assign_ctids(self):
+        assert assign_ctids(['a', 'b', 'c'], 200) == {'a': 201, 'b': 202, 'c': 203}
+
+    def test_bounded_per_host(self):
+        allocation = FakeBulkAllocation({'a1': 'h1', 'a2': 'h1', 'a3': 'h1', 'b1': 'h2', 'b2': 'h2'}, 2)
+        results = []
+        allocation.deploy().addCallback(results.append)
+
+        # both hosts deploy at the same time, two VMs each
+        assert sorted(allocation.running) == ['a1', 'a2', 'b1', 'b2']
+        assert allocation.overlap == set([frozenset(['h1', 'h2'])])
+
+        allocation.finish('a1')
+        assert sorted(allocation.running) == ['a2', 'a3', 'b1', 'b2']
+        for vm in ['a2', 'a3', 'b1', 'b2']:
+            allocation.finish(vm)
+
+        assert allocation.max_running == {'h1': 2, 'h2': 2}
+        assert len(results) == 1 and all(results[0].values()) and len(results[0]) == 5
+        # every VM of the batch has its own CTID
+        assert sorted(allocation.ctids.values()) == range(201, 206)
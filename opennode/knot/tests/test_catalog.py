@@ -0,0 +1,64 @@
+import unittest
+
+from opennode.knot.model.catalog import ComputesCatalog, indexed_values
+
+
+class FakeContainer(object):
+    backend = u'openvz'
+
+
+class FakeCompute(object):
+
+    def __init__(self, name, owner, state=u'active', ipv4_address=None, failure=False):
+        self.__name__ = name
+        self.__parent__ = FakeContainer()
+        self.__owner__ = owner
+        self.hostname = u'%s.example.com' % name
+        self.state = state
+        self.ipv4_address = ipv4_address
+        self.failure = failure
+        self.suspicious = False
+
+
+class ComputesCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.catalog = ComputesCatalog()
+        self.computes = [FakeCompute('vm1', 'joe', ipv4_address=u'10.0.0.1/24'),
+                         FakeCompute('vm2', 'joe', state=u'inactive'),
+                         FakeCompute('vm3', 'ann', failure=True)]
+        self.catalog.update(self.computes)
+
+    def test_indexed_values(self):
+        values = indexed_values(self.computes[0])
+        assert values['ipv4'] == u'10.0.0.1'
+        assert values['backend'] == u'openvz'
+        assert 'ipv4' not in indexed_values(self.computes[1])
+
+    def test_query(self):
+        assert sorted(self.catalog.query(owner='joe')) == ['vm1', 'vm2']
+        assert self.catalog.query(owner='joe', state=u'inactive') == ['vm2']
+        assert self.catalog.query(failure=True) == ['vm3']
+        assert self.catalog.query(owner='bob') == []
+        assert len(self.catalog.query()) == 3
+        assert self.catalog.distinct('ipv4') == [u'10.0.0.1']
+        self.assertRaises(ValueError, self.catalog.query, colour='red')
+
+    def test_reindex(self):
+        vm1 = self.computes[0]
+        vm1.__owner__ = 'ann'
+        vm1.ipv4_address = None
+        assert self.catalog.index('vm1', indexed_values(vm1))
+        assert not self.catalog.index('vm1', indexed_values(vm1))
+
+        assert self.catalog.query(owner='joe') == ['vm2']
+        assert sorted(self.catalog.query(owner='ann')) == ['vm1', 'vm3']
+        assert self.catalog.distinct('ipv4') == []
+
+    def test_update(self):
+        assert self.catalog.update(self.computes, dry_run=True) == 0
+
+        self.computes[1].state = u'active'
+        assert self.catalog.update(self.computes[1:]) == 2
+        assert sorted(self.catalog.query(state=u'active')) == ['vm2', 'vm3']
+        assert self.catalog.query(owner='joe') == ['vm2']
@@ -0,0 +1,97 @@
+import unittest
+
+from BTrees.OOBTree import OOBTree
+
+from opennode.knot.model import computes
+from opennode.knot.model.catalog import ComputesCatalog
+from opennode.knot.model.compute import Compute
+from opennode.knot.model.computes import check_computes_index, forget_deleted_compute
+from opennode.knot.model.computes import index_created_compute, is_attached, query_computes
+from opennode.knot.model.machines import Machines
+from opennode.knot.model.virtualizationcontainer import VirtualizationContainer
+
+
+def make_compute(name, hostname, container=None):
+    compute = Compute(hostname, u'active', 1024)
+    compute.__name__ = name
+    if container is not None:
+        container.add(compute)
+    return compute
+
+
+class ComputesIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.machines = Machines()
+        self.root = {'oms_root': {'machines': self.machines}, 'computes_index': OOBTree(),
+                     'computes_catalog': ComputesCatalog()}
+        self.get_root = computes.db.get_root
+        computes.db.get_root = lambda: self.root
+
+        self.host = make_compute('h1', u'h1.example.com', self.machines)
+        self.vms = VirtualizationContainer(u'openvz')
+        self.host.add(self.vms)
+        self.vm1 = make_compute('vm1', u'vm1.example.com', self.vms)
+        self.vm2 = make_compute('vm2', u'vm2.example.com', self.vms)
+        for compute in (self.host, self.vm1, self.vm2):
+            index_created_compute(compute, None)
+
+    def tearDown(self):
+        computes.db.get_root = self.get_root
+
+    @property
+    def index(self):
+        return self.root['computes_index']
+
+    def test_created(self):
+        assert sorted(self.index.keys()) == ['h1', 'vm1', 'vm2']
+        assert self.index['vm1'] is self.vm1
+        assert [c.__name__ for c in query_computes(hostname=u'vm1.example.com')] == ['vm1']
+
+    def test_deleted_hypervisor(self):
+        del self.machines['h1']
+        forget_deleted_compute(self.host, None)
+
+        assert list(self.index.keys()) == []
+        assert query_computes(state=u'active') == []
+
+    def test_is_attached(self):
+        assert is_attached(self.vm1) and is_attached(self.host)
+
+        # a stale entry: the hypervisor is gone, the VM object is still in the index
+        del self.machines['h1']
+        assert not is_attached(self.vm1)
+        assert not is_attached(self.host)
+
+    def test_is_attached_moved(self):
+        del self.vms['vm1']
+        moved = make_compute('vm1', u'vm1.example.com', self.vms)
+
+        assert not is_attached(self.vm1)
+        assert is_attached(moved)
+        # the index still holds the old object, which is hidden from queries
+        assert query_computes(hostname=u'vm1.example.com') == []
+
+    def test_check(self):
+        del self.index['vm2']
+        self.index['gone'] = make_compute('gone', u'gone.example.com')
+
+        missing, stale, recataloged = check_computes_index(repair=False)
+        assert missing == ['vm2']
+        assert stale == ['gone']
+        assert recataloged == 0
+        # nothing was repaired
+        assert 'vm2' not in self.index and 'gone' in self.index
+
+    def test_repair(self):
+        del self.index['vm2']
+        self.index['gone'] = make_compute('gone', u'gone.example.com')
+        self.vm1.state = u'inactive'
+
+        missing, stale, recataloged = check_computes_index(repair=True)
+        assert (missing, stale, recataloged) == (['vm2'], ['gone'], 1)
+
+        assert sorted(self.index.keys()) == ['h1', 'vm1', 'vm2']
+        assert self.index['vm2'] is self.vm2
+        assert [c.__name__ for c in query_computes(state=u'inactive')] == ['vm1']
+        assert check_computes_index(repair=False) == ([], [], 0)
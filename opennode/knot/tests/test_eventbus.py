@@ -0,0 +1,107 @@
+import unittest
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from opennode.knot.backend.operation import OperationRemoteError
+from opennode.knot.backend.salt import eventbus
+from opennode.knot.backend.salt.eventbus import SaltEventBus, parse_return_event
+
+
+class FakeEventPublisher(object):
+    """Replays a list of (tag, data) events, then stops the bus reading from it"""
+
+    def __init__(self, bus, events):
+        self.bus = bus
+        self.events = list(events)
+
+    def get_event(self, wait=1):
+        if not self.events:
+            self.bus.stop()
+            return
+        return self.events.pop(0)
+
+
+def ret(jid, minion, result, legacy=False):
+    tag = jid if legacy else 'salt/job/%s/ret/%s' % (jid, minion)
+    return tag, {'jid': jid, 'id': minion, 'return': result, 'retcode': 0}
+
+
+class FakeThreads(object):
+    """Runs the functions deferred to a thread right away"""
+
+    def deferToThread(self, fn, *args):
+        return defer.maybeDeferred(fn, *args)
+
+
+class SaltEventBusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.bus = SaltEventBus(None, None, early_ttl=10, clock=self.clock, deliver=lambda f, *a: f(*a))
+        self.bus.start = lambda: None
+        self.threads = eventbus.threads
+        eventbus.threads = FakeThreads()
+
+    def tearDown(self):
+        eventbus.threads = self.threads
+
+    def replay(self, *events):
+        source = FakeEventPublisher(self.bus, events)
+        self.bus.source_factory = lambda: source
+        self.bus.running = True
+        self.bus._read_loop()
+
+    def test_parse_return_event(self):
+        assert parse_return_event(*ret('20130101', 'h1', 42)) == ('20130101', 'h1', 42)
+        assert parse_return_event(*ret('20130101', 'h1', 42, legacy=True)) == ('20130101', 'h1', 42)
+        assert parse_return_event('salt/job/20130101/new', {'jid': '20130101', 'minions': ['h1']}) is None
+        assert parse_return_event('salt/auth', {'act': 'accept'}) is None
+
+    def test_matches_returns_by_jid(self):
+        results = []
+        for jid, host in (('1', 'h1'), ('2', 'h2')):
+            self.bus.wait(jid, host, 'test.ping', 5).addCallback(results.append)
+        assert self.bus.outstanding == 2
+
+        self.replay(('salt/job/2/new', {'jid': '2', 'minions': ['h2']}),
+                    ret('2', 'h2', True),
+                    ret('1', 'h1', 'pong', legacy=True))
+
+        assert results == [{'h2': True}, {'h1': 'pong'}]
+        assert self.bus.outstanding == 0
+
+    def publish(self, jid, *events):
+        """Returns a publisher which replays the events before returning the jid, like a minion replying
+        before publishing returned"""
+        def publisher(hostname, action, args):
+            self.replay(*events)
+            return jid
+        return publisher
+
+    def test_early_return(self):
+        results = []
+        self.bus.publisher = self.publish('3', ret('3', 'h3', [1, 2]), ret('x', 'h9', True))
+        self.bus.submit('h3', 'test.ping', [], 5).addCallback(results.append)
+        assert results == [{'h3': [1, 2]}]
+        # returns of the jobs of other clients are not kept
+        assert self.bus._early == {}
+
+    def test_early_expiry(self):
+        self.bus._publishing = 1
+        self.replay(ret('4', 'h4', True))
+        self.clock.advance(11)
+        self.replay(ret('5', 'h5', True))
+        assert '4' not in self.bus._early and '5' in self.bus._early
+
+    def test_timeout(self):
+        errors = []
+        d = self.bus.wait('6', 'h6', 'test.ping', 5)
+        d.addErrback(lambda f: errors.append(f.check(OperationRemoteError)))
+        self.clock.advance(6)
+        assert errors == [OperationRemoteError]
+        assert self.bus.outstanding == 0
+
+        # a late return is dropped
+        self.replay(ret('6', 'h6', True))
+        assert '6' not in self.bus._early
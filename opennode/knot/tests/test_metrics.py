@@ -0,0 +1,109 @@
+import unittest
+
+from twisted.internet import defer
+from twisted.internet.error import ProcessDone, ProcessExitedAlready
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+
+from opennode.knot.backend.ingest import ingestor
+from opennode.knot.backend.metrics import GatheredHosts, GatherStats, IngestStats, host_stats
+from opennode.knot.backend.metrics import VirtualComputeMetricGatherer
+from opennode.knot.backend.operation import OperationRemoteError
+from opennode.knot.backend.scheduler import BoundedScheduler, JobTimeoutError
+from opennode.knot.backend.subprocess import async_check_output
+
+
+class ExitedTransport(object):
+
+    def signalProcess(self, signal):
+        raise ProcessExitedAlready()
+
+
+class ExitingReactor(object):
+    """Spawns processes that exit right away"""
+
+    def spawnProcess(self, protocol, *args, **kwargs):
+        protocol.makeConnection(ExitedTransport())
+        protocol.processEnded(Failure(ProcessDone(0)))
+
+
+class GatherDeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.scheduler = BoundedScheduler(2, timeout=30, clock=self.clock)
+        self.phy = []
+
+        self.gatherer = VirtualComputeMetricGatherer(None)
+        self.gatherer.host = 'uuid1'
+        self.gatherer.hostname = 'h1'
+        self.gatherer.state = u'active'
+        self.gatherer.vms = object()
+        self.gatherer.vms_path = '/machines/uuid1/vms-openvz'
+        self.gatherer.gather_phy = lambda: self.phy.append(True)
+
+    def aborted_by_killhook(self, vms):
+        # salt executors fail their call when the killhook fires
+        d = defer.Deferred()
+        self.gatherer._killhook.addCallback(lambda r: d.errback(OperationRemoteError(msg='aborted')))
+        return d
+
+    def test_killed_at_deadline(self):
+        self.gatherer.fetch_vm_metrics = self.aborted_by_killhook
+        errors = []
+        d = self.scheduler.submit('h1', self.gatherer.gather)
+        d.addErrback(lambda f: errors.append(f.check(JobTimeoutError)))
+
+        self.clock.advance(29)
+        assert not errors and self.scheduler.is_pending('h1')
+
+        self.clock.advance(2)
+        assert errors == [JobTimeoutError]
+        # the host metrics are not gathered after a kill, and the slot is free again
+        assert self.phy == []
+        assert not self.scheduler.is_pending('h1')
+
+    def test_completed_before_deadline(self):
+        self.gatherer.fetch_vm_metrics = lambda vms: defer.succeed({})
+        results = []
+        self.scheduler.submit('h1', self.gatherer.gather).addCallback(results.append)
+
+        assert results == [None]
+        assert self.phy == [True]
+        assert not self.clock.getDelayedCalls()
+
+    def test_kill_after_process_exit(self):
+        errors = []
+
+        def job(killhook):
+            output = async_check_output(['true'], ExitingReactor(), killhook=killhook)
+            killhook.addErrback(errors.append)
+            # the job goes on after its process exited, until the deadline
+            return output.addCallback(lambda r: defer.Deferred())
+
+        self.scheduler.submit('h1', job).addErrback(lambda f: None)
+        self.clock.advance(31)
+        assert errors == []
+
+
+class GatherStatsTest(unittest.TestCase):
+
+    def test_counters(self):
+        stats = GatherStats()
+        stats.count('h1', 'gathered')
+        stats.count('h1', 'late')
+        stats.count('h2', 'killed')
+
+        assert stats.get('h1') == {'gathered': 1, 'late': 1, 'killed': 0, 'skipped': 0, 'failed': 0}
+        assert stats.get('h2')['killed'] == 1
+
+    def test_proc_view(self):
+        host_stats.count('h3', 'skipped')
+        host = GatheredHosts()._items['h3']
+        assert host.hostname == 'h3' and host.skipped == 1 and host.gathered == 0
+
+    def test_ingest_stats(self):
+        ingestor.stats['points'] = 42
+        ingestor.stats['batch_latency'] = 0.5
+        stats = IngestStats()
+        assert stats.points == 42 and stats.batch_latency == 0.5
@@ -0,0 +1,25 @@
+import unittest
+
+from opennode.knot.backend.metricsdelta import MetricsSnapshot
+
+
+class MetricsSnapshotTest(unittest.TestCase):
+
+    def test_merge(self):
+        snapshot = MetricsSnapshot()
+        full = {'full': True, 'seq': 1, 'changed': {'vm1': {'cpu_usage': 0.5, 'memory_usage': 100},
+                                                    'vm2': {'cpu_usage': 0.1, 'memory_usage': 50}}}
+        assert len(snapshot.merge(full)) == 2
+
+        metrics = snapshot.merge({'seq': 2, 'base': 1, 'changed': {'vm1': {'cpu_usage': 0.7}},
+                                  'removed': ['vm2']})
+        assert metrics == {'vm1': {'cpu_usage': 0.7, 'memory_usage': 100}}
+        assert snapshot.seq == 2
+
+    def test_out_of_sequence(self):
+        snapshot = MetricsSnapshot()
+        assert snapshot.merge({'seq': 5, 'base': 4, 'changed': {}}) is None
+
+        snapshot.merge({'full': True, 'seq': 1, 'changed': {'vm1': {'cpu_usage': 0.5}}})
+        assert snapshot.merge({'seq': 3, 'base': 2, 'changed': {}}) is None
+        assert snapshot.seq is None and snapshot.metrics == {}
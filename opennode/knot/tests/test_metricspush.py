@@ -0,0 +1,125 @@
+import base64
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet import defer
+from twisted.test.proto_helpers import StringTransport
+
+from opennode.knot.backend.metricspush import MetricsPushFactory, PushRegistry, TokenBucket
+from opennode.knot.backend.metricspush import verify_signature
+
+try:
+    from M2Crypto import BIO, RSA
+except ImportError:
+    RSA = None
+
+
+def fake_verify(pem, message, signature, hash_type):
+    """Stands in for the RSA check: only the holder of `pem` can produce the signature"""
+    return signature == 'signed %s with %s' % (message, pem)
+
+
+class FakeGatherer(object):
+    host = 'h1'
+
+
+class FakePushFactory(MetricsPushFactory):
+
+    def get_gatherer(self, minion_id):
+        return defer.succeed(FakeGatherer())
+
+
+class MetricsPushTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(2, 3, clock=lambda: self.now)
+        assert [bucket.consume() for i in xrange(4)] == [True, True, True, False]
+
+        self.now += 1
+        assert bucket.consume() and bucket.consume() and not bucket.consume()
+
+    def test_push_registry(self):
+        registry = PushRegistry(ttl=5, clock=lambda: self.now)
+        assert not registry.is_pushing('h1')
+
+        registry.seen('h1')
+        self.now += 5
+        assert registry.is_pushing('h1')
+        self.now += 1
+        assert not registry.is_pushing('h1')
+
+
+class MetricsPushAuthTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pki_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.pki_dir, 'minions'))
+        with open(os.path.join(self.pki_dir, 'minions', 'h1'), 'w') as f:
+            f.write('h1 key')
+        self.factory = FakePushFactory(self.pki_dir, 'sha256', 2, 10, registry=PushRegistry(),
+                                       verify=fake_verify)
+
+    def tearDown(self):
+        shutil.rmtree(self.pki_dir)
+
+    def connect(self):
+        protocol = self.factory.buildProtocol(None)
+        transport = StringTransport()
+        protocol.makeConnection(transport)
+        command, nonce = transport.value().split()
+        assert command == 'NONCE'
+        transport.clear()
+        return protocol, transport, nonce
+
+    def auth(self, protocol, minion_id, signature):
+        protocol.dataReceived('AUTH %s %s\n' % (minion_id, base64.b64encode(signature)))
+
+    def test_signed_nonce(self):
+        protocol, transport, nonce = self.connect()
+        self.auth(protocol, 'h1', 'signed %s with h1 key' % nonce)
+        assert transport.value() == 'OK\n'
+        assert protocol.minion_id == 'h1' and not transport.disconnecting
+
+    def test_fingerprint_without_key(self):
+        # the fingerprint of the public key is no proof of holding the private one
+        protocol, transport, nonce = self.connect()
+        protocol.dataReceived('AUTH h1 6b:26:02:28:0e:0f:b1:9c:fe:32:60:63:c4:ec:d5:3c\n')
+        assert transport.value().startswith('ERR ')
+        assert transport.disconnecting and protocol.minion_id is None
+        assert self.factory.stats['rejected'] == 1
+
+    def test_replayed_signature(self):
+        protocol, transport, nonce = self.connect()
+        other_protocol, other_transport, other_nonce = self.connect()
+        assert nonce != other_nonce
+
+        self.auth(other_protocol, 'h1', 'signed %s with h1 key' % nonce)
+        assert other_transport.value().startswith('ERR ') and other_transport.disconnecting
+
+    def test_unknown_minion(self):
+        protocol, transport, nonce = self.connect()
+        self.auth(protocol, '../h1', 'signed %s with h1 key' % nonce)
+        assert transport.value().startswith('ERR ')
+
+
+class VerifySignatureTest(unittest.TestCase):
+
+    def setUp(self):
+        if RSA is None:
+            self.skipTest('M2Crypto is not installed')
+        self.key = RSA.gen_key(1024, 65537, lambda *args: None)
+        bio = BIO.MemoryBuffer()
+        self.key.save_pub_key_bio(bio)
+        self.pem = bio.read()
+
+    def test_verify_signature(self):
+        signature = self.key.sign(hashlib.sha256('nonce').digest(), 'sha256')
+        assert verify_signature(self.pem, 'nonce', signature)
+        assert not verify_signature(self.pem, 'other nonce', signature)
+        assert not verify_signature(self.pem, 'nonce', 'not a signature')
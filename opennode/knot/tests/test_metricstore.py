@@ -0,0 +1,183 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from twisted.internet import task
+
+from opennode.knot.backend import metricstore
+from opennode.knot.backend.metricsquery import aggregate_series, bucketize, percentile
+from opennode.knot.backend.metricstore import MetricStore, MetricStoreStream, Segment
+
+
+class FakeStream(object):
+
+    def __init__(self):
+        self.items = []
+
+    def add(self, item):
+        self.items.append(item)
+
+
+class MetricStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = MetricStore(self.directory, segment_size=10, memory_segments=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_segment_roundtrip(self):
+        segment = Segment(1000, 5)
+        for i in xrange(5):
+            segment.append(1000 + i * 500, i * 1.5)
+        assert not segment.accepts(4000)
+
+        loaded = Segment.loads(segment.dumps())
+        assert loaded.points() == segment.points()
+        assert loaded.points(1500, 2000) == [(1500, 1.5), (2000, 3.0)]
+
+    def test_roll_to_disk(self):
+        self.store.add_many('/machines/a/metrics/cpu', [(i * 1000, i) for i in xrange(35)])
+
+        series = self.store.series['/machines/a/metrics/cpu']
+        assert self.store.memory_points == 15
+        assert len(series.files) == 2
+        assert os.path.exists(os.path.join(series.directory, series.files[0][3]))
+
+        points = self.store.read('/machines/a/metrics/cpu')
+        assert points == [(i * 1000, float(i)) for i in xrange(35)]
+        assert self.store.read('/machines/a/metrics/cpu', 8000, 12000) == [(i * 1000, float(i))
+                                                                           for i in xrange(8, 13)]
+        assert self.store.last('/machines/a/metrics/cpu') == (34000, 34.0)
+
+    def test_reopen_reads_rolled_segments(self):
+        self.store.add_many('/machines/a/metrics/cpu', [(i * 1000, i) for i in xrange(25)])
+
+        store = MetricStore(self.directory, segment_size=10, memory_segments=2)
+        assert store.read('/machines/a/metrics/cpu', limit=3) == [(7000, 7.0), (8000, 8.0), (9000, 9.0)]
+
+    def test_rejects_bad_points(self):
+        assert self.store.add('/m/cpu', 2000, 1)
+        assert not self.store.add('/m/cpu', 1000, 1)
+        assert not self.store.add('/m/cpu', 3000, 'n/a')
+        assert self.store.read('/m/cpu') == [(2000, 1.0)]
+
+
+    def test_numeric_points_skip_default_stream(self):
+        stream = MetricStoreStream.__new__(MetricStoreStream)
+        stream.key = '/m/a/cpu'
+        stream.fallback = FakeStream()
+        self.addCleanup(setattr, metricstore, '_store', metricstore._store)
+        metricstore._store = self.store
+
+        stream.add_many([(1000, 1), (2000, (0.1, 0.2, 0.3)), (3000, 2.5)])
+        assert self.store.read('/m/a/cpu') == [(1000, 1), (3000, 2.5)]
+        # only what the store cannot hold reaches the generic stream
+        assert stream.fallback.items == [(2000, (0.1, 0.2, 0.3))]
+
+
+class RollupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = MetricStore(self.directory, segment_size=100, memory_segments=1, raw_retention=60,
+                                 tiers=[(60, 3600), (3600, 86400)])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_tier_for(self):
+        assert self.store.tier_for(None) is None
+        assert self.store.tier_for(1) is None
+        assert self.store.tier_for(300) == (60, 3600)
+        assert self.store.tier_for(86400) == (3600, 86400)
+
+    def test_buckets(self):
+        # one point per second over 3 minutes, the value being the second of the minute
+        self.store.add_many('/m/cpu', [(i * 1000, i % 60) for i in xrange(180)])
+
+        assert self.store.read('/m/cpu', resolution=60) == [(0, 29.5), (60000, 29.5), (120000, 29.5)]
+        assert self.store.memory_points == sum(s.memory_points for s in self.store.series.itervalues())
+        assert self.store.read('/m/cpu', resolution=60, aggregate='max') == [(0, 59.0), (60000, 59.0),
+                                                                             (120000, 59.0)]
+        assert self.store.read('/m/cpu', 60000, 60000, resolution=60, aggregate='min') == [(60000, 0.0)]
+        assert self.store.read('/m/cpu', resolution=3600, aggregate='last') == [(0, 59.0)]
+        self.assertRaises(ValueError, self.store.read, '/m/cpu', resolution=60, aggregate='p99')
+
+    def test_raw_retention(self):
+        self.store.add_many('/m/cpu', [(i * 1000, i) for i in xrange(500)])
+        assert self.store.read('/m/cpu')[0] == (300000, 300.0)
+
+
+class MetricsQueryTest(unittest.TestCase):
+
+    def test_aggregate_series(self):
+        hosts = [bucketize([(0, 1.0), (30000, 3.0), (60000, 4.0)], 60),
+                 bucketize([(0, 6.0), (60000, 2.0)], 60)]
+
+        assert aggregate_series(hosts, 60, 'sum') == [[0, 8.0], [60000, 6.0]]
+        assert aggregate_series(hosts, 60, 'max') == [[0, 6.0], [60000, 4.0]]
+        assert aggregate_series(hosts, 60, 'avg') == [[0, 4.0], [60000, 3.0]]
+
+    def test_percentile(self):
+        assert percentile(range(1, 101), 95) == 95
+        assert percentile([7], 95) == 7
+
+
+class MetricStoreGcTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = MetricStore(self.directory, segment_size=10, memory_segments=1,
+                                 retention={'cpu': (60, None), 'load': (None, 15)}, memory_budget=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_memory_budget_evicts_lru(self):
+        self.store.add_many('/m/a/cpu', [(i * 1000, i) for i in xrange(5)])
+        self.store.add_many('/m/b/cpu', [(i * 1000, i) for i in xrange(8)])
+
+        assert self.store.enforce_budget() == 5
+        assert '/m/a/cpu' not in self.store.series and self.store.memory_points == 8
+        assert self.store.read('/m/a/cpu') == [(i * 1000, float(i)) for i in xrange(5)]
+
+    def test_gc(self):
+        for i in xrange(4):
+            # partial segments written by successive evictions
+            self.store.add_many('/m/a/load', [(i * 5000 + j * 1000, j) for j in xrange(5)])
+            self.store.evict('/m/a/load')
+        self.store.add_many('/m/a/cpu', [(i * 1000, i) for i in xrange(5)])
+        self.store.evict('/m/a/cpu')
+        assert self.store.memory_points == 0
+
+        # the oldest load segment was trimmed at the last flush already
+        assert len(self.store.read('/m/a/load')) == 15
+
+        report = self.store.gc(now=1000000)
+        assert report['series'] == 2 and report['removed_series'] == 1
+        assert report['expired_points'] == 5
+        assert report['merged_files'] == 2 and report['reclaimed_bytes'] > 0
+        assert self.store.read('/m/a/load') == [(i * 5000 + j * 1000, float(j)) for i in xrange(1, 4)
+                                                for j in xrange(5)]
+
+    def test_cooperative_gc(self):
+        for key in ('/m/a/load', '/m/a/cpu', '/m/b/cpu'):
+            self.store.add_many(key, [(j * 1000, j) for j in xrange(5)])
+            self.store.evict(key)
+
+        # one series per iteration, each run by hand
+        calls = []
+        cooperator = task.Cooperator(terminationPredicateFactory=lambda: lambda: True,
+                                     scheduler=calls.append)
+        reports = []
+        self.store.cooperative_gc(now=1000000, cooperator=cooperator).addCallback(reports.append)
+
+        steps = 0
+        while calls:
+            calls.pop(0)()
+            steps += 1
+        assert steps >= 3
+        assert reports[0]['series'] == 3 and reports[0]['removed_series'] == 2
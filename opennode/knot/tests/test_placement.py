@@ -0,0 +1,88 @@
+import unittest
+
+from opennode.knot.backend.placement import BestFitStrategy, Demand, HostCapacity, LeastLoadedStrategy
+from opennode.knot.backend.placement import PlacementTable, SpreadStrategy
+
+
+NO_OVERCOMMIT = {'memory': False, 'disk': False, 'cores': False}
+
+
+def capacity(host, memory, load=0.0, templates=(u'centos',), backend=u'openvz'):
+    return HostCapacity(host, host, backend, memory, 100000, 4, load, set(templates))
+
+
+class PlacementTableTest(unittest.TestCase):
+
+    def make_table(self, strategy):
+        self.now = 1000
+        table = PlacementTable(strategy, refresh_interval=60, clock=lambda: self.now)
+        table.load([capacity('h1', 4096, load=0.5), capacity('h2', 1024, load=0.1),
+                    capacity('h3', 8192, load=0.9), capacity('h4', 16384, templates=())])
+        return table
+
+    def test_best_fit(self):
+        table = self.make_table(BestFitStrategy())
+        demand = Demand(1000, 1000, 1, u'centos')
+
+        assert table.place('vm1', u'openvz', demand, NO_OVERCOMMIT).host == 'h2'
+        # h2 is left with 24 MB
+        assert table.place('vm2', u'openvz', demand, NO_OVERCOMMIT).host == 'h1'
+        assert table.place('vm3', u'openvz', Demand(9000, 0, 1, u'centos'), NO_OVERCOMMIT) is None
+        assert table.place('vm4', u'kvm', demand, NO_OVERCOMMIT) is None
+
+        explanation = table.explain(u'openvz', Demand(9000, 0, 1, u'centos'), NO_OVERCOMMIT)
+        assert explanation['h4'] == 'Template is unavailable'
+        assert explanation['h1'].startswith('Has 3096 MB free memory')
+
+    def test_spread(self):
+        table = self.make_table(SpreadStrategy())
+        demand = Demand(6000, 0, 1, u'centos')
+
+        assert table.place('vm1', u'openvz', demand, NO_OVERCOMMIT).host == 'h3'
+        assert table.place('vm2', u'openvz', demand, NO_OVERCOMMIT) is None
+        assert table.place('vm2', u'openvz', demand, dict(NO_OVERCOMMIT, memory=True)).host == 'h1'
+
+    def test_least_loaded(self):
+        table = self.make_table(LeastLoadedStrategy())
+        assert table.place('vm1', u'openvz', Demand(2000, 0, 1, u'centos'), NO_OVERCOMMIT).host == 'h1'
+
+    def test_reservations(self):
+        table = self.make_table(BestFitStrategy())
+        demand = Demand(1000, 1000, 1, u'centos')
+
+        table.place('vm1', u'openvz', demand, NO_OVERCOMMIT)
+        assert table.backends[u'openvz'].hosts['h2'].memory == 24
+
+        table.release('vm1')
+        assert table.backends[u'openvz'].hosts['h2'].memory == 1024
+
+        table.place('vm1', u'openvz', demand, NO_OVERCOMMIT)
+        table.place('vm2', u'openvz', demand, NO_OVERCOMMIT)
+
+        # vm1 is deployed and accounted for by the fresh read, vm2 is still deploying
+        table.load([capacity('h1', 4096), capacity('h2', 24)], deployed=set([('vm1', 'h2')]))
+        assert table.pending.keys() == ['vm2']
+        assert table.backends[u'openvz'].hosts['h1'].memory == 3096
+
+        table.undeployed('h2', u'openvz', demand)
+        assert table.backends[u'openvz'].hosts['h2'].memory == 1024
+        assert [key for key, host in table.backends[u'openvz'].keys] == [1024, 3096]
+
+        self.now += PlacementTable.pending_ttl + 1
+        table.load([capacity('h1', 4096)])
+        assert not table.pending
+
+    def test_backends_share_host(self):
+        table = PlacementTable(BestFitStrategy(), clock=lambda: 1000)
+        table.load([capacity('h1', 4096), capacity('h1', 4096, backend=u'kvm'), capacity('h2', 2048)])
+        demand = Demand(3000, 1000, 1, u'centos')
+
+        assert table.place('vm1', u'openvz', demand, NO_OVERCOMMIT).host == 'h1'
+        # the memory reserved through the openvz container is gone from the kvm one too
+        assert table.backends[u'kvm'].hosts['h1'].memory == 1096
+        assert table.backends[u'kvm'].hosts['h1'].disk == 99000
+        assert table.place('vm2', u'kvm', demand, NO_OVERCOMMIT) is None
+
+        table.release('vm1')
+        assert table.backends[u'kvm'].hosts['h1'].memory == 4096
+        assert table.place('vm2', u'kvm', demand, NO_OVERCOMMIT).host == 'h1'
@@ -0,0 +1,154 @@
+import json
+import unittest
+
+from twisted.internet import defer
+from twisted.internet.error import ProcessTerminated
+from twisted.internet.task import Clock
+
+from opennode.knot.backend import salt
+from opennode.knot.backend import subprocess
+from opennode.knot.backend.operation import OperationRemoteError
+from opennode.knot.backend.salt import BatchingSaltExecutor, SaltBatch, json_loads_merged
+
+
+class FakeSalt(object):
+    """Stands in for async_check_output: records the salt invocations and lets the test end them"""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, args, killhook=None, max_output=None):
+        d = defer.Deferred()
+        self.calls.append((args, killhook, d))
+        return d
+
+    def hosts(self, i=-1):
+        args = self.calls[i][0]
+        return args[args.index('-L') + 1].split(',')
+
+    def finish(self, data, i=-1):
+        self.calls[i][2].callback(json.dumps(data))
+
+    def fail(self, data, exit_code=2, i=-1):
+        error = ProcessTerminated(exitCode=exit_code)
+        error.output = json.dumps(data) if data is not None else ''
+        self.calls[i][2].errback(error)
+
+
+class BatchingSaltExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.salt = FakeSalt()
+        self.async_check_output = subprocess.async_check_output
+        subprocess.async_check_output = self.salt
+        BatchingSaltExecutor.clock = self.clock = Clock()
+        BatchingSaltExecutor._pending.clear()
+        BatchingSaltExecutor._unresponsive.clear()
+
+    def tearDown(self):
+        subprocess.async_check_output = self.async_check_output
+        BatchingSaltExecutor.clock = salt.reactor
+        BatchingSaltExecutor._unresponsive.clear()
+
+    def call(self, hostname, killhook=None):
+        results = []
+        executor = BatchingSaltExecutor(hostname, 'test.ping', None, timeout=5)
+        d = executor.run(__killhook=killhook) if killhook else executor.run()
+        d.addCallbacks(lambda r: results.append(r), lambda f: results.append(f.value))
+        return results
+
+    def test_split(self):
+        r1, r2 = self.call('h1'), self.call('h2')
+        assert self.salt.calls == []
+
+        self.clock.advance(1)
+        assert len(self.salt.calls) == 1
+        assert self.salt.hosts() == ['h1', 'h2']
+
+        self.salt.finish({'h1': True, 'h2': {'load': 1}})
+        assert r1 == [True]
+        assert r2 == [{'load': 1}]
+
+    def test_missing_host(self):
+        r1, r2 = self.call('h1'), self.call('h2')
+        self.clock.advance(1)
+        # salt exits with an error when a minion did not return
+        self.salt.fail({'h1': True})
+
+        assert r1 == [True]
+        assert isinstance(r2[0], OperationRemoteError)
+        assert 'empty response' in r2[0].message
+
+        # the host that did not return is called on its own until it answers again
+        r2, r3 = self.call('h2'), self.call('h3')
+        self.clock.advance(1)
+        assert '-L' not in self.salt.calls[1][0] and 'h2' in self.salt.calls[1][0]
+        assert self.salt.hosts(2) == ['h3']
+
+        self.salt.finish({'h2': True}, i=1)
+        assert r2 == [True]
+        assert not BatchingSaltExecutor._unresponsive
+
+    def test_process_failure(self):
+        r1, r2 = self.call('h1'), self.call('h2')
+        self.clock.advance(1)
+        self.salt.fail(None, exit_code=1)
+
+        assert [type(r) for r in r1 + r2] == [ProcessTerminated, ProcessTerminated]
+
+    def test_single_host_key_fallback(self):
+        r1, r2 = self.call('h1'), self.call('h2')
+        self.clock.advance(1)
+        self.salt.finish({'h1': True, 'h2.example.com': False})
+
+        assert r1 == [True]
+        assert r2 == [False]
+
+    def test_remote_traceback(self):
+        r1, r2 = self.call('h1'), self.call('h2')
+        self.clock.advance(1)
+        self.salt.finish({'h1': 'Traceback (most recent call last):\n  ...', 'h2': True})
+
+        assert isinstance(r1[0], OperationRemoteError)
+        assert r1[0].remote_tb.startswith('Traceback')
+        assert r2 == [True]
+
+    def test_killhook_detach(self):
+        k1, k2 = defer.Deferred(), defer.Deferred()
+        r1, r2 = self.call('h1', k1), self.call('h2', k2)
+        self.clock.advance(1)
+        process_killhook = self.salt.calls[0][1]
+
+        k1.callback(None)
+        assert isinstance(r1[0], OperationRemoteError)
+        # the process is only killed once every caller left
+        assert not process_killhook.called
+
+        k2.callback(None)
+        assert process_killhook.called
+        self.salt.fail(None, exit_code=None)
+        assert len(r1) == len(r2) == 1
+
+    def test_max_hosts_flush(self):
+        results = [self.call('h%s' % i) for i in xrange(200)]
+        # the batch is full, it does not wait for the window
+        assert len(self.salt.calls) == 1
+        assert len(self.salt.hosts()) == 200
+        assert not self.clock.getDelayedCalls()
+
+        self.salt.finish(dict(('h%s' % i, i) for i in xrange(200)))
+        assert [r[0] for r in results] == range(200)
+
+
+class SaltBatchTest(unittest.TestCase):
+
+    def test_split(self):
+        assert SaltBatch.split(['h1', 'h2'], {'h1': 1, 'h2': 2}) == {'h1': {'h1': 1}, 'h2': {'h2': 2}}
+        assert SaltBatch.split(['h1', 'h2'], {'h1': 1, 'x': 2}) == {'h1': {'h1': 1}, 'h2': {'x': 2}}
+        # ambiguous keys are not guessed
+        assert SaltBatch.split(['h1', 'h2', 'h3'], {'h1': 1, 'x': 2, 'y': 3}) == {'h1': {'h1': 1}}
+
+    def test_json_loads_merged(self):
+        assert json_loads_merged('{"h1": 1}\n{"h2": [2]}\n') == {'h1': 1, 'h2': [2]}
+        assert json_loads_merged('  ') == {}
+        self.assertRaises(TypeError, json_loads_merged, '{"h1": 1} [2]')
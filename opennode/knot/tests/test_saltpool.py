@@ -0,0 +1,154 @@
+import os
+import select
+import unittest
+
+from twisted.internet.task import Clock
+
+from opennode.knot.backend.operation import OperationRemoteError
+from opennode.knot.backend.salt.pool import FrameBuffer, SaltWorker, SaltWorkerPool, frame, send_result
+
+
+class FakeWorker(object):
+    """Records the jobs dispatched by the pool instead of running them in a process"""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.job = None
+        self.jobs = []
+        self.killed = False
+
+    def dispatch(self, job):
+        self.job = job
+        self.jobs.append(job)
+
+    def stop(self, kill=False):
+        self.killed = kill
+
+
+def echo_worker(conn, result_fd, c_path):
+    """Stands in for the LocalClient worker: returns the arguments of each job, dies on 'die'"""
+    while True:
+        job = conn.recv()
+        if job is None:
+            return
+        job_id, hostname, action, args, timeout = job
+        if action == 'die':
+            os._exit(1)
+        # large enough to need several reads
+        send_result(result_fd, job_id, {hostname: list(args) + ['x' * 300000]})
+
+
+class FakePool(object):
+
+    def __init__(self):
+        self.done = []
+        self.lost = []
+
+    def job_done(self, worker, job_id, data):
+        self.done.append((job_id, data))
+
+    def worker_lost(self, worker):
+        self.lost.append(worker)
+
+
+class FrameBufferTest(unittest.TestCase):
+
+    def test_partial_messages(self):
+        data = frame((1, {'h1': True})) + frame((2, {'h2': 'x' * 1000}))
+        buf = FrameBuffer()
+
+        assert buf.feed(data[:3]) == []
+        assert buf.feed(data[3:20]) == []
+        assert buf.feed(data[20:-1]) == [(1, {'h1': True})]
+        assert buf.feed(data[-1:]) == [(2, {'h2': 'x' * 1000})]
+        assert buf.data == ''
+
+
+class SaltWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = FakePool()
+        self.worker = SaltWorker(self.pool, target=echo_worker)
+
+    def tearDown(self):
+        self.worker.stop(kill=True)
+
+    def read_until(self, condition):
+        while not condition():
+            assert select.select([self.worker.fileno()], [], [], 5)[0], 'worker did not answer'
+            self.worker.doRead()
+
+    def test_round_trip(self):
+        self.worker.conn.send((7, 'h1', 'test.ping', ('a',), None))
+        self.read_until(lambda: self.pool.done)
+        assert self.pool.done == [(7, {'h1': ['a', 'x' * 300000]})]
+
+    def test_worker_death(self):
+        self.worker.conn.send((8, 'h1', 'die', (), None))
+        self.read_until(lambda: self.pool.lost)
+        assert self.pool.lost == [self.worker] and self.worker.stopped
+
+
+class SaltWorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.workers = []
+        self.pool = SaltWorkerPool(1, 60, worker_factory=self.make_worker, clock=self.clock)
+
+    def make_worker(self, pool):
+        worker = FakeWorker(pool)
+        self.workers.append(worker)
+        return worker
+
+    def test_round_trip(self):
+        results = []
+        job1 = self.pool.submit('h1', 'test.ping', ())
+        job2 = self.pool.submit('h2', 'test.ping', ())
+        job1.deferred.addCallback(results.append)
+        job2.deferred.addCallback(results.append)
+        worker, = self.workers
+        assert worker.job is job1 and len(self.pool.queue) == 1
+
+        self.pool.job_done(worker, job1.id, {'h1': True})
+        assert results == [{'h1': True}]
+        assert worker.job is job2
+
+        # a late result of a previous job is discarded
+        self.pool.job_done(worker, job1.id, {'h1': True})
+        self.pool.job_done(worker, job2.id, {'h2': True})
+        assert results == [{'h1': True}, {'h2': True}]
+        assert self.pool.idle == [worker] and not self.clock.getDelayedCalls()
+
+    def test_cancel(self):
+        errors = []
+        job1 = self.pool.submit('h1', 'test.ping', ())
+        job2 = self.pool.submit('h2', 'test.ping', ())
+        job1.deferred.addErrback(lambda f: errors.append(f.check(OperationRemoteError)))
+
+        self.pool.cancel(job1)
+        assert errors == [OperationRemoteError]
+        assert self.workers[0].killed
+        # the queued job runs on a replacement worker
+        assert len(self.workers) == 2 and self.workers[1].job is job2
+
+    def test_worker_death(self):
+        errors = []
+        job = self.pool.submit('h1', 'test.ping', ())
+        job.deferred.addErrback(lambda f: errors.append(f.value))
+
+        self.pool.worker_lost(self.workers[0])
+        assert 'died' in str(errors[0])
+        assert self.pool.workers == []
+
+        self.pool.submit('h1', 'test.ping', ())
+        assert len(self.workers) == 2 and self.pool.workers == [self.workers[1]]
+
+    def test_hard_timeout(self):
+        errors = []
+        job = self.pool.submit('h1', 'test.ping', (), timeout=5)
+        job.deferred.addErrback(lambda f: errors.append(f.value))
+
+        self.clock.advance(61)
+        assert 'Timeout' in str(errors[0])
+        assert self.workers[0].killed and self.pool.workers == []
@@ -0,0 +1,95 @@
+import unittest
+
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from opennode.knot.backend.scheduler import BoundedScheduler, JobTimeoutError
+
+
+class BoundedSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.started = []
+        self.pending = {}
+
+    def job(self, killhook, key):
+        self.started.append(key)
+        d = defer.Deferred()
+        self.pending[key] = d
+        return d
+
+    def test_max_concurrency(self):
+        scheduler = BoundedScheduler(2, clock=self.clock)
+        for key in ('a', 'b', 'c'):
+            scheduler.submit(key, self.job, key)
+
+        assert self.started == ['a', 'b']
+        assert scheduler.running == 2 and scheduler.waiting == 1
+
+        self.pending['a'].callback(None)
+        assert self.started == ['a', 'b', 'c']
+        assert scheduler.new_cycle()['completed'] == 1
+
+    def test_priority_and_skip(self):
+        scheduler = BoundedScheduler(1, clock=self.clock)
+        scheduler.submit('a', self.job, 'a')
+        scheduler.submit('b', self.job, 'b')
+        scheduler.submit('c', self.job, 'c', priority=-1)
+
+        assert scheduler.submit('a', self.job, 'a') is None
+        assert scheduler.submit('b', self.job, 'b') is None
+
+        self.pending['a'].callback(None)
+        assert self.started == ['a', 'c']
+        assert scheduler.stats['skipped'] == 2
+
+    def test_timeout_fires_killhook(self):
+        killed = []
+
+        def job(killhook):
+            killhook.addCallback(lambda r: killed.append(True))
+            return defer.Deferred()
+
+        scheduler = BoundedScheduler(1, timeout=10, clock=self.clock)
+        errors = []
+        d = scheduler.submit('a', job)
+        d.addErrback(lambda f: errors.append(f.check(JobTimeoutError)))
+
+        self.clock.advance(11)
+        assert killed == [True]
+        assert errors == [JobTimeoutError]
+        assert scheduler.stats['timed_out'] == 1
+
+    def test_timed_out_job_holds_its_slot(self):
+        scheduler = BoundedScheduler(1, timeout=10, clock=self.clock)
+        errors = []
+        scheduler.submit('a', self.job, 'a').addErrback(lambda f: errors.append(f.check(JobTimeoutError)))
+        scheduler.submit('b', self.job, 'b')
+
+        # 'a' ignores the killhook and keeps running
+        self.clock.advance(11)
+        assert errors == [JobTimeoutError]
+        assert scheduler.is_pending('a')
+        assert scheduler.submit('a', self.job, 'a') is None
+        assert self.started == ['a'] and scheduler.running == 1
+
+        self.pending['a'].callback(None)
+        assert not scheduler.is_pending('a')
+        assert self.started == ['a', 'b']
+        assert scheduler.stats['completed'] == 0
+
+    def test_cancel_queued(self):
+        scheduler = BoundedScheduler(1, clock=self.clock)
+        errors = []
+        scheduler.submit('a', self.job, 'a')
+        d = scheduler.submit('b', self.job, 'b')
+        d.addErrback(lambda f: errors.append(f.check(defer.CancelledError)))
+
+        assert scheduler.cancel('b')
+        assert errors == [defer.CancelledError]
+        assert not scheduler.is_pending('b')
+
+        self.pending['a'].callback(None)
+        assert self.started == ['a']
+        assert not scheduler.cancel('b')
@@ -0,0 +1,127 @@
+import json
+import unittest
+
+from twisted.internet import defer
+from twisted.internet.error import ProcessDone, ProcessExitedAlready, ProcessTerminated
+from twisted.python.failure import Failure
+
+from opennode.knot.backend import salt
+from opennode.knot.backend.salt import decode_output
+from opennode.knot.backend.subprocess import OutputLimitExceeded, async_check_output, kill_process
+
+
+class FakeTransport(object):
+
+    def __init__(self, exited=False):
+        self.exited = exited
+        self.signals = []
+
+    def signalProcess(self, signal):
+        if self.exited:
+            raise ProcessExitedAlready()
+        self.signals.append(signal)
+
+
+class FakeReactor(object):
+    """Spawns no process, the test feeds the protocol instead"""
+
+    def spawnProcess(self, protocol, *args, **kwargs):
+        self.protocol = protocol
+        self.transport = FakeTransport()
+        protocol.makeConnection(self.transport)
+
+
+class FakeThreads(object):
+    """Runs the functions deferred to a thread right away, recording them"""
+
+    def __init__(self):
+        self.calls = []
+
+    def deferToThread(self, fn):
+        self.calls.append(fn)
+        return defer.maybeDeferred(fn)
+
+
+class SubprocessTest(unittest.TestCase):
+
+    def spawn(self, max_output=None, killhook=None):
+        self.reactor = FakeReactor()
+        results = []
+        d = async_check_output(['salt'], self.reactor, killhook=killhook, max_output=max_output)
+        d.addBoth(results.append)
+        return results
+
+    def test_chunks(self):
+        results = self.spawn()
+        for chunk in ('{"h1": ', '[1, 2', ']}'):
+            self.reactor.protocol.outReceived(chunk)
+        self.reactor.protocol.errReceived('warning')
+
+        assert self.reactor.protocol.outBuffer == '{"h1": [1, 2]}'
+        assert self.reactor.protocol.errBuffer == 'warning'
+
+        self.reactor.protocol.processEnded(Failure(ProcessDone(0)))
+        assert results == ['{"h1": [1, 2]}']
+
+    def test_max_output(self):
+        results = self.spawn(max_output=10)
+        self.reactor.protocol.outReceived('x' * 8)
+        assert self.reactor.transport.signals == []
+
+        self.reactor.protocol.outReceived('x' * 8)
+        assert self.reactor.transport.signals == ['KILL']
+        # the output is dropped and no longer collected
+        self.reactor.protocol.outReceived('x' * 8)
+        assert self.reactor.protocol.outBuffer == ''
+
+        self.reactor.protocol.processEnded(Failure(ProcessTerminated(signal=9)))
+        assert results[0].check(OutputLimitExceeded)
+
+    def test_failure_keeps_output(self):
+        results = self.spawn()
+        self.reactor.protocol.outReceived('{"h1": true}')
+        self.reactor.protocol.processEnded(Failure(ProcessTerminated(exitCode=2)))
+
+        assert results[0].check(ProcessTerminated)
+        assert results[0].value.output == '{"h1": true}'
+
+    def test_kill_exited_process(self):
+        killhook = defer.Deferred()
+        results = self.spawn(killhook=killhook)
+        self.reactor.protocol.processEnded(Failure(ProcessDone(0)))
+        self.reactor.transport.exited = True
+
+        # a late killhook does not raise
+        killhook.callback(None)
+        assert results == ['']
+        kill_process(FakeTransport(exited=True))
+
+
+class DecodeOutputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.threads = salt.threads
+        salt.threads = FakeThreads()
+
+    def tearDown(self):
+        salt.threads = self.threads
+
+    def decode(self, output, merged=False):
+        results = []
+        decode_output(output, merged=merged).addBoth(results.append)
+        return results[0]
+
+    def test_small_output(self):
+        assert self.decode('') == {}
+        assert self.decode('{"h1": 1}') == {'h1': 1}
+        assert self.decode('{"h1": 1}\n{"h2": 2}', merged=True) == {'h1': 1, 'h2': 2}
+        assert salt.threads.calls == []
+
+    def test_large_output(self):
+        threshold = salt.get_config().getint('salt', 'json_thread_threshold')
+        data = {'h1': ['x' * 1000] * (threshold / 1000 + 1)}
+
+        assert self.decode(json.dumps(data)) == data
+        assert self.decode(json.dumps(data) + '\n' + json.dumps({'h2': 2}), merged=True) == \
+            dict(data, h2=2)
+        assert len(salt.threads.calls) == 2
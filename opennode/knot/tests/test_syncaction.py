@@ -0,0 +1,136 @@
+import unittest
+
+from twisted.internet import defer
+from twisted.python import failure
+
+from opennode.knot.backend import syncaction
+from opennode.knot.backend.capabilities import capabilities
+from opennode.knot.backend.fingerprint import fingerprints
+from opennode.knot.backend.operation import OperationRemoteError
+from opennode.knot.backend.syncaction import SyncAction
+
+
+class FakeHost(object):
+    __name__ = 'h1'
+
+    def __str__(self):
+        return self.__name__
+
+
+class FakeOperation(object):
+    """Stands in for the adapters of the remote operations, counting their calls"""
+
+    def __init__(self, result, calls):
+        self.result = result
+        self.calls = calls
+
+    def __call__(self, context, default=None):
+        return self
+
+    def run(self):
+        self.calls.append(self)
+        if isinstance(self.result, Exception):
+            return defer.fail(self.result)
+        return defer.succeed(self.result)
+
+
+def result_of(d):
+    results = []
+    d.addBoth(results.append)
+    if isinstance(results[0], failure.Failure):
+        results[0].raiseException()
+    return results[0]
+
+
+def hardware(used=1024):
+    return {'info': {'cpuModel': 'x86', 'kernelVersion': '2.6.32'},
+            'uptime': 1000.0,
+            'disk_usage': {'/': {'device': '/dev/sda1', 'total': 4096, 'used': used},
+                           '/proc': {'device': 'proc', 'total': 0, 'used': 0}}}
+
+
+class SyncActionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.patched = {}
+        self.patch(syncaction.db, 'get', lambda obj, name: defer.succeed(getattr(obj, name)))
+        self.patch(syncaction, 'any_stack_installed', lambda context: True)
+
+        self.action = SyncAction(FakeHost())
+        self.action.timings = []
+        fingerprints.forget('h1')
+        capabilities.forget('h1')
+
+    def tearDown(self):
+        for (obj, name), value in self.patched.iteritems():
+            setattr(obj, name, value)
+        fingerprints.forget('h1')
+        capabilities.forget('h1')
+
+    def patch(self, obj, name, value):
+        self.patched.setdefault((obj, name), getattr(obj, name))
+        setattr(obj, name, value)
+
+    def test_unchanged_hardware(self):
+        info, disk_space, disk_used, routes, uptime, digest = result_of(
+            self.action.prepare_hw(False, hardware()))
+        assert disk_space == {u'/': 4.0, u'total': 4.0}
+        assert disk_used == {u'/': 1.0, u'total': 1.0}
+        fingerprints.update('h1', 'hardware', digest)
+
+        # the used disk space does not count as a hardware change
+        assert result_of(self.action.prepare_hw(False, hardware(used=2048))) == \
+            (None, None, {u'/': 2.0, u'total': 2.0}, None, None, None)
+
+        # full syncs apply the hardware data anyway
+        full = result_of(self.action.prepare_hw(True, hardware(used=2048)))
+        assert full[0] == hardware()['info'] and full[-1] == digest
+
+    def test_fetch_calls(self):
+        def fail():
+            raise OperationRemoteError(msg='Remote error on h1')
+
+        remote = result_of(self.action.fetch_calls({'info': lambda: {'numCpus': 2},
+                                                    'uptime': lambda: defer.succeed(1000.0),
+                                                    'disk_usage': fail}))
+
+        assert remote['info'] == {'numCpus': 2}
+        assert remote['uptime'] == 1000.0
+        assert isinstance(remote['disk_usage'], failure.Failure)
+        assert remote['disk_usage'].check(OperationRemoteError)
+        assert sorted(stage for stage, duration in self.action.timings) == \
+            ['fetch-disk_usage', 'fetch-info', 'fetch-uptime']
+
+    def fake_operations(self, inventory):
+        calls = []
+        self.action.get_fetch_targets = lambda full: defer.succeed(([], False, None))
+        for name, value in (('IGetComputeInfo', {'numCpus': 2}), ('IGetHWUptime', 1000.0),
+                            ('IGetDiskUsage', {}), ('IGetInventory', inventory)):
+            self.patch(syncaction, name, FakeOperation(value, calls))
+        return calls
+
+    def test_unsupported_inventory(self):
+        calls = self.fake_operations(OperationRemoteError(msg="'onode.inventory' is not available."))
+        # the inventory worked before the agent got downgraded, so it covers the individual calls
+        capabilities.mark_supported('h1', 'inventory')
+
+        remote = result_of(self.action.fetch_remote(False))
+
+        assert not capabilities.supported('h1', 'inventory')
+        assert remote == {'info': {'numCpus': 2}, 'uptime': 1000.0, 'disk_usage': {}}
+        assert len(calls) == 4
+
+        # the next syncs only issue the individual calls
+        del calls[:]
+        result_of(self.action.fetch_remote(False))
+        assert len(calls) == 3
+
+    def test_inventory(self):
+        inventory = {'hardware_info': {'numCpus': 4}, 'host_uptime': 2000.0, 'host_disk_usage': {}}
+        calls = self.fake_operations(inventory)
+        capabilities.mark_supported('h1', 'inventory')
+
+        remote = result_of(self.action.fetch_remote(False))
+
+        assert remote == {'info': {'numCpus': 4}, 'uptime': 2000.0, 'disk_usage': {}}
+        assert len(calls) == 1
@@ -0,0 +1,38 @@
+import unittest
+
+from opennode.knot.backend.syncschedule import AdaptiveSyncSchedule
+
+
+class AdaptiveSyncScheduleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.schedule = AdaptiveSyncSchedule(10, 60, backoff=2, clock=lambda: self.now)
+
+    def test_new_host_is_due(self):
+        assert self.schedule.is_due('h1', 'host1')
+        assert self.schedule.get('h1').hostname == 'host1'
+
+    def test_backoff_and_reset(self):
+        for interval in (20, 40, 60, 60):
+            assert self.schedule.record('h1', 'host1', 0, False).interval == interval
+
+        entry = self.schedule.record('h1', 'host1', 3, False)
+        assert entry.interval == 10 and entry.idle_streak == 0
+        assert not self.schedule.is_due('h1')
+        self.now += 10
+        assert self.schedule.is_due('h1')
+
+    def test_failures_back_off(self):
+        self.schedule.record('h1', 'host1', 5, True)
+        entry = self.schedule.record('h1', 'host1', 5, True)
+        assert entry.interval == 40 and entry.failures == 2
+
+    def test_expedite(self):
+        self.schedule.record('h1', 'host1', 0, False)
+        self.schedule.record('h1', 'host1', 0, False)
+        assert not self.schedule.is_due('h1')
+
+        self.schedule.expedite('h1')
+        assert self.schedule.is_due('h1')
+        assert self.schedule.get('h1').interval == 10
@@ -0,0 +1,90 @@
+import unittest
+
+from BTrees.OOBTree import OOBTree
+
+from opennode.knot.model.compute import Compute
+from opennode.knot.model.machines import Machines
+from opennode.knot.model.template import GlobalTemplates, Template, Templates
+from opennode.knot.model.template import catalogue_templates, offers_template, uncatalogue_host
+from opennode.knot.model.virtualizationcontainer import VirtualizationContainer
+from opennode.oms.zodb import db
+
+
+def make_template(name, container=None):
+    template = Template(name, u'openvz')
+    template.__name__ = name
+    if container is not None:
+        container.add(template)
+    return template
+
+
+class TemplateCatalogueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.machines = Machines()
+        self.root = {'oms_root': {'machines': self.machines}, 'templates_catalogue': OOBTree(),
+                     'computes_index': OOBTree()}
+        self.get_root = db.get_root
+        db.get_root = lambda: self.root
+
+    def tearDown(self):
+        db.get_root = self.get_root
+
+    @property
+    def catalogue(self):
+        return self.root['templates_catalogue']
+
+    def test_catalogue(self):
+        centos, debian = make_template(u'centos'), make_template(u'debian')
+        catalogue_templates('h1', u'openvz', {u'centos': centos, u'debian': debian})
+        catalogue_templates('h2', u'openvz', {u'centos': centos})
+
+        assert offers_template(u'centos', 'h1', u'openvz')
+        assert not offers_template(u'centos', 'h1', u'kvm')
+        assert not offers_template(u'ubuntu', 'h1', u'openvz')
+
+        # templates the host no longer offers are forgotten
+        catalogue_templates('h1', u'openvz', {u'centos': centos})
+        assert not offers_template(u'debian', 'h1', u'openvz')
+        assert sorted(self.catalogue.keys()) == [u'centos']
+
+        uncatalogue_host('h1')
+        assert not offers_template(u'centos', 'h1', u'openvz')
+        assert offers_template(u'centos', 'h2', u'openvz')
+        uncatalogue_host('h2')
+        assert list(self.catalogue.keys()) == []
+
+        del self.root['templates_catalogue']
+        assert offers_template(u'centos', 'h2', u'openvz') is None
+
+    def make_host(self):
+        host = Compute(u'h1.example.com', u'active', 4096)
+        host.__name__ = 'h1'
+        self.machines.add(host)
+        vms = VirtualizationContainer(u'openvz')
+        host.add(vms)
+        templates = Templates()
+        vms.add(templates)
+
+        centos = make_template(u'centos', templates)
+        # known to the tree but not catalogued yet
+        make_template(u'ubuntu', templates)
+        catalogue_templates('h1', u'openvz', {u'centos': centos})
+        self.root['computes_index']['h1'] = host
+
+        # catalogued templates of a host that was deleted
+        gone = Compute(u'gone.example.com', u'active', 4096)
+        gone.__name__ = 'gone'
+        self.root['computes_index']['gone'] = gone
+        catalogue_templates('gone', u'openvz', {u'debian': make_template(u'debian')})
+        return host
+
+    def test_global_templates(self):
+        self.make_host()
+        assert sorted(GlobalTemplates()._items.keys()) == [u'centos']
+
+    def test_global_templates_without_index(self):
+        self.make_host()
+        del self.root['computes_index']
+        # the tree is walked instead
+        assert sorted(GlobalTemplates()._items.keys()) == [u'centos', u'ubuntu']
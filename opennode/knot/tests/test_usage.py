@@ -0,0 +1,35 @@
+import unittest
+
+from opennode.knot.backend.usage import UsageUpdater, ewma, rounded
+
+
+class UsageUpdaterTest(unittest.TestCase):
+
+    def test_ewma(self):
+        assert ewma(None, 10, 0.5) == 10.0
+        assert ewma(10.0, 20, 0.5) == 15.0
+        assert ewma((1.0, 2.0), (3.0, 4.0), 0.5) == (2.0, 3.0)
+        assert ewma({u'root': 10.0}, {u'root': 20.0, u'boot': 4.0}, 0.5) == {u'root': 15.0, u'boot': 4.0}
+        assert rounded((0.123456, {u'root': 1.005001})) == (0.12, {u'root': 1.01})
+
+    def test_observe(self):
+        updater = UsageUpdater(alpha=0.5, interval=10, clock=lambda: 100)
+        updater.observe('/machines/h1/metrics/memory_usage', [(1000, 100), (2000, 200)])
+        updater.observe('/machines/h1/metrics/uptime', [(1000, 5)])
+        updater.observe('/machines/h1/vms/v1/metrics/cpu_usage', [(1000, (1.0, 0.5, 0.2))])
+
+        assert updater.dirty == set(['/machines/h1', '/machines/h1/vms/v1'])
+        assert updater.smoothed['/machines/h1'] == {'memory_usage': 150.0}
+        assert updater.is_due()
+
+    def test_observe_ignores_mismatched_shapes(self):
+        updater = UsageUpdater(alpha=0.5, interval=10, clock=lambda: 100)
+        updater.observe('/machines/h1/metrics/cpu_usage', [(1000, 0.5)])
+        updater.observe('/machines/h1/metrics/network_usage', [(1000, {u'eth0': 1.0})])
+        updater.observe('/machines/h1/metrics/diskspace_usage', [(1000, 100.0)])
+        assert updater.dirty == set()
+        assert updater.smoothed.get('/machines/h1', {}) == {}
+
+        updater.observe('/machines/h1/metrics/cpu_usage', [(1000, (1.0, 0.5, 0.2)), (2000, 0.5)])
+        assert updater.smoothed['/machines/h1'] == {'cpu_usage': (1.0, 0.5, 0.2)}
+        assert updater.dirty == set(['/machines/h1'])
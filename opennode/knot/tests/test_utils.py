@@ -1,5 +1,6 @@
 import unittest
 from opennode.knot.utils import mac_addr_kvm_generator
+from opennode.knot.utils.vmdiff import diff_vms
 
 
 class UtilsTest(unittest.TestCase):
@@ -9,3 +10,13 @@ class UtilsTest(unittest.TestCase):
         assert len(mac) == 17
         assert ':' in mac
         assert mac.startswith('52:54:00')
+
+    def test_diff_vms(self):
+        remote = [{'uuid': 'a'}, {'uuid': 'b'}, {'uuid': 'c'}, {'uuid': 'a', 'dup': True}]
+        diff = diff_vms(remote, ['b', 'c', 'd'], lambda uuid, vm: uuid == 'c')
+        assert diff.added == ['a'] and 'dup' not in diff.remote['a']
+        assert diff.changed == ['b']
+        assert diff.unchanged == ['c']
+        assert diff.removed == ['d']
+        assert diff.needs_sync('a') and diff.needs_sync('b') and not diff.needs_sync('c')
+        assert len(diff) == 3
@@ -0,0 +1,68 @@
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+
+
+class VmDiff(object):
+    """Classification of the VMs reported by a host against the locally known ones.
+
+    `remote` indexes the remote payload by uuid; `added`, `removed`, `changed` and `unchanged` list
+    uuids in payload order (local order for removed ones).
+
+    """
+
+    def __init__(self):
+        self.remote = {}
+        self.added = []
+        self.removed = []
+        self.changed = []
+        self.unchanged = []
+        self._status = {}
+
+    def status(self, uuid):
+        return self._status.get(uuid)
+
+    def needs_sync(self, uuid):
+        return self._status.get(uuid) in (ADDED, CHANGED)
+
+    def _classify(self, uuid, status):
+        self._status[uuid] = status
+        getattr(self, status).append(uuid)
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
+
+    def __repr__(self):
+        return '<VmDiff +%s -%s ~%s =%s>' % (len(self.added), len(self.removed), len(self.changed),
+                                             len(self.unchanged))
+
+
+def diff_vms(remote_vms, local_uuids, is_unchanged=None):
+    """Classifies VMs in a single pass over the remote payload and the local uuids.
+
+    `is_unchanged(uuid, vm)` tells whether a VM present on both sides needs no update, by default all
+    of them are considered changed. Duplicate uuids in the payload keep the first entry.
+    """
+    diff = VmDiff()
+    local_uuids = list(local_uuids)
+    local_set = set(local_uuids)
+
+    for vm in remote_vms:
+        uuid = vm['uuid']
+        if uuid in diff.remote:
+            continue
+        diff.remote[uuid] = vm
+
+        if uuid not in local_set:
+            diff._classify(uuid, ADDED)
+        elif is_unchanged is not None and is_unchanged(uuid, vm):
+            diff._classify(uuid, UNCHANGED)
+        else:
+            diff._classify(uuid, CHANGED)
+
+    for uuid in local_uuids:
+        if uuid not in diff.remote:
+            diff._classify(uuid, REMOVED)
+
+    return diff
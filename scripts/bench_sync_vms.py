@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""Benchmarks the VM reconciliation of a sync against a synthetic host.
+
+Compares the former list-scanning matching with the uuid-indexed diff used by SyncVmsAction, on a host
+reporting COUNT containers of which a few were added, removed or changed since the last sync.
+
+Usage: bench_sync_vms.py [COUNT] [ROUNDS]
+"""
+import os
+import random
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from opennode.knot.utils.vmdiff import diff_vms
+
+
+def synthetic_host(count, churn):
+    remote_vms = [{'uuid': uuid.uuid4().hex, 'name': 'vm%s' % i, 'state': 'active',
+                   'template': 'centos', 'memory': 512, 'diskspace': {'/': 2048.0}}
+                  for i in xrange(count)]
+    local_uuids = [vm['uuid'] for vm in remote_vms]
+
+    random.shuffle(local_uuids)
+    del local_uuids[:churn]  # added on the host since the last sync
+    local_uuids.extend(uuid.uuid4().hex for i in xrange(churn))  # removed from the host
+    changed = set(random.sample(local_uuids, churn))
+    return remote_vms, local_uuids, changed
+
+
+def legacy_reconcile(remote_vms, local_uuids, changed):
+    remote_uuids = set(i['uuid'] for i in remote_vms)
+    local = set(local_uuids)
+    synced = 0
+    for vm_uuid in remote_uuids.difference(local):
+        [rvm for rvm in remote_vms if rvm['uuid'] == vm_uuid][0]
+    for vm_uuid in local_uuids + list(remote_uuids.difference(local)):
+        matching = [rvm for rvm in remote_vms if rvm['uuid'] == vm_uuid]
+        if not matching or vm_uuid not in changed and vm_uuid in local:
+            continue
+        synced += 1
+    return synced
+
+
+def indexed_reconcile(remote_vms, local_uuids, changed):
+    diff = diff_vms(remote_vms, local_uuids, lambda vm_uuid, vm: vm_uuid not in changed)
+    synced = 0
+    for vm_uuid in local_uuids + diff.added:
+        if diff.needs_sync(vm_uuid):
+            diff.remote[vm_uuid]
+            synced += 1
+    return synced
+
+
+def bench(fn, args, rounds):
+    best = None
+    for i in xrange(rounds):
+        start = time.time()
+        result = fn(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    args = synthetic_host(count, max(1, count / 100))
+
+    print 'Synthetic host: %s containers, %s added/removed/changed' % (count, max(1, count / 100))
+    for name, fn in (('list scan', legacy_reconcile), ('indexed diff', indexed_reconcile)):
+        elapsed, synced = bench(fn, args, rounds)
+        print '%-14s %8.2f ms  (%s VMs to sync)' % (name, elapsed * 1000, synced)
+
+
+if __name__ == '__main__':
+    main()